@@ -15,11 +15,8 @@ namespace py = pybind11;
 using tcp = boost::asio::ip::tcp;
 using namespace pybind11::literals;
 
-std::mutex g_lifecycle_mutex;
 std::mutex g_workers_mutex;
 
-double last_component_io_time;
-
 PYBIND11_EMBEDDED_MODULE(cpp_coordinator, m) {
   m.def(
       "on_new_pipeline",
@@ -30,8 +27,7 @@ PYBIND11_EMBEDDED_MODULE(cpp_coordinator, m) {
   m.def(
       "on_new_component",
       [](std::vector<std::string> info) {
-        g_coordinator_ptr->OnNewComponent(std::move(info));
-        return last_component_io_time;
+        return g_coordinator_ptr->OnNewComponent(std::move(info));
       },
       py::arg("info").none(false));
   m.def(
@@ -118,10 +114,10 @@ void Coordinator::DoActionFromMsg(std::shared_ptr<MessageHandler> worker,
       py_scheduler_->attr("add_new_worker")(wc);
     }
     OnWorkerGotID(worker, id);
-    workers_[id]->Send(
-        std::move(Message::MakeWithoutArgs("Coordinator", "request_manifest")));
+    workers_[id]->Send(std::move(Message::MakeRequest(
+        "Coordinator", "request_manifest", {}, NextRequestId())));
 
-  } else if (cmd == "response_manifest") {
+  } else if (cmd == "response_manifest" || cmd == "manifest_delta") {
     {
       py::gil_scoped_acquire guard{};
 
@@ -132,6 +128,13 @@ void Coordinator::DoActionFromMsg(std::shared_ptr<MessageHandler> worker,
       }
 
       auto new_worker = wc.attr("on_msg")(msg.ToPython()).cast<bool>();
+      if (wc.attr("needs_resync").cast<bool>()) {
+        util::log::Warn(kClassName, "Manifest of {} out of sync. Resyncing",
+                        id);
+        workers_[id]->Send(std::move(Message::MakeRequest(
+            "Coordinator", "request_manifest", {}, NextRequestId())));
+        return;
+      }
       if (new_worker) {
         py_scheduler_->attr("on_worker_ready")(
             wc, py::cpp_function([this, id](py::object component) {
@@ -141,35 +144,59 @@ void Coordinator::DoActionFromMsg(std::shared_ptr<MessageHandler> worker,
 
               auto command =
                   component.attr("command").cast<std::vector<std::string>>();
+              auto request_id = component.attr("request_id").cast<uint64_t>();
               util::log::Debug(kClassName,
-                               "Sending component execution task to {}: {}", id,
-                               fmt::join(command, ", "));
-              auto msg = Message::Make("Coordinator", "execute", command);
+                               "Sending component execution task #{} to {}: {}",
+                               request_id, id, fmt::join(command, ", "));
+              auto msg = Message::MakeRequest("Coordinator", "execute", command,
+                                              request_id);
               workers_[id]->Send(std::move(msg));
             }));
       }
     }
 
   } else if (cmd == "done") {
-    util::log::Info(kClassName, "Component done: {}. Time spent on I/O: {}",
-                    msg.args()[0], msg.args()[1]);
+    util::log::Info(kClassName,
+                    "Component done: {} (#{}). Time spent on I/O: {}",
+                    msg.args()[0], msg.request_id(), msg.args()[1]);
 
-    last_component_io_time = std::stod(msg.args()[1]);
+    std::shared_ptr<boost::promise<ComponentResult>> run;
+    {
+      std::lock_guard<std::mutex> lock(pending_runs_mutex_);
+      auto it = pending_runs_.find(msg.request_id());
+      if (it != pending_runs_.end()) {
+        run = std::move(it->second);
+        pending_runs_.erase(it);
+      }
+    }
+
+    // Workers before resource accounting only send the ID and I/O time
+    std::string resource_usage =
+        msg.args().size() > 2 ? msg.args()[2] : std::string("{}");
 
     {
       py::gil_scoped_acquire guard{};
 
       py::object wc = py_scheduler_->attr("get_worker")(id);
       if (wc.is(py::none())) {
+        // Still complete the request below, or the trial manager hangs
         util::log::Error(kClassName, "No worker with ID {}", id);
-        return;
+      } else {
+        // The scheduler recycles the worker if the usage asks for it
+        py_scheduler_->attr("on_component_done")(wc, resource_usage);
       }
+    }
 
-      py_scheduler_->attr("cache_worker")(wc);
+    if (!run) {
+      util::log::Error(kClassName, "No pending component for request #{}",
+                       msg.request_id());
+      return;
     }
-    util::log::Debug(kClassName,
-                     "Worker cached: {}. Unlocking g_lifecycle_mutex...", id);
-    g_lifecycle_mutex.unlock();  // This will unblock the trial manager
+    util::log::Debug(kClassName, "Completing request #{} of {}",
+                     msg.request_id(), id);
+    // Unblocks the trial manager
+    run->set_value(
+        ComponentResult(std::stod(msg.args()[1]), std::move(resource_usage)));
 
   } else if (cmd == "bye") {
     util::log::Debug(kClassName,
@@ -188,7 +215,8 @@ void Coordinator::DoActionFromMsg(std::shared_ptr<MessageHandler> worker,
     }
 
     util::log::Debug(kClassName, "Remaining workers: {}", workers_.size());
-    if (workers_.size() == 0) {
+    // Workers also leave when evicted or recycled, before the lifecycle ends
+    if (workers_.size() == 0 && lifecycle_done_) {
       g_workers_mutex.unlock();
       util::log::Debug(kClassName, "All workers disconnected. Exit", id);
 
@@ -219,6 +247,7 @@ void Coordinator::OnNewLifecycle(std::string manifest_name) {
     PyOnNewLifecycle(manifest_name);
 
     util::log::Debug(kClassName, "Lifecycle done. Exiting...");
+    lifecycle_done_ = true;
 
     for (auto it = workers_.begin(); it != workers_.end(); ++it) {
       auto& w = it->second;
@@ -246,10 +275,20 @@ void Coordinator::OnNewPipeline(std::vector<std::string> pipeline,
     }
   }
 }
-void Coordinator::OnNewComponent(std::vector<std::string> info) {
+ComponentResult Coordinator::OnNewComponent(std::vector<std::string> info) {
   ReleaseGIL();
+
+  // Completions are matched by request ID, so that components dispatched to
+  // the same worker (or by several trial managers) may finish in any order
+  auto request_id = NextRequestId();
+  auto run = std::make_shared<boost::promise<ComponentResult>>();
+  {
+    std::lock_guard<std::mutex> lock(pending_runs_mutex_);
+    pending_runs_[request_id] = run;
+  }
+
   boost::promise<bool> promise;
-  boost::asio::post(lifecycle_strand_, [this, info, &promise]() {
+  boost::asio::post(lifecycle_strand_, [this, info, request_id, &promise]() {
     {
       py::gil_scoped_acquire guard{};
       std::string id = info[0];
@@ -259,23 +298,24 @@ void Coordinator::OnNewComponent(std::vector<std::string> info) {
       py::object component = pc[id.c_str()];
       component.attr("path") = working_directory;
       component.attr("command") = info;
+      component.attr("request_id") = request_id;
 
       py_scheduler_->attr("get_compatible_worker_sync")(
-          component, py::cpp_function([this, info](std::string worker_id) {
+          component,
+          py::cpp_function([this, info, request_id](std::string worker_id) {
             py::exec(
                 "print(f'[Coordinator] TIME OF WORKER FOUND (EXISTING WORKER): "
                 "{time.time()}')");
 
             util::log::Debug(kClassName,
-                             "Sending component execution task to {}: {}",
-                             worker_id, fmt::join(info, ", "));
-            auto msg = Message::Make("Coordinator", "execute",
-                                     std::vector<std::string>(info));
+                             "Sending component execution task #{} to {}: {}",
+                             request_id, worker_id, fmt::join(info, ", "));
+            auto msg = Message::MakeRequest("Coordinator", "execute",
+                                            std::vector<std::string>(info),
+                                            request_id);
             workers_[worker_id]->Send(std::move(msg));
           }));
     }
-    util::log::Debug(kClassName, "Locking g_lifecycle_mutex...");
-    g_lifecycle_mutex.lock();
     util::log::Debug(kClassName, "Releasing promise...");
     promise.set_value(true);
   });
@@ -283,18 +323,18 @@ void Coordinator::OnNewComponent(std::vector<std::string> info) {
   util::log::Debug(kClassName, "Waiting for promise to release...");
   promise.get_future().get();
 
-  util::log::Debug(kClassName, "Locking g_lifecycle_mutex...");
-  // This will block the current thread (the trail manager)
-  g_lifecycle_mutex.lock();
+  // This will block the current thread (the trail manager) until `done`
+  auto result = run->get_future().get();
 
-  // Now the component is done
-  g_lifecycle_mutex.unlock();
   util::log::Debug(kClassName, "Component {} is done. Acquiring GIL...",
                    info[0]);
   AcquireGIL();
   util::log::Debug(kClassName, "GIL acquired. Resuming trial manager...");
+  return result;
 }
 
+uint64_t Coordinator::NextRequestId() { return next_request_id_++; }
+
 void Coordinator::AcquireGIL() {
   if (lifecycle_thread_state_) {
     PyEval_RestoreThread(lifecycle_thread_state_);
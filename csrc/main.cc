@@ -12,6 +12,8 @@
 #include <backward.hpp>
 #endif
 
+#include <algorithm>
+#include <boost/algorithm/string.hpp>
 #include <boost/asio.hpp>
 #include <boost/filesystem.hpp>
 #include <cstdio>
@@ -74,6 +76,38 @@ inline static void DebugShowSysPath() {
   util::log::Debug(kClassName, "sys.path = [{}]", fmt::join(sys_path, ", "));
 }
 
+/**
+ * @brief Connect to the coordinator and serve as a worker until exit.
+ * Requires an interpreter, with the GIL released.
+ */
+static void RunWorker(mhmode mode, const std::string& id,
+                      const std::string& coord_host,
+                      unsigned short coord_port) {
+  auto& conf = seccask::Config::Get();
+
+  boost::asio::io_context io;
+  boost::asio::executor_work_guard<boost::asio::io_context::executor_type>
+      work_guard(io.get_executor());
+
+  tcp::resolver resolver(io);
+
+  auto endpoints = resolver.resolve(coord_host, std::to_string(coord_port));
+  seccask::Worker w(mode, id, io, endpoints);
+  w.Start();
+
+  std::vector<std::thread> threads;
+
+  for (int n = 0; n < conf.NumIOThreads(); ++n) {
+    threads.emplace_back([&] { io.run(); });
+  }
+
+  for (auto& thread : threads) {
+    if (thread.joinable()) {
+      thread.join();
+    }
+  }
+}
+
 inline static std::string GetFileContent(std::string path) {
   std::ifstream t(path);
   std::stringstream buffer;
@@ -101,6 +135,8 @@ int main(int argc, const char** argv) {
   std::string coord_host;
   std::string key;
   unsigned short coord_port;
+  unsigned short zygote_port{0};
+  std::string zygote_profile;
   mhmode mode{mhmode::kPlaintext};
 
   CLI::App app{"SecCask 2"};
@@ -117,6 +153,11 @@ int main(int argc, const char** argv) {
                  "(Only for worker) Coordinator port to connect")
       ->default_val(seccask::Config::kDefaultCoordinatorPort);
   app.add_option("-k, --key", key, "Component key");
+  app.add_option("-z,--zygote-port", zygote_port,
+                 "(Only for worker) Serve as a zygote on this port, forking a "
+                 "worker per request");
+  app.add_option("--profile", zygote_profile,
+                 "(Only for zygote) Packages to preload, separated by commas");
 
   std::map<std::string, mhmode> map{{"plain", mhmode::kPlaintext},
                                     {"tls", mhmode::kTLS},
@@ -182,6 +223,31 @@ int main(int argc, const char** argv) {
       }
     }
 
+  } else if (zygote_port != 0) {
+    // Start as zygote. No thread may be started before forking
+    {
+      py::scoped_interpreter interp{};
+
+      std::vector<std::string> packages;
+      boost::split(packages, zygote_profile, boost::is_any_of(","),
+                   boost::token_compress_on);
+      packages.erase(std::remove(packages.begin(), packages.end(), ""),
+                     packages.end());
+
+      util::log::Info(kClassName, "Start as zygote at port {}. Preloading [{}]",
+                      zygote_port, fmt::join(packages, ", "));
+
+      // Only returns in forked children
+      id = py::module_::import("daemon.zygote")
+               .attr("serve")(zygote_port, packages)
+               .cast<std::string>();
+
+      util::log::Info(kClassName, "Forked from zygote as worker {}", id);
+
+      py::gil_scoped_release release{};
+      RunWorker(mode, id, coord_host, coord_port);
+    }
+
   } else {
     // Start as worker
     if (id.size() == 0) {
@@ -193,27 +259,7 @@ int main(int argc, const char** argv) {
       py::scoped_interpreter interp{};
       py::gil_scoped_release release{};
 
-      boost::asio::io_context io;
-      boost::asio::executor_work_guard<boost::asio::io_context::executor_type>
-          work_guard(io.get_executor());
-
-      tcp::resolver resolver(io);
-
-      auto endpoints = resolver.resolve(coord_host, std::to_string(coord_port));
-      seccask::Worker w(mode, id, io, endpoints);
-      w.Start();
-
-      std::vector<std::thread> threads;
-
-      for (int n = 0; n < conf.NumIOThreads(); ++n) {
-        threads.emplace_back([&] { io.run(); });
-      }
-
-      for (auto& thread : threads) {
-        if (thread.joinable()) {
-          thread.join();
-        }
-      }
+      RunWorker(mode, id, coord_host, coord_port);
     }
   }
 
@@ -2,9 +2,6 @@
 
 #include <pybind11/stl.h>
 
-#include <boost/algorithm/string.hpp>
-#include <boost/regex.hpp>
-
 using namespace pybind11::literals;
 
 namespace seccask {
@@ -22,44 +19,185 @@ Message Message::MakeWithoutArgs(std::string sender_id, std::string cmd) {
   return Message::Make(sender_id, cmd, std::move(std::vector<std::string>()));
 }
 
+Message Message::MakeRequest(std::string sender_id, std::string cmd,
+                             std::vector<std::string> args,
+                             uint64_t request_id) {
+  util::log::Debug(kClassName, "New message #{}: {} {} [{}]", request_id,
+                   sender_id, cmd, fmt::join(args, " "));
+  return Message(std::move(sender_id), std::move(cmd), std::move(args),
+                 request_id);
+}
+
+namespace {
+void EncodeVarint(uint64_t value, std::string& out) {
+  while (value >= 0x80) {
+    out.push_back(static_cast<char>((value & 0x7F) | 0x80));
+    value >>= 7;
+  }
+  out.push_back(static_cast<char>(value));
+}
+
+bool DecodeVarint(std::string_view buf, size_t& pos, uint64_t& value) {
+  value = 0;
+  for (int shift = 0; shift <= 63; shift += 7) {
+    if (pos >= buf.size()) {
+      return false;
+    }
+    auto b = static_cast<uint8_t>(buf[pos++]);
+    value |= static_cast<uint64_t>(b & 0x7F) << shift;
+    if (b < 0x80) {
+      return true;
+    }
+  }
+  return false;
+}
+
+/**
+ * @brief Text as `daemon/message.py` decodes it: bytes that are not valid UTF-8
+ * become surrogates, so that a field is always `str`.
+ */
+py::str DecodeText(const std::string& value) {
+  auto* str =
+      PyUnicode_DecodeUTF8(value.data(), value.size(), "surrogateescape");
+  if (str == nullptr) {
+    throw py::error_already_set();
+  }
+  return py::reinterpret_steal<py::str>(str);
+}
+
+void EncodeBytesField(uint64_t field, const std::string& value,
+                      std::string& out) {
+  EncodeVarint((field << 3) | Message::kKindBytes, out);
+  EncodeVarint(value.size(), out);
+  out.append(value);
+}
+}  // namespace
+
+std::string Message::ToString() const {
+  std::string result;
+  size_t reserved = kHeaderSize + sender_id_.size() + cmd_.size() + 20;
+  for (const auto& arg : args_) {
+    reserved += arg.size() + 10;
+  }
+  result.reserve(reserved);
+
+  result.push_back(static_cast<char>(kVersion));
+  result.push_back(0);
+  EncodeBytesField(kFieldSenderId, sender_id_, result);
+  EncodeBytesField(kFieldCmd, cmd_, result);
+  if (request_id_ != 0) {
+    EncodeVarint((kFieldRequestId << 3) | kKindVarint, result);
+    EncodeVarint(request_id_, result);
+  }
+  for (const auto& arg : args_) {
+    EncodeBytesField(kFieldArg, arg, result);
+  }
+  return result;
+}
+
 std::optional<Message> Message::MakeFromString(const std::string& value) {
+  if (value.size() < kHeaderSize ||
+      static_cast<uint8_t>(value[0]) != kVersion) {
+    util::log::Error(kClassName, "Unsupported message header");
+    return std::nullopt;
+  }
+  if (static_cast<uint8_t>(value[1]) & kFlagMore) {
+    util::log::Error(kClassName, "Multi-frame message. Use MakeFromFields");
+    return std::nullopt;
+  }
+  return MakeFromFields(std::string_view(value).substr(kHeaderSize));
+}
+
+std::optional<Message> Message::MakeFromFields(std::string_view fields) {
+  if (fields.size() > kMaxMessageSize) {
+    util::log::Error(kClassName, "Message of {} bytes is too large",
+                     fields.size());
+    return std::nullopt;
+  }
   std::string parsed_id;
   std::string parsed_cmd;
   std::vector<std::string> parsed_args;
+  uint64_t parsed_request_id = 0;
 
-  boost::smatch match;
-  auto is_matched =
-      boost::regex_search(value, match, boost::regex(kRegexPattern));
-  if (!is_matched) {
-    return std::nullopt;
-  }
+  size_t pos = 0;
+  while (pos < fields.size()) {
+    uint64_t tag;
+    if (!DecodeVarint(fields, pos, tag)) {
+      util::log::Error(kClassName, "Truncated field tag");
+      return std::nullopt;
+    }
+    auto field = tag >> 3;
+    auto kind = static_cast<uint8_t>(tag & 0x07);
 
-  util::log::Debug(kClassName, "Has {} matches:", match.size() - 1);
-  for (int i = 1; i < match.size(); i++) {
-    util::log::Debug(kClassName, "{}", std::string{match[i]});
+    std::string value;
+    uint64_t length;  // Also holds the value of a varint field
+    if (kind == kKindVarint) {
+      if (!DecodeVarint(fields, pos, length)) {
+        util::log::Error(kClassName, "Truncated varint");
+        return std::nullopt;
+      }
+      if (field == kFieldRequestId) {
+        parsed_request_id = length;
+      }
+      continue;
+    } else if (kind == kKindBytes) {
+      if (!DecodeVarint(fields, pos, length) ||
+          length > fields.size() - pos) {
+        util::log::Error(kClassName, "Truncated field");
+        return std::nullopt;
+      }
+      value.assign(fields.substr(pos, length));
+      pos += length;
+    } else if (kind == kKindChunked) {
+      while (true) {
+        if (!DecodeVarint(fields, pos, length) ||
+            length > fields.size() - pos) {
+          util::log::Error(kClassName, "Truncated chunk");
+          return std::nullopt;
+        }
+        if (length == 0) {
+          break;
+        }
+        value.append(fields.substr(pos, length));
+        pos += length;
+      }
+    } else {
+      util::log::Error(kClassName, "Unknown field kind {}", kind);
+      return std::nullopt;
+    }
+
+    if (field == kFieldSenderId) {
+      parsed_id = std::move(value);
+    } else if (field == kFieldCmd) {
+      parsed_cmd = std::move(value);
+    } else if (field == kFieldArg) {
+      parsed_args.emplace_back(std::move(value));
+    }
+    // Unknown fields are skipped for forward compatibility
   }
 
-  parsed_id = match[1];
-  parsed_cmd = match[2];
-  std::string parsed_args_str = match[3];
-  if (parsed_args_str.size() == 0) {
-    // No args
-    util::log::Debug(kClassName, "Parsed message: {} {}", parsed_id,
-                     parsed_cmd);
-  } else {
-    // Has args. Try to parse
-    util::log::Debug(kClassName, "args_str: {}", parsed_args_str);
-    boost::split(parsed_args, parsed_args_str, boost::is_any_of(kDelimiter));
-    util::log::Debug(kClassName, "Parsed message: {} {} [{}]", parsed_id,
-                     parsed_cmd, fmt::join(parsed_args, " "));
+  if (parsed_id.empty() || parsed_cmd.empty()) {
+    util::log::Error(kClassName, "Message without sender or command");
+    return std::nullopt;
   }
 
-  return Message::Make(parsed_id, parsed_cmd, parsed_args);
+  util::log::Debug(kClassName, "Parsed message #{}: {} {} ({} args)",
+                   parsed_request_id, parsed_id, parsed_cmd,
+                   parsed_args.size());
+  return Message(std::move(parsed_id), std::move(parsed_cmd),
+                 std::move(parsed_args), parsed_request_id);
 }
 
 py::object Message::ToPython() const {
   py::gil_scoped_acquire guard{};
   py::object Message = py::module_::import("daemon.message").attr("Message");
-  return Message("sender_id"_a = sender_id_, "cmd"_a = cmd_, "args"_a = args_);
+
+  py::list py_args;
+  for (const auto& arg : args_) {
+    py_args.append(DecodeText(arg));
+  }
+  return Message("sender_id"_a = DecodeText(sender_id_),
+                 "cmd"_a = DecodeText(cmd_), "args"_a = py_args,
+                 "request_id"_a = request_id_);
 }
 }  // namespace seccask
\ No newline at end of file
@@ -190,6 +190,14 @@ void MessageHandler::DoRead(const boost::asio::yield_context& yield) {
     return;
   }
   read_len_ = util::SwapEndian(read_len_);
+  if (read_len_ > Message::kMaxMessageSize + Message::kHeaderSize) {
+    // Reading it would be the peer's choice of allocation
+    util::log::Error(kClassName, "Frame of {} bytes is too large. Closing",
+                     read_len_);
+    read_fields_.clear();
+    Close();
+    return;
+  }
 
   mode_ == Mode::kPlaintext
       ? boost::asio::async_read(socket_, *read_buf_,
@@ -207,11 +215,38 @@ void MessageHandler::DoRead(const boost::asio::yield_context& yield) {
   std::string msg_str((std::istreambuf_iterator<char>(read_buf_.get())),
                       std::istreambuf_iterator<char>());
   read_buf_->consume(read_len_);
-  util::log::Debug(kClassName, "msg_str: [{}] {}", read_len_, msg_str);
+  util::log::Debug(kClassName, "Frame received: [{}]", read_len_);
+
+  if (msg_str.size() < Message::kHeaderSize ||
+      static_cast<uint8_t>(msg_str[0]) != Message::kVersion) {
+    // The peer speaks another protocol. Nothing after this can be trusted
+    util::log::Error(kClassName, "Unsupported message header. Closing");
+    read_fields_.clear();
+    Close();
+    return;
+  }
+
+  // Frames of a large message are joined before decoding
+  if (read_fields_.size() + msg_str.size() - Message::kHeaderSize >
+      Message::kMaxMessageSize) {
+    util::log::Error(kClassName, "Message over {} bytes. Closing",
+                     Message::kMaxMessageSize);
+    read_fields_.clear();
+    Close();
+    return;
+  }
+  read_fields_.append(msg_str, Message::kHeaderSize);
+  if (static_cast<uint8_t>(msg_str[1]) & Message::kFlagMore) {
+    DoRead(yield);
+    return;
+  }
 
-  auto try_msg = Message::MakeFromString(msg_str);
+  auto try_msg = Message::MakeFromFields(read_fields_);
+  read_fields_.clear();
   if (!try_msg.has_value()) {
-    util::log::Error(kClassName, "Message parse failed");
+    // Frames are length-prefixed, so the next one is still aligned
+    util::log::Error(kClassName, "Message parse failed. Skipped");
+    DoRead(yield);
     return;
   }
 
@@ -230,11 +265,18 @@ void MessageHandler::Close() {
   is_closing_ = true;
 
   boost::system::error_code ec;
-  ssl_socket_->shutdown(ec);
+  if (mode_ == Mode::kPlaintext) {
+    socket_.shutdown(boost::asio::ip::tcp::socket::shutdown_both, ec);
+  } else {
+    ssl_socket_->shutdown(ec);
+  }
   if (ec) {
     util::log::Error(kClassName, fmt::format("At line {}: {}", __LINE__,
                                              std::strerror(ec.value())));
   }
+  // Also wakes up pending reads and writes, which fail with `ec`
+  mode_ == Mode::kPlaintext ? socket_.close(ec)
+                            : ssl_socket_->lowest_layer().close(ec);
 }
 
 void MessageHandler::Send(Message&& msg) {
@@ -255,45 +297,57 @@ void MessageHandler::Send(Message&& msg,
 }
 
 void MessageHandler::DoWrite(const boost::asio::yield_context& yield) {
-  boost::system::error_code ec;
-  auto msg = write_msgs_.front().ToString();
-  write_len_ = msg.length();
-  write_len_ = util::SwapEndian(write_len_);
-  spdlog::debug("write_len_ in big endian: {}", write_len_);
-
-  mode_ == Mode::kPlaintext
-      ? boost::asio::async_write(socket_, boost::asio::buffer(&write_len_, 4),
-                                 yield[ec])
-      : boost::asio::async_write(
-            *ssl_socket_, boost::asio::buffer(&write_len_, 4), yield[ec]);
-  if (ec) {
-    util::log::Error(kClassName, fmt::format("At line {}: {}", __LINE__,
-                                             std::strerror(ec.value())));
+  // Only one coroutine writes, until the queue is empty. Others only queue:
+  // writing the front message again while it is in flight would interleave
+  // frames
+  if (is_writing_) {
     return;
   }
+  is_writing_ = true;
 
-  mode_ == Mode::kPlaintext
-      ? boost::asio::async_write(
-            socket_, boost::asio::buffer(msg, msg.length()), yield[ec])
-      : boost::asio::async_write(
-            *ssl_socket_, boost::asio::buffer(msg, msg.length()), yield[ec]);
-  if (ec) {
-    util::log::Error(kClassName, fmt::format("At line {}: {}", __LINE__,
-                                             std::strerror(ec.value())));
-    return;
-  }
+  while (!write_msgs_.empty()) {
+    boost::system::error_code ec;
+    auto msg = write_msgs_.front().ToString();
+    write_len_ = msg.length();
+    write_len_ = util::SwapEndian(write_len_);
+    spdlog::debug("write_len_ in big endian: {}", write_len_);
+
+    mode_ == Mode::kPlaintext
+        ? boost::asio::async_write(socket_, boost::asio::buffer(&write_len_, 4),
+                                   yield[ec])
+        : boost::asio::async_write(
+              *ssl_socket_, boost::asio::buffer(&write_len_, 4), yield[ec]);
+    if (ec) {
+      util::log::Error(kClassName, fmt::format("At line {}: {}", __LINE__,
+                                               std::strerror(ec.value())));
+      is_writing_ = false;
+      return;
+    }
+
+    mode_ == Mode::kPlaintext
+        ? boost::asio::async_write(
+              socket_, boost::asio::buffer(msg, msg.length()), yield[ec])
+        : boost::asio::async_write(
+              *ssl_socket_, boost::asio::buffer(msg, msg.length()), yield[ec]);
+    if (ec) {
+      util::log::Error(kClassName, fmt::format("At line {}: {}", __LINE__,
+                                               std::strerror(ec.value())));
+      is_writing_ = false;
+      return;
+    }
 
-  util::log::Info(kClassName, "Message sent: [{}] {}", write_len_, msg);
+    util::log::Info(kClassName, "Message sent: [{}] {}", msg.length(),
+                    write_msgs_.front().Repr());
 
-  if (write_msgs_.front().cmd() == "bye") {
-    this->Close();
-    _exit(0);
-  }
+    if (write_msgs_.front().cmd() == "bye") {
+      this->Close();
+      _exit(0);
+    }
 
-  write_msgs_.pop_front();
-  if (!write_msgs_.empty()) {
-    DoWrite();
+    write_msgs_.pop_front();
   }
+
+  is_writing_ = false;
 }
 
 void MessageHandler::Spawn(
@@ -47,56 +47,66 @@ void Worker::DoActionFromMsg(Message msg) {
       // handler_ = nullptr;
 
     } else if (msg.cmd() == "request_manifest") {
-      boost::asio::post(component_strand_, [this]() {
-        std::string manifest_str;
-
-        {
-          py::gil_scoped_acquire guard{};
-          py::exec("from manifest import Manifest");
-          util::log::Debug(kClassName, "manifest.Manifest imported");
-          manifest_str =
-              py::eval(
-                  fmt::format(
-                      R"end(Manifest.capture_current_env(appendix={{"worker_id": "{}"}}).json())end",
-                      id_))
-                  .cast<std::string>();
-        }
-
-        util::log::Debug(kClassName, "Manifest for current env: {}",
-                         manifest_str);
-        std::vector<std::string> manifest = {manifest_str};
-        handler_->Send(
-            std::move(Message::Make(id_, "response_manifest", manifest)));
-      });
+      auto request_id = msg.request_id();
+      Enqueue(
+          [this, request_id]() {
+            std::string manifest_str;
+
+            {
+              py::gil_scoped_acquire guard{};
+              py::object capture_manifest_delta =
+                  py::module_::import("manifest").attr("capture_manifest_delta");
+              util::log::Debug(kClassName,
+                               "manifest.capture_manifest_delta imported");
+              // The coordinator asks for a manifest on connection or resync.
+              // Always report the full package table
+              manifest_str =
+                  capture_manifest_delta("worker_id"_a = id_, "full"_a = true)
+                      .cast<std::string>();
+            }
+
+            util::log::Debug(kClassName, "Manifest for current env: {}",
+                             manifest_str);
+            std::vector<Message> msgs;
+            msgs.emplace_back(Message::MakeRequest(id_, "manifest_delta",
+                                                   {manifest_str}, request_id));
+            Reply(std::move(msgs));
+          },
+          true);
 
     } else if (msg.cmd() == "execute") {
       const std::vector<std::string> &args = msg.args();
+      auto request_id = msg.request_id();
       std::string component_id = args[0];
       std::string working_directory = args[1];
       std::string component_key = args[2];
       std::vector<std::string> cmds;
       cmds.assign(args.begin() + 3, args.end());
 
-      if (component_key == "NULL") {
-        util::log::Warn(
-            kClassName,
-            "Component key is empty. Do not do component encryption");
-      } else {
-        encfs::InitWithKey(component_key);
-      }
-
-      util::log::Debug(kClassName, "Execute component {} at {} with args [{}]",
-                       component_id, working_directory, fmt::join(cmds, " "));
-      boost::asio::post(component_strand_, [this, component_id,
-                                            working_directory, cmds]() {
+      util::log::Debug(
+          kClassName, "Queue component {} (#{}) at {} with args [{}]",
+          component_id, request_id, working_directory, fmt::join(cmds, " "));
+      Enqueue([this, request_id, component_id, working_directory,
+               component_key, cmds]() {
         std::string manifest_str;
         std::string finished_component_id;
 
+        // Set the key here rather than on arrival, since a queued component
+        // must not change the key of a running one
+        if (component_key == "NULL") {
+          util::log::Warn(
+              kClassName,
+              "Component key is empty. Do not do component encryption");
+        } else {
+          encfs::InitWithKey(component_key);
+        }
+
         util::log::Debug(
             kClassName, "In thread - Execute component {} at {} with args [{}]",
             component_id, working_directory, fmt::join(cmds, " "));
 
         double io_time = 0.0;
+        std::string resource_usage;
 
         {
           py::gil_scoped_acquire guard{};
@@ -113,27 +123,34 @@ void Worker::DoActionFromMsg(Message msg) {
 
           io_time = g_sc_time_spent_on_io;
 
-          manifest_str =
-              py::eval(
-                  fmt::format(
-                      R"end(Manifest.capture_current_env(appendix={{"worker_id": "{}"}}).json())end",
-                      id_))
-                  .cast<std::string>();
+          resource_usage = py::module_::import("daemon.worker")
+                               .attr("get_last_resource_usage")()
+                               .cast<std::string>();
         }
 
-        util::log::Debug(kClassName, "Component {} finished with manifest: {}",
+        // Captured before `done`: the coordinator caches the worker on `done`,
+        // and checks compatibility of the next component against its manifest
+        {
+          py::gil_scoped_acquire guard{};
+          manifest_str = py::module_::import("manifest")
+                             .attr("capture_manifest_delta")("worker_id"_a = id_)
+                             .cast<std::string>();
+        }
+
+        util::log::Debug(kClassName,
+                         "Component {} finished with manifest delta: {}",
                          finished_component_id, manifest_str);
 
-        handler_->Spawn([this, finished_component_id, manifest_str,
-                         io_time](boost::asio::yield_context yield) {
-          handler_->Send(std::move(Message::Make(id_, "response_manifest",
-                                                 {manifest_str})),
-                         yield);
-          handler_->Send(std::move(Message::Make(id_, "done",
-                                                 {finished_component_id,
-                                                  fmt::format("{}", io_time)})),
-                         yield);
-        });
+        // One reply, so that the two are sent in this order
+        std::vector<Message> msgs;
+        msgs.emplace_back(Message::MakeRequest(id_, "manifest_delta",
+                                               {manifest_str}, request_id));
+        msgs.emplace_back(Message::MakeRequest(
+            id_, "done",
+            {finished_component_id, fmt::format("{}", io_time),
+             resource_usage},
+            request_id));
+        Reply(std::move(msgs));
       });
     } else {
       util::log::Error(kClassName, "Unknown command: {}", msg.cmd());
@@ -142,4 +159,43 @@ void Worker::DoActionFromMsg(Message msg) {
     util::log::Error(kClassName, e.what());
   }
 }
+
+void Worker::Enqueue(std::function<void()> job, bool urgent) {
+  {
+    std::lock_guard<std::mutex> lock(run_queue_mutex_);
+    if (urgent) {
+      run_queue_.emplace_front(std::move(job));
+    } else {
+      run_queue_.emplace_back(std::move(job));
+    }
+    util::log::Debug(kClassName, "Run queue length: {}", run_queue_.size());
+  }
+
+  // One drain per job. Each drain takes whichever job is at the front
+  boost::asio::post(component_strand_, [this]() {
+    std::function<void()> next;
+    {
+      std::lock_guard<std::mutex> lock(run_queue_mutex_);
+      if (run_queue_.empty()) {
+        return;
+      }
+      next = std::move(run_queue_.front());
+      run_queue_.pop_front();
+    }
+    try {
+      next();
+    } catch (std::exception &e) {
+      util::log::Error(kClassName, e.what());
+    }
+  });
+}
+
+void Worker::Reply(std::vector<Message> msgs) {
+  auto shared_msgs = std::make_shared<std::vector<Message>>(std::move(msgs));
+  handler_->Spawn([this, shared_msgs](boost::asio::yield_context yield) {
+    for (auto &msg : *shared_msgs) {
+      handler_->Send(std::move(msg), yield);
+    }
+  });
+}
 }  // namespace seccask
\ No newline at end of file
@@ -3,16 +3,23 @@
 #include <fmt/format.h>
 #include <pybind11/pybind11.h>
 
+#include <atomic>
 #include <boost/asio.hpp>
+#include <boost/thread/future.hpp>
 #include <deque>
+#include <map>
 #include <memory>
+#include <mutex>
 #include <string>
+#include <utility>
 #include <vector>
 
 #include "seccask/message.h"
 #include "seccask/msg_handler.h"
 
 namespace seccask {
+using ComponentResult = std::pair<double, std::string>;
+
 class __attribute__((visibility("hidden"))) Coordinator
     : public std::enable_shared_from_this<Coordinator> {
  public:
@@ -26,6 +33,8 @@ class __attribute__((visibility("hidden"))) Coordinator
         port_(port),
         lifecycle_strand_(io),
         lifecycle_thread_state_(nullptr),
+        next_request_id_(1),
+        lifecycle_done_(false),
         component_key_() {
     memset(&gil_, 0, sizeof(PyGILState_STATE));
   }
@@ -36,7 +45,13 @@ class __attribute__((visibility("hidden"))) Coordinator
   void OnNewLifecycle(std::string manifest_name);
   void OnNewPipeline(std::vector<std::string> pipeline,
                      std::vector<std::string> ids);
-  void OnNewComponent(std::vector<std::string> info);
+  /**
+   * @brief Dispatch a component and block until it is done.
+   *
+   * @return Time spent on I/O by the component, and resources used by it (as
+   * JSON; see `profiler.ResourceMeter`)
+   */
+  ComponentResult OnNewComponent(std::vector<std::string> info);
   void OnCacheFull(std::string worker_id);
   void OnWaitingNewWorker();
   void OnWorkerGotID(std::shared_ptr<MessageHandler> worker, std::string id);
@@ -50,6 +65,7 @@ class __attribute__((visibility("hidden"))) Coordinator
  private:
   void AcquireGIL();
   void ReleaseGIL();
+  uint64_t NextRequestId();
   void DoAccept();
   void DoActionFromMsg(std::shared_ptr<MessageHandler> worker, Message msg);
 
@@ -64,6 +80,11 @@ class __attribute__((visibility("hidden"))) Coordinator
   std::shared_ptr<py::object> py_task_monitor_;
   PyGILState_STATE gil_;
   PyThreadState* lifecycle_thread_state_;
+  std::atomic<uint64_t> next_request_id_;
+  std::atomic<bool> lifecycle_done_; /**< Exit when the last worker leaves */
+  std::mutex pending_runs_mutex_;
+  std::map<uint64_t, std::shared_ptr<boost::promise<ComponentResult>>>
+      pending_runs_; /**< Components dispatched and not yet done */
   std::string component_key_;
 };
 }  // namespace seccask
@@ -5,8 +5,8 @@
 
 #include <iostream>
 #include <optional>
-#include <regex>
 #include <string>
+#include <string_view>
 #include <vector>
 
 #include "seccask/util.h"
@@ -17,38 +17,74 @@ namespace seccask {
 
 class Message {
  public:
-  inline static constexpr const char* kDelimiter = "%";
   inline static constexpr const char* kClassName = "Message";
-  inline static constexpr const char* kRegexPattern =
-      R"end(^(.+)\r\n(.+)\r\n(.*)$)end";
 
-  Message(std::string sender_id, std::string cmd, std::vector<std::string> args)
-      : sender_id_(sender_id), cmd_(cmd), args_(args) {}
+  /* Binary codec. Must be kept in sync with `pysrc/daemon/message.py` */
+  inline static constexpr uint8_t kVersion = 1;
+  inline static constexpr uint8_t kFlagMore = 0x01;
+  inline static constexpr size_t kHeaderSize = 2; /**< version + flags */
+  /** Frames of a message are joined in memory, so larger ones are refused */
+  inline static constexpr size_t kMaxMessageSize = 256 << 20;
+
+  inline static constexpr uint8_t kKindVarint = 0;
+  inline static constexpr uint8_t kKindBytes = 1;
+  inline static constexpr uint8_t kKindChunked = 2;
+
+  inline static constexpr uint64_t kFieldSenderId = 1;
+  inline static constexpr uint64_t kFieldCmd = 2;
+  inline static constexpr uint64_t kFieldArg = 3;
+  inline static constexpr uint64_t kFieldRequestId = 4;
+
+  Message(std::string sender_id, std::string cmd, std::vector<std::string> args,
+          uint64_t request_id = 0)
+      : sender_id_(sender_id),
+        cmd_(cmd),
+        args_(args),
+        request_id_(request_id) {}
   Message(const Message& rhs) =
       delete; /**< Copy constructor disabled. Consider either moving the
                  existing message or recreating by factory methods */
   Message(Message&& rhs) noexcept
       : sender_id_(std::move(rhs.sender_id_)),
         cmd_(std::move(rhs.cmd_)),
-        args_(std::move(rhs.args_)) {}
+        args_(std::move(rhs.args_)),
+        request_id_(rhs.request_id_) {}
 
   static Message Make(std::string sender_id, std::string cmd,
                       std::vector<std::string> args);
   static Message MakeWithoutArgs(std::string sender_id, std::string cmd);
+  /**
+   * @brief Make a request (with `request_id` != 0) or a reply to one (with the
+   * request ID of the message it answers).
+   */
+  static Message MakeRequest(std::string sender_id, std::string cmd,
+                             std::vector<std::string> args,
+                             uint64_t request_id);
+  /**
+   * @brief Decode a single frame body (header and fields, without the length
+   * prefix). Frames with `kFlagMore` set must be joined with `MakeFromFields`.
+   */
   static std::optional<Message> MakeFromString(const std::string& value);
+  /**
+   * @brief Decode concatenated field bytes of one or more frames.
+   */
+  static std::optional<Message> MakeFromFields(std::string_view fields);
 
   const std::string& sender_id() const { return sender_id_; }
   const std::string& cmd() const { return cmd_; }
   const std::vector<std::string>& args() const { return args_; }
+  uint64_t request_id() const { return request_id_; }
 
-  inline std::string ToString() const {
-    return fmt::format("{}\r\n{}\r\n{}", sender_id_, cmd_,
-                       fmt::join(args_, kDelimiter));
-  }
+  /**
+   * @brief Encode as a single frame body (header and fields, without the
+   * length prefix).
+   */
+  std::string ToString() const;
 
   inline std::string Repr() const {
-    return fmt::format("Message {{ sender_id: {}, cmd: {}, args: [{}] }}",
-                       sender_id_, cmd_, fmt::join(args_, " "));
+    return fmt::format(
+        "Message {{ sender_id: {}, cmd: {}, request_id: {}, args: [{}] }}",
+        sender_id_, cmd_, request_id_, fmt::join(args_, " "));
   }
 
   py::object ToPython() const;
@@ -57,5 +93,6 @@ class Message {
   std::string sender_id_;
   std::string cmd_;
   std::vector<std::string> args_;
+  uint64_t request_id_; /**< 0 if not a request or a reply to one */
 };
 }  // namespace seccask
\ No newline at end of file
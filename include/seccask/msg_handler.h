@@ -137,7 +137,9 @@ class MessageHandler : public std::enable_shared_from_this<MessageHandler> {
   uint32_t read_len_;
   uint32_t write_len_;
   std::shared_ptr<boost::asio::streambuf> read_buf_;
+  std::string read_fields_; /**< Fields of a message spanning frames */
   std::deque<Message> write_msgs_;
+  bool is_writing_ = false; /**< A coroutine is draining `write_msgs_` */
   std::function<void(std::shared_ptr<MessageHandler>, Message)> callback_;
   std::function<void(std::shared_ptr<MessageHandler>)> connected_callback_;
   bool is_closing_;
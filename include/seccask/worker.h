@@ -5,7 +5,9 @@
 #include <boost/asio.hpp>
 #include <boost/asio/ssl.hpp>
 #include <deque>
+#include <functional>
 #include <memory>
+#include <mutex>
 #include <string>
 #include <vector>
 
@@ -40,11 +42,24 @@ class Worker {
 
  private:
   void DoActionFromMsg(Message msg);
+  /**
+   * @brief Queue a job in the local run queue. Jobs run one at a time on
+   * `component_strand_`. Urgent jobs (e.g., manifest requests) skip ahead of
+   * queued components, so their replies may arrive before earlier requests
+   * complete.
+   */
+  void Enqueue(std::function<void()> job, bool urgent = false);
+  /**
+   * @brief Send messages in order.
+   */
+  void Reply(std::vector<Message> msgs);
 
   seccask::MessageHandler::Mode mode_;
   std::string id_;
   std::shared_ptr<MessageHandler> handler_;
   boost::asio::io_context::strand component_strand_;
+  std::mutex run_queue_mutex_;
+  std::deque<std::function<void()>> run_queue_;
   const boost::asio::ip::tcp::resolver::results_type& endpoints_;
 };
 
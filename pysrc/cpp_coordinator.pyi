@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Tuple
 
 def get_component_key() -> str:
     """Get Component Key. Debugging purpose only.
@@ -27,16 +27,20 @@ def on_new_pipeline(pipeline: List[str], ids: List[str]) -> None:
     """
     ...
 
-def on_new_component(info: List[str]) -> float:
+def on_new_component(info: List[str]) -> Tuple[float, str]:
     """On New Component callback.
 
     When a new component is created, this method is called to notify the coordinator.
+    Blocks until the component is done. Several threads may call this at the same
+    time; each call waits for its own component only.
     
     Args:
         info (List[str]): The information of the new component.
     
     Returns:
-        float: I/O time for component.
+        Tuple[float, str]: I/O time for component, and resources used by it as a
+            JSON object (CPU time, peak RSS, bytes read and written, page faults
+            and import time; see `profiler.ResourceMeter`).
         
     Example:
     ```
@@ -0,0 +1,165 @@
+"""Fan-out of updates to many asynchronous subscribers (e.g., websockets).
+
+Each subscriber has its own bounded queue. When the queue is full, the oldest
+item is dropped, so with `maxsize=1` a subscriber only ever sees the latest
+update (coalescing). A subscriber with a longer queue that keeps falling behind
+is disconnected after `max_drops` consecutive drops. With `maxsize=1`, the
+pending item is superseded rather than dropped, which is never counted: such a
+subscriber only needs the latest item, however busy it is. Publishing never
+blocks, and may happen from any thread.
+"""
+import asyncio
+import threading
+from typing import Any, Optional, Set
+
+
+class SubscriptionClosed(Exception):
+    pass
+
+
+_CLOSED = object()
+
+
+class Subscription:
+    def __init__(
+        self, hub: "BroadcastHub", maxsize: int, max_drops: Optional[int]
+    ) -> None:
+        self._hub = hub
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self._max_drops = max_drops
+        self._consecutive_drops = 0
+        self._num_dropped = 0
+        self._closed = False
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    @property
+    def num_dropped(self) -> int:
+        return self._num_dropped
+
+    def _offer(self, item: Any) -> None:
+        """Called on the event loop of the hub"""
+        if self._closed:
+            return
+
+        if self._queue.full():
+            self._queue.get_nowait()
+            self._num_dropped += 1
+            if self._queue.maxsize > 1:
+                self._consecutive_drops += 1
+                if (
+                    self._max_drops is not None
+                    and self._consecutive_drops > self._max_drops
+                ):
+                    self.close()
+                    return
+        self._queue.put_nowait(item)
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._hub.unsubscribe(self)
+        # Wake up a pending `get`
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._queue.put_nowait(_CLOSED)
+
+    async def get(self) -> Any:
+        """
+        Raises:
+            SubscriptionClosed: if the subscriber has been disconnected
+        """
+        item = await self._queue.get()
+        if item is _CLOSED:
+            self._queue.put_nowait(_CLOSED)
+            raise SubscriptionClosed
+        self._consecutive_drops = 0
+        return item
+
+    async def __aenter__(self) -> "Subscription":
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Any:
+        try:
+            return await self.get()
+        except SubscriptionClosed:
+            raise StopAsyncIteration
+
+
+class BroadcastHub:
+    """
+    ```
+    hub = BroadcastHub()
+
+    # In a coroutine
+    async with hub.subscribe() as sub:
+        async for update in sub:
+            ...
+
+    # Anywhere
+    hub.publish(update)
+    ```
+    """
+
+    def __init__(self, maxsize: int = 1, max_drops: Optional[int] = None) -> None:
+        self._maxsize = maxsize
+        self._max_drops = max_drops
+        self._subscribers: Set[Subscription] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+
+    @property
+    def num_subscribers(self) -> int:
+        with self._lock:
+            return len(self._subscribers)
+
+    def subscribe(
+        self, maxsize: Optional[int] = None, max_drops: Optional[int] = None
+    ) -> Subscription:
+        """Must be called on the event loop that consumes the updates"""
+        sub = Subscription(
+            self,
+            maxsize if maxsize is not None else self._maxsize,
+            max_drops if max_drops is not None else self._max_drops,
+        )
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+            self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def publish(self, item: Any = True) -> None:
+        with self._lock:
+            if not self._subscribers:
+                return
+            loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+
+        try:
+            in_loop = asyncio.get_running_loop() is loop
+        except RuntimeError:
+            in_loop = False
+
+        if in_loop:
+            self._deliver(item)
+        else:
+            loop.call_soon_threadsafe(self._deliver, item)
+
+    def _deliver(self, item: Any) -> None:
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            sub._offer(item)
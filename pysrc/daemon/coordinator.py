@@ -1,13 +1,16 @@
-import asyncio
-import itertools
 import json
 import datetime
 import os
+import sqlite3
+import threading
 import time
-from typing import Dict, List, Literal
+from collections import OrderedDict
+from typing import Dict, List, Literal, Optional, Tuple
 
+from pipeman.config import default_config as conf
 from pipeman.env import env
-from pipeman.utils import LogUtils, first, notify
+from pipeman.utils import LogUtils
+from daemon.broadcast import BroadcastHub, Subscription
 import pipeline as p
 
 
@@ -30,6 +33,117 @@ def on_new_lifecycle(manifest_name: str):
     exp_runner.start(manifest_path)
 
 
+class PipelineHistory:
+    """Finished pipelines, indexed by pipeline hash.
+
+    Finished pipelines do not change, so their info dicts are built once. The
+    latest `retention` ones are kept in memory; older ones spill to a SQLite
+    file (reset on startup) and are read back on demand. Each pipeline gets an increasing sequence
+    number, which is used as the pagination cursor.
+    """
+
+    def __init__(self, retention: int, spill_path: str) -> None:
+        self.logger = LogUtils.get_default_named_logger(type(self).__name__)
+        self._retention = retention
+        self._entries: "OrderedDict[str, Tuple[int, dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._next_seq = 1
+        self._num_spilled = 0
+
+        # Like the in-memory part, the history only covers the current run
+        self._db = sqlite3.connect(spill_path, check_same_thread=False)
+        with self._db:
+            self._db.execute("DROP TABLE IF EXISTS pipelines")
+            self._db.execute(
+                "CREATE TABLE pipelines "
+                "(seq INTEGER PRIMARY KEY, hash TEXT NOT NULL, info TEXT NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX pipelines_hash ON pipelines (hash)")
+
+    def add(self, pipeline: "p.Pipeline"):
+        info = pipeline.info_dict
+        with self._lock:
+            pipeline_hash = pipeline.hash
+            if pipeline_hash is None:
+                # No components, so nothing to hash. Still listed, under a key
+                # of its own
+                pipeline_hash = f"unhashed-{self._next_seq}"
+                info["pipeline_hash"] = pipeline_hash
+                self.logger.warning(
+                    f"Pipeline {pipeline.name} has no hash. Kept as {pipeline_hash}"
+                )
+            self._entries.pop(pipeline_hash, None)
+            self._entries[pipeline_hash] = (self._next_seq, info)
+            self._next_seq += 1
+
+            spilled = []
+            while len(self._entries) > self._retention:
+                h, (seq, old_info) = self._entries.popitem(last=False)
+                spilled.append((seq, h, json.dumps(old_info)))
+            if spilled:
+                with self._db:
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO pipelines VALUES (?, ?, ?)", spilled
+                    )
+                self._num_spilled += len(spilled)
+                self.logger.debug(f"{len(spilled)} pipeline(s) spilled to disk")
+
+    def get(self, pipeline_hash: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(pipeline_hash)
+            if entry is not None:
+                return entry[1]
+            row = self._db.execute(
+                "SELECT info FROM pipelines WHERE hash = ? ORDER BY seq DESC LIMIT 1",
+                (pipeline_hash,),
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def page(
+        self, cursor: Optional[int], limit: int
+    ) -> Tuple[List[dict], Optional[int]]:
+        """Finished pipelines, newest first.
+
+        Args:
+            cursor: only return pipelines older than this cursor. `None` starts
+                from the newest one
+            limit: max. number of pipelines to return. At least 1
+
+        Returns:
+            Tuple[List[dict], Optional[int]]: info dicts, and the cursor of the
+                next page (`None` if this is the last page)
+        """
+        if limit < 1:
+            raise ValueError(f"limit must be at least 1, not {limit}")
+        if cursor is None:
+            cursor = self._next_seq
+
+        result: List[Tuple[int, dict]] = []
+        with self._lock:
+            for seq, info in reversed(self._entries.values()):
+                if len(result) > limit:
+                    break
+                if seq < cursor:
+                    result.append((seq, info))
+
+            if len(result) <= limit and self._num_spilled > 0:
+                if result:
+                    cursor = min(cursor, result[-1][0])
+                rows = self._db.execute(
+                    "SELECT seq, info FROM pipelines WHERE seq < ? "
+                    "ORDER BY seq DESC LIMIT ?",
+                    (cursor, limit + 1 - len(result)),
+                ).fetchall()
+                result.extend((seq, json.loads(info)) for seq, info in rows)
+
+        next_cursor = result[limit - 1][0] if len(result) > limit else None
+        return [info for _, info in result[:limit]], next_cursor
+
+    def __len__(self):
+        return len(self._entries) + self._num_spilled
+
+
 class TaskMonitor:
     PUBLISHERS = Literal["pipeline_update"]
 
@@ -37,23 +151,31 @@ class TaskMonitor:
         self.logger = LogUtils.get_default_named_logger(type(self).__name__)
         self._dummy_pipeline = None
         self._active_pipeline: p.Pipeline = self.get_dummy_pipeline()
-        self._finished_pipelines: List[p.Pipeline] = []
+        self._history = PipelineHistory(
+            retention=conf.getint("coordinator", "history_retention"),
+            spill_path=os.path.join(env.temp_path, "pipeline_history.db"),
+        )
+        self._page_size = conf.getint("coordinator", "history_page_size")
         self._pending_components: Dict[str, p.Component] = {}
-        self._pipeline_update_publisher = asyncio.Queue(1)
+        # Each subscriber keeps only the latest update
+        self._pipeline_update_publisher = BroadcastHub()
+        self._version = 0
 
     def notify(self, publisher: PUBLISHERS):
         p = None
         if publisher == "pipeline_update":
             p = self._pipeline_update_publisher
+            self._version += 1
 
-        notify(p)
+        p.publish()
 
-    async def wait(self, publisher: PUBLISHERS):
+    def subscribe(self, publisher: PUBLISHERS) -> Subscription:
+        """Must be called on the event loop of the subscriber"""
         p = None
         if publisher == "pipeline_update":
             p = self._pipeline_update_publisher
 
-        await p.get()
+        return p.subscribe()
 
     def get_dummy_pipeline(self):
         if not self._dummy_pipeline:
@@ -62,6 +184,11 @@ class TaskMonitor:
             )
         return self._dummy_pipeline
 
+    @property
+    def version(self):
+        """Changes whenever `pipelines_info_dict` may change. Cheap to compute"""
+        return (self._version, self._active_pipeline.state_version)
+
     @property
     def active_pipeline(self):
         return self._active_pipeline
@@ -73,12 +200,13 @@ class TaskMonitor:
     @active_pipeline.setter
     def active_pipeline(self, active_pipeline: "p.Pipeline"):
         self._active_pipeline = active_pipeline
+        self.notify("pipeline_update")
 
     def record_component_done(self, component_id: str):
         component = self._pending_components[component_id]
         component.done = True
         component.end_time = int(time.time() * 1000)
-        # self.notify("pipeline_update")
+        self.notify("pipeline_update")
 
         if component.is_end_of_sequence:
             self._on_pipeline_done()
@@ -88,25 +216,35 @@ class TaskMonitor:
 
     def _on_pipeline_done(self):
         self.logger.debug(f"Pipeline done")
-        self._finished_pipelines.append(self._active_pipeline)
+        self._history.add(self._active_pipeline)
         self._active_pipeline = self.get_dummy_pipeline()
-        # self.notify("pipeline_update")
+        self.notify("pipeline_update")
 
     def add_pending_components(self, components: Dict[str, "p.Component"]):
         self._pending_components.update(components)
+        self.notify("pipeline_update")
 
     @property
     def pipelines_info_dict(self):
+        """The active pipeline and the latest page of finished ones"""
+        return self.get_pipelines_info_dict()
+
+    def get_pipelines_info_dict(
+        self, cursor: Optional[int] = None, limit: Optional[int] = None
+    ):
+        """`limit` is clamped to 1 to `history_page_size`, the default"""
+        if limit is None:
+            limit = self._page_size
+        limit = max(1, min(limit, self._page_size))
+        finished, next_cursor = self._history.page(cursor, limit)
         return {
             "active": self._active_pipeline.info_dict,
-            "finished": list(
-                map(lambda x: x.info_dict, reversed(self._finished_pipelines))
-            ),
+            "finished": finished,
+            "num_finished": len(self._history),
+            "next_cursor": next_cursor,
         }
 
-    def get_pipeline_info_dict(self, pipeline_hash: str):
-        return first(
-            itertools.chain([self._active_pipeline], self._finished_pipelines),
-            condition=lambda p: p.hash == pipeline_hash,
-            default=None,
-        ).info_dict
+    def get_pipeline_info_dict(self, pipeline_hash: str) -> Optional[dict]:
+        if self._active_pipeline.hash == pipeline_hash:
+            return self._active_pipeline.info_dict
+        return self._history.get(pipeline_hash)
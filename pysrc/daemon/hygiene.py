@@ -0,0 +1,145 @@
+"""Hygiene of long-lived workers, which run many components one after another.
+
+Without it, every run leaves its imports in `sys.modules` and its directory in
+`sys.path`, and freed memory is kept by the allocator, so that cached workers
+grow with every reuse. With hygiene, a run is bracketed by `Hygiene.before_run`
+and `Hygiene.after_run`, which:
+
+- restore `sys.path` to what it was before the run;
+- evict the modules imported by the run, except heavy shared packages (the
+    allowlist), the standard library, packages already loaded before the run,
+    and packages with extension modules (which cannot be safely imported
+    twice in a process);
+- collect garbage and return freed memory to the OS (`malloc_trim`);
+- tell if the worker should be recycled, when its RSS is above a threshold.
+
+State loaded before the first run (e.g., preloaded by a zygote) is moved to the
+permanent generation with `gc.freeze`, so that collections skip it.
+"""
+import ctypes
+import gc
+import importlib.machinery
+import os
+import sys
+import sysconfig
+from types import ModuleType
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Set
+
+_EXTENSION_SUFFIXES = tuple(importlib.machinery.EXTENSION_SUFFIXES)
+_STDLIB_PATHS = tuple(
+    os.path.realpath(sysconfig.get_paths()[k]) + os.sep
+    for k in ("stdlib", "platstdlib")
+)
+
+
+class HygieneReport(NamedTuple):
+    evicted_modules: int
+    rss_bytes: Optional[int]
+    recycle: bool
+    """True if RSS is above the threshold and the worker should be recycled"""
+
+
+def _is_extension(module: ModuleType) -> bool:
+    file = getattr(module, "__file__", None)
+    return file is not None and file.endswith(_EXTENSION_SUFFIXES)
+
+
+def _is_stdlib(name: str, module: ModuleType) -> bool:
+    if name in sys.builtin_module_names:
+        return True
+    file = getattr(module, "__file__", None)
+    if file is None:
+        return False
+    path = os.path.realpath(file)
+    return path.startswith(_STDLIB_PATHS) and "-packages" + os.sep not in path
+
+
+def current_rss_bytes() -> Optional[int]:
+    """Resident set size of this process. None if unknown"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def malloc_trim() -> bool:
+    """Return free heap memory to the OS. False if not on glibc"""
+    try:
+        return bool(ctypes.CDLL("libc.so.6").malloc_trim(0))
+    except (OSError, AttributeError):
+        return False
+
+
+class Hygiene:
+    def __init__(self, keep_packages: Iterable[str], max_rss_bytes: int) -> None:
+        """
+        Args:
+            keep_packages: top-level packages never evicted, e.g., `numpy`
+            max_rss_bytes: recycle the worker above this RSS. 0 to disable
+        """
+        self._keep_packages = set(keep_packages)
+        self._max_rss_bytes = max_rss_bytes
+        self._frozen = False
+        self._path_snapshot: List[str] = []
+        self._modules_snapshot: Set[str] = set()
+
+    def before_run(self) -> None:
+        if not self._frozen:
+            gc.collect()
+            gc.freeze()
+            self._frozen = True
+        self._path_snapshot = list(sys.path)
+        self._modules_snapshot = set(sys.modules)
+
+    def after_run(
+        self,
+        retain: Callable[[ModuleType], bool] = lambda m: False,
+        keep_packages: Iterable[str] = (),
+    ) -> HygieneReport:
+        """
+        Args:
+            retain: modules imported by the run to keep anyway (e.g., the
+                helpers held by the module cache)
+            keep_packages: top-level packages to keep this time, e.g., those
+                that modules kept alive elsewhere refer to. Evicting them would
+                free nothing, and importing them again would make a second
+                copy, whose types differ from the first
+        """
+        sys.path[:] = self._path_snapshot
+        # Returns before collecting, so that no local still holds the modules
+        evicted = self._evict_modules(retain, set(keep_packages))
+
+        gc.collect()
+        malloc_trim()
+
+        rss = current_rss_bytes()
+        recycle = (
+            self._max_rss_bytes > 0 and rss is not None and rss > self._max_rss_bytes
+        )
+        return HygieneReport(evicted, rss, recycle)
+
+    def _evict_modules(
+        self, retain: Callable[[ModuleType], bool], keep_packages: Set[str]
+    ) -> int:
+        # Imported by the run, by top-level package
+        groups: Dict[str, Dict[str, ModuleType]] = {}
+        for name in set(sys.modules) - self._modules_snapshot:
+            groups.setdefault(name.partition(".")[0], {})[name] = sys.modules[name]
+
+        evicted = 0
+        for top, modules in groups.items():
+            if (
+                top in self._keep_packages
+                or top in keep_packages
+                or top in self._modules_snapshot
+                or any(
+                    _is_stdlib(n, m) or _is_extension(m) for n, m in modules.items()
+                )
+            ):
+                continue
+            for name, module in modules.items():
+                if not retain(module):
+                    del sys.modules[name]
+                    evicted += 1
+        return evicted
@@ -0,0 +1,152 @@
+"""Windowed reads of (possibly huge, growing) worker log files.
+
+Nothing here loads more than one window of a log into memory: reads are by
+byte offset and length, grep scans the file chunk by chunk, and follow mode
+polls for appended bytes.
+"""
+import asyncio
+import os
+import re
+from typing import AsyncIterator, List, NamedTuple, Optional, Pattern
+
+CHUNK_SIZE = 65536
+
+
+class LogWindow(NamedTuple):
+    offset: int
+    """Where the window starts"""
+    next_offset: int
+    """Where the next window starts (the size of the file when at the end)"""
+    size: int
+    """Size of the file when read"""
+    data: str
+
+
+class GrepMatch(NamedTuple):
+    offset: int
+    """Offset of the beginning of the matched line"""
+    line: str
+
+
+class GrepResult(NamedTuple):
+    offset: int
+    next_offset: int
+    """Where to continue scanning; equals `size` when the whole file is scanned"""
+    size: int
+    matches: List[GrepMatch]
+
+
+def _decode(data: bytes) -> str:
+    return data.decode("utf-8", errors="replace")
+
+
+def _resolve_offset(offset: Optional[int], length: int, size: int) -> int:
+    """Negative offsets count from the end. `None` is the last window"""
+    if offset is None:
+        offset = -length
+    if offset < 0:
+        offset = max(size + offset, 0)
+    return min(offset, size)
+
+
+def read_window(path: str, offset: Optional[int], length: int) -> LogWindow:
+    """Read at most `length` bytes from `offset`.
+
+    Raises:
+        FileNotFoundError
+        ValueError: if `length` is not positive
+    """
+    if length <= 0:
+        raise ValueError(f"Window length must be positive, not {length}")
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        offset = _resolve_offset(offset, length, size)
+        f.seek(offset)
+        data = f.read(length)
+    return LogWindow(offset, offset + len(data), size, _decode(data))
+
+
+def grep(
+    path: str,
+    pattern: Pattern[bytes],
+    offset: Optional[int],
+    length: int,
+    max_matches: int,
+) -> GrepResult:
+    """Lines matching `pattern` among (about) `length` bytes from `offset`.
+
+    Scanning starts at the first line boundary from `offset`, and stops at a
+    line boundary after `length` bytes or at `max_matches` matches.
+    `next_offset` tells where to resume. Lines longer than `CHUNK_SIZE` are
+    matched piecewise.
+
+    Raises:
+        FileNotFoundError
+        ValueError: if `length` or `max_matches` is not positive
+    """
+    if length <= 0 or max_matches <= 0:
+        raise ValueError("Window length and max. matches must be positive")
+    matches: List[GrepMatch] = []
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        offset = _resolve_offset(offset, length, size)
+        if offset > 0:
+            # Start at the beginning of the next line, if within the window
+            f.seek(offset - 1)
+            if f.read(1) != b"\n":
+                skipped = 0
+                while skipped < length:
+                    piece = f.readline(min(CHUNK_SIZE, length - skipped))
+                    skipped += len(piece)
+                    if not piece or piece.endswith(b"\n"):
+                        break
+                else:
+                    # Within a line longer than the window. Resume after it
+                    return GrepResult(f.tell(), f.tell(), size, matches)
+        pos = start = f.tell()
+
+        while pos < size and pos - start < length and len(matches) < max_matches:
+            line = f.readline(CHUNK_SIZE)
+            if not line:
+                break
+            if pattern.search(line):
+                matches.append(GrepMatch(pos, _decode(line.rstrip(b"\r\n"))))
+            pos += len(line)
+
+    return GrepResult(start, pos, size, matches)
+
+
+async def follow(
+    path: str, offset: Optional[int], poll_interval: float
+) -> AsyncIterator[LogWindow]:
+    """Windows of bytes appended to the log, from `offset` (or the end).
+
+    Starts again from the beginning if the file gets truncated.
+
+    Raises:
+        FileNotFoundError
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        pos = size if offset is None else _resolve_offset(offset, 0, size)
+
+        while True:
+            size = os.fstat(f.fileno()).st_size
+            if size < pos:
+                pos = 0
+            if size == pos:
+                await asyncio.sleep(poll_interval)
+                continue
+
+            f.seek(pos)
+            data = f.read(min(size - pos, CHUNK_SIZE))
+            yield LogWindow(pos, pos + len(data), size, _decode(data))
+            pos += len(data)
+
+
+def compile_pattern(pattern: str, ignore_case: bool = False) -> Pattern[bytes]:
+    """
+    Raises:
+        re.error
+    """
+    return re.compile(pattern.encode(), re.IGNORECASE if ignore_case else 0)
@@ -1,11 +1,105 @@
-from typing import Any, List
+"""Coordinator/worker messages and their binary codec.
+
+Wire format of one frame (same as `csrc/message.cc`):
+
+    | length: u32 BE | version: u8 | flags: u8 | fields ... |
+
+`length` counts everything after itself. If `flags & FLAG_MORE` is set, the
+message continues in the next frame: the field bytes of all frames are
+concatenated before decoding. Each field is
+
+    | tag: varint | value |
+
+where `tag = (field_number << 3) | kind`. Kinds:
+
+    KIND_VARINT:  value is a varint
+    KIND_BYTES:   value is `| len: varint | bytes |`
+    KIND_CHUNKED: value is a sequence of `| len: varint | bytes |` ended by a
+                  zero length. Used to stream payloads of unknown size.
+
+Fields: 1 sender_id (str), 2 cmd (str), 3 arg (str, repeated), 4 request_id
+(varint, omitted if 0). Text is UTF-8. Bytes that are not valid UTF-8 are
+decoded to surrogates (`surrogateescape`), and encoded back unchanged, so
+that every field decodes to one type whatever its content.
+
+A reply carries the request id of the message it answers, so that several
+requests can be in flight on one connection and complete in any order.
+"""
+import struct
+from typing import Any, Iterable, Iterator, List, Union
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+VERSION = 1
+FLAG_MORE = 0x01
+
+KIND_VARINT = 0
+KIND_BYTES = 1
+KIND_CHUNKED = 2
+
+FIELD_SENDER_ID = 1
+FIELD_CMD = 2
+FIELD_ARG = 3
+FIELD_REQUEST_ID = 4
+
+DEFAULT_MAX_FRAME_SIZE = 1 << 20
+MAX_MESSAGE_SIZE = 256 << 20
+"""Frames of a message are joined in memory, so larger ones are refused"""
+
+_FRAME_HEADER = struct.Struct(">IBB")
+
+
+class MessageDecodeError(ValueError):
+    pass
+
+
+def encode_varint(value: int, out: bytearray) -> None:
+    if value < 0:
+        raise ValueError("varint must be non-negative")
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(buf: memoryview, pos: int):
+    """Returns (value, new position)"""
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(buf):
+            raise MessageDecodeError("Truncated varint")
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise MessageDecodeError("Varint too long")
+
+
+TEXT_ERRORS = "surrogateescape"
+
+
+def _decode_text(value: Buffer) -> str:
+    return str(value, "utf-8", TEXT_ERRORS)
+
+
+def _encode_bytes_field(field: int, value: Buffer, out: bytearray) -> None:
+    encode_varint((field << 3) | KIND_BYTES, out)
+    encode_varint(len(value), out)
+    out += value
 
 
 class Message:
-    def __init__(self, sender_id: str, cmd: str, args: List[Any] = []) -> None:
+    def __init__(
+        self, sender_id: str, cmd: str, args: List[Any] = [], request_id: int = 0
+    ) -> None:
         self._sender_id = sender_id
         self._cmd = cmd
         self._args = args
+        self._request_id = request_id
 
     @property
     def sender_id(self):
@@ -19,18 +113,245 @@ class Message:
     def args(self):
         return self._args
 
+    @property
+    def request_id(self) -> int:
+        """0 if the message is neither a request nor a reply to one"""
+        return self._request_id
+
     def __repr__(self) -> str:
-        return f"<MSG:From {self.sender_id}|{self.cmd} with args {self.args}>"
+        rid = f"#{self.request_id}" if self.request_id else ""
+        return f"<MSG{rid}:From {self.sender_id}|{self.cmd} with args {self.args}>"
+
+    def encode_body(self) -> bytearray:
+        """Fields only, without frame header"""
+        out = bytearray()
+        sender_id = self._sender_id.encode("utf-8", TEXT_ERRORS)
+        _encode_bytes_field(FIELD_SENDER_ID, sender_id, out)
+        _encode_bytes_field(FIELD_CMD, self._cmd.encode("utf-8", TEXT_ERRORS), out)
+        if self._request_id:
+            encode_varint((FIELD_REQUEST_ID << 3) | KIND_VARINT, out)
+            encode_varint(self._request_id, out)
+        for arg in self._args:
+            if isinstance(arg, str):
+                arg = arg.encode("utf-8", TEXT_ERRORS)
+            _encode_bytes_field(FIELD_ARG, arg, out)
+        return out
 
     def dump(self) -> bytearray:
-        body = f"{self._sender_id}\r\n{self._cmd}\r\n{'%'.join(self.args)}"
-        result = bytearray()
-        result.extend(len(body).to_bytes(4, "big"))
-        result.extend(map(ord, body))
+        """Encode as a single frame"""
+        body = self.encode_body()
+        result = bytearray(_FRAME_HEADER.pack(len(body) + 2, VERSION, 0))
+        result += body
         return result
 
+    def dump_frames(
+        self,
+        stream_arg: Iterable[Buffer] = (),
+        max_frame_size: int = DEFAULT_MAX_FRAME_SIZE,
+    ) -> Iterator[bytes]:
+        """Encode as frames of at most `max_frame_size` body bytes.
+
+        Chunks from `stream_arg` are sent as one extra trailing argument of
+        unknown size (e.g., a log or manifest read piece by piece), so the
+        payload never has to be held in memory as a whole.
+        """
+        pending = self.encode_body()
+        has_stream = False
+
+        def frame(body: Buffer, more: bool) -> bytes:
+            flags = FLAG_MORE if more else 0
+            return _FRAME_HEADER.pack(len(body) + 2, VERSION, flags) + body
+
+        for chunk in stream_arg:
+            if not has_stream:
+                encode_varint((FIELD_ARG << 3) | KIND_CHUNKED, pending)
+                has_stream = True
+            if len(chunk) == 0:
+                continue
+            encode_varint(len(chunk), pending)
+            pending += chunk
+            while len(pending) > max_frame_size:
+                yield frame(pending[:max_frame_size], more=True)
+                del pending[:max_frame_size]
+
+        if has_stream:
+            encode_varint(0, pending)
+        while len(pending) > max_frame_size:
+            yield frame(pending[:max_frame_size], more=True)
+            del pending[:max_frame_size]
+        yield frame(pending, more=False)
+
+    @staticmethod
+    def decode_body(body: Buffer) -> "Message":
+        """Decode concatenated field bytes.
+
+        String fields, arguments included, are always `str` (see the module
+        documentation).
+        """
+        buf = memoryview(body)
+        pos = 0
+        sender_id = ""
+        cmd = ""
+        args: List[Any] = []
+        request_id = 0
+
+        while pos < len(buf):
+            tag, pos = decode_varint(buf, pos)
+            field, kind = tag >> 3, tag & 0x07
+
+            if kind == KIND_VARINT:
+                value, pos = decode_varint(buf, pos)
+            elif kind == KIND_BYTES:
+                length, pos = decode_varint(buf, pos)
+                if pos + length > len(buf):
+                    raise MessageDecodeError("Truncated field")
+                value = buf[pos : pos + length]
+                pos += length
+            elif kind == KIND_CHUNKED:
+                parts = []
+                while True:
+                    length, pos = decode_varint(buf, pos)
+                    if length == 0:
+                        break
+                    if pos + length > len(buf):
+                        raise MessageDecodeError("Truncated chunk")
+                    parts.append(buf[pos : pos + length])
+                    pos += length
+                value = b"".join(parts)
+            else:
+                raise MessageDecodeError(f"Unknown field kind {kind}")
+
+            if field == FIELD_SENDER_ID:
+                sender_id = _decode_text(value)
+            elif field == FIELD_CMD:
+                cmd = _decode_text(value)
+            elif field == FIELD_ARG:
+                args.append(_decode_text(value))
+            elif field == FIELD_REQUEST_ID:
+                request_id = value
+            # Unknown fields are skipped for forward compatibility
+
+        return Message(sender_id, cmd, args, request_id)
+
     @staticmethod
-    def load(msg_str: str):
-        tokens = msg_str.split("\r\n")
-        args = tokens[2].split("%")
-        return Message(tokens[0], tokens[1], args)
+    def load(frame: Buffer) -> "Message":
+        """Decode a single frame produced by `dump`"""
+        buf = memoryview(frame)
+        if len(buf) < _FRAME_HEADER.size:
+            raise MessageDecodeError("Truncated frame header")
+        length, version, flags = _FRAME_HEADER.unpack_from(buf)
+        if version != VERSION:
+            raise MessageDecodeError(f"Unsupported version {version}")
+        if flags & FLAG_MORE:
+            raise MessageDecodeError("Multi-frame message. Use MessageReader")
+        return Message.decode_body(buf[_FRAME_HEADER.size : 4 + length])
+
+
+class MessageReader:
+    """Incremental decoder for a byte stream of frames.
+
+    ```
+    reader = MessageReader()
+    for data in sock_chunks:
+        for msg in reader.feed(data):
+            ...
+    ```
+    """
+
+    def __init__(self) -> None:
+        self._buf = bytearray()
+        self._body = bytearray()
+
+    def feed(self, data: Buffer) -> List[Message]:
+        self._buf += data
+        result = []
+        view = memoryview(self._buf)
+        pos = 0
+        try:
+            while len(view) - pos >= 4:
+                (length,) = struct.unpack_from(">I", view, pos)
+                if length - 2 > MAX_MESSAGE_SIZE:
+                    raise MessageDecodeError(f"Frame of {length} bytes too large")
+                if len(view) - pos - 4 < length:
+                    break
+                if length < 2:
+                    raise MessageDecodeError("Frame too short")
+                version, flags = view[pos + 4], view[pos + 5]
+                if version != VERSION:
+                    raise MessageDecodeError(f"Unsupported version {version}")
+                with view[pos + 6 : pos + 4 + length] as body:
+                    pos += 4 + length
+                    if flags & FLAG_MORE or len(self._body) > 0:
+                        if len(self._body) + len(body) > MAX_MESSAGE_SIZE:
+                            raise MessageDecodeError("Message too large")
+                        self._body += body
+                        if flags & FLAG_MORE:
+                            continue
+                        result.append(Message.decode_body(self._body))
+                        self._body = bytearray()
+                    else:
+                        # Copy out, since `_buf` is compacted below
+                        result.append(Message.decode_body(bytes(body)))
+        finally:
+            view.release()
+        del self._buf[:pos]
+        return result
+
+
+def _legacy_dump(msg: Message) -> bytearray:
+    """Text format used before the binary codec. Kept for the benchmark."""
+    body = f"{msg.sender_id}\r\n{msg.cmd}\r\n{'%'.join(msg.args)}"
+    result = bytearray()
+    result.extend(len(body).to_bytes(4, "big"))
+    result.extend(map(ord, body))
+    return result
+
+
+def _legacy_load(msg_str: str) -> Message:
+    tokens = msg_str.split("\r\n")
+    args = tokens[2].split("%")
+    return Message(tokens[0], tokens[1], args)
+
+
+if __name__ == "__main__":
+    import json
+    import timeit
+
+    # Benchmark: binary codec vs. the legacy text format
+    manifest = json.dumps(
+        {f"package-{i}": f"{i}.{i % 7}.{i % 3}" for i in range(2000)}
+    )
+    cases = {
+        "small": Message("worker-1", "done", ["component-1", "0.123"]),
+        "manifest": Message("worker-1", "response_manifest", [manifest]),
+    }
+    n = 200
+
+    for name, msg in cases.items():
+        legacy = _legacy_dump(msg)
+        legacy_str = legacy[4:].decode("latin-1")
+        binary = msg.dump()
+        assert Message.load(binary).args == msg.args
+
+        t_ld = timeit.timeit(lambda: _legacy_dump(msg), number=n) / n
+        t_ll = timeit.timeit(lambda: _legacy_load(legacy_str), number=n) / n
+        t_bd = timeit.timeit(lambda: msg.dump(), number=n) / n
+        t_bl = timeit.timeit(lambda: Message.load(binary), number=n) / n
+        print(
+            f"[{name}] size legacy={len(legacy)}B binary={len(binary)}B | "
+            f"dump legacy={t_ld * 1e6:.1f}us binary={t_bd * 1e6:.1f}us | "
+            f"load legacy={t_ll * 1e6:.1f}us binary={t_bl * 1e6:.1f}us"
+        )
+
+    # Streaming: 64 MiB payload in 1 MiB frames
+    chunk = b"x" * (1 << 16)
+    reader = MessageReader()
+    t0 = timeit.default_timer()
+    msgs = []
+    for frame in Message("worker-1", "log").dump_frames(
+        stream_arg=(chunk for _ in range(1024))
+    ):
+        msgs.extend(reader.feed(frame))
+    t1 = timeit.default_timer()
+    assert len(msgs) == 1 and len(msgs[0].args[0]) == 1 << 26
+    print(f"[stream] 64 MiB in {t1 - t0:.3f}s")
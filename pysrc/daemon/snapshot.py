@@ -0,0 +1,126 @@
+"""Versioned JSON snapshots of coordinator state for the WebAPI.
+
+A `Snapshot` rebuilds its document only when the version reported by the
+owner of the state changes (e.g., a mutation counter), so that polling
+dashboards do not walk the scheduler or the pipelines on every request.
+Consecutive snapshots are diffed into JSON patches (RFC 6902) for websocket
+pushes.
+"""
+import json
+import threading
+import time
+from typing import Any, Callable, Hashable, List, NamedTuple, Optional, Tuple
+
+
+class SnapshotState(NamedTuple):
+    seq: int
+    """Increases by one on each rebuild"""
+    document: Any
+    json: str
+    etag: str
+
+
+def _escape_pointer(token: str) -> str:
+    return token.replace("~", "~0").replace("/", "~1")
+
+
+def make_json_patch(old: Any, new: Any, path: str = "") -> List[dict]:
+    """Minimal RFC 6902 patch turning `old` into `new`"""
+    if type(old) != type(new):
+        return [{"op": "replace", "path": path, "value": new}]
+
+    if isinstance(old, dict):
+        ops = []
+        for k in old.keys() - new.keys():
+            ops.append({"op": "remove", "path": f"{path}/{_escape_pointer(str(k))}"})
+        for k, v in new.items():
+            p = f"{path}/{_escape_pointer(str(k))}"
+            if k not in old:
+                ops.append({"op": "add", "path": p, "value": v})
+            else:
+                ops.extend(make_json_patch(old[k], v, p))
+        return ops
+
+    if isinstance(old, list):
+        ops = []
+        common = min(len(old), len(new))
+        for i in range(common):
+            ops.extend(make_json_patch(old[i], new[i], f"{path}/{i}"))
+        # Remove from the end, so that indexes stay valid
+        for i in range(len(old) - 1, common - 1, -1):
+            ops.append({"op": "remove", "path": f"{path}/{i}"})
+        for i in range(common, len(new)):
+            ops.append({"op": "add", "path": f"{path}/{i}", "value": new[i]})
+        return ops
+
+    if old != new:
+        return [{"op": "replace", "path": path, "value": new}]
+    return []
+
+
+class Snapshot:
+    """Cached document of some state.
+
+    Args:
+        build_fn: builds the (JSON-serializable) document
+        version_fn: cheap function returning a value that changes whenever the
+            state changes
+    """
+
+    def __init__(
+        self, build_fn: Callable[[], Any], version_fn: Callable[[], Hashable]
+    ) -> None:
+        self._build_fn = build_fn
+        self._version_fn = version_fn
+        self._etag_prefix = f"{int(time.time() * 1000):x}"
+        self._lock = threading.Lock()
+        self._version: Optional[Hashable] = None
+        self._state: Optional[SnapshotState] = None
+        self._prev_state: Optional[SnapshotState] = None
+        self._patch: Optional[str] = None
+
+    def get(self) -> SnapshotState:
+        version = self._version_fn()
+        with self._lock:
+            if self._state is None or version != self._version:
+                document = self._build_fn()
+                seq = self._state.seq + 1 if self._state is not None else 1
+                self._prev_state = self._state
+                self._state = SnapshotState(
+                    seq=seq,
+                    document=document,
+                    json=json.dumps(document),
+                    etag=f'"{self._etag_prefix}-{seq}"',
+                )
+                self._version = version
+                self._patch = None
+            return self._state
+
+    def push_message(self, last_seq: Optional[int]) -> Tuple[int, Optional[str]]:
+        """Websocket message for a subscriber that has seen `last_seq`.
+
+        Returns the current seq and a message: a patch `{"seq", "base",
+        "patch"}` against the previous snapshot if possible, a full document
+        `{"seq", "document"}` otherwise, or `None` if the subscriber is up to
+        date.
+        """
+        self.get()
+        with self._lock:
+            state, prev = self._state, self._prev_state
+            assert state is not None
+            if last_seq == state.seq:
+                return state.seq, None
+
+            if prev is not None and last_seq == prev.seq:
+                if self._patch is None:
+                    # Computed once and shared by all subscribers
+                    self._patch = json.dumps(
+                        {
+                            "seq": state.seq,
+                            "base": prev.seq,
+                            "patch": make_json_patch(prev.document, state.document),
+                        }
+                    )
+                return state.seq, self._patch
+
+            return state.seq, f'{{"seq": {state.seq}, "document": {state.json}}}'
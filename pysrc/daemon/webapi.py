@@ -1,14 +1,30 @@
 import asyncio
 import json
 import os
-from typing import Any
-from quart import Quart, make_response, websocket
+import re
+import time
+from typing import Any, Optional
+from quart import Quart, make_response, request, websocket
 
+import pipeman.metrics as metrics
 import pipeman.utils as utils
 from pipeman.env import env
 from pipeman.config import default_config as conf
 
 import daemon.coordinator as coord
+import daemon.logtail as logtail
+from daemon.broadcast import BroadcastHub, Subscription, SubscriptionClosed
+from daemon.message import Message
+from daemon.snapshot import Snapshot
+
+# Push loops also re-check snapshot versions at this interval (in seconds), as
+# not every state change notifies them
+PUSH_POLL_INTERVAL = 1.0
+
+# Worker logs are read by windows of at most this many bytes
+LOG_WINDOW_SIZE = conf.getint("coordinator", "log_window_size")
+LOG_MAX_MATCHES = conf.getint("coordinator", "log_max_matches")
+LOG_FOLLOW_INTERVAL = conf.getfloat("coordinator", "log_follow_interval")
 
 
 class WebAPI:
@@ -17,6 +33,17 @@ class WebAPI:
     ) -> None:
         self._coordinator = coordinator
         self._loop = loop
+        self._pool_snapshot = Snapshot(
+            lambda: self._coordinator.scheduler.pool_info_dict,
+            lambda: self._coordinator.scheduler.pool_version,
+        )
+        self._pipelines_snapshot = Snapshot(
+            lambda: self._coordinator.task_monitor.pipelines_info_dict,
+            lambda: self._coordinator.task_monitor.version,
+        )
+        # Wakes up /logs_push clients, which then read from `utils.log_store`
+        self._log_updates = BroadcastHub()
+        utils.log_store.add_listener(self._log_updates.publish)
         self._init_server()
 
     def _init_server(self):
@@ -31,41 +58,63 @@ class WebAPI:
         async def sysconf():
             return await self.make_response(str(conf))
 
+        @app.route("/metrics")
+        async def metrics_text():
+            res = await make_response(metrics.render())
+            res.content_type = "text/plain; version=0.0.4; charset=utf-8"
+            return res
+
         @app.route("/pool")
         async def pool():
-            return await self.make_response(self._coordinator.scheduler.pool_info_dict)
+            return await self.make_snapshot_response(self._pool_snapshot)
 
         @app.websocket("/pool_push")
         async def pool_push():
-            async def sending():
-                while True:
-                    await self._coordinator.scheduler._is_pool_updated.get()
-                    await websocket.send(
-                        json.dumps(self._coordinator.scheduler.pool_info_dict)
-                    )
-
-            producer = asyncio.create_task(sending())
-            consumer = asyncio.create_task(receiving())
-            await asyncio.gather(producer, consumer)
+            """Sends the full pool first, then JSON patches. See `Snapshot`"""
+            async with self._coordinator.scheduler.pool_updates.subscribe() as sub:
+                await push_snapshot(self._pool_snapshot, sub)
 
         @app.route("/pipelines")
         async def pipelines():
+            """Paginated with `?cursor=<next_cursor of last page>&limit=<n>`"""
+            cursor = request.args.get("cursor", type=int)
+            limit = request.args.get("limit", type=int)
+            if cursor is None and limit is None:
+                return await self.make_snapshot_response(self._pipelines_snapshot)
             return await self.make_response(
-                self._coordinator.task_monitor.pipelines_info_dict
+                self._coordinator.task_monitor.get_pipelines_info_dict(
+                    cursor=cursor, limit=limit
+                )
             )
 
         @app.websocket("/pipelines_push")
         async def pipelines_push():
+            """Sends the first page first, then JSON patches. See `Snapshot`"""
+            task_monitor = self._coordinator.task_monitor
+            async with task_monitor.subscribe("pipeline_update") as sub:
+                await push_snapshot(self._pipelines_snapshot, sub)
+
+        async def push_snapshot(snapshot: Snapshot, sub: Subscription):
             async def sending():
+                last_seq: Optional[int] = None
                 while True:
-                    await self._coordinator.task_monitor.wait("pipeline_update")
-                    await websocket.send(
-                        json.dumps(self._coordinator.task_monitor.pipelines_info_dict)
-                    )
+                    seq, msg = snapshot.push_message(last_seq)
+                    if msg is not None:
+                        await websocket.send(msg)
+                        last_seq = seq
+                    try:
+                        await asyncio.wait_for(sub.get(), PUSH_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
 
             producer = asyncio.create_task(sending())
             consumer = asyncio.create_task(receiving())
-            await asyncio.gather(producer, consumer)
+            try:
+                await asyncio.gather(producer, consumer)
+            except SubscriptionClosed:
+                # Too slow to keep up. The client reconnects for a full document
+                consumer.cancel()
+                await websocket.close(1013)
 
         @app.route("/pipeline/<pipeline_hash>")
         async def pipeline_info(pipeline_hash):
@@ -75,18 +124,43 @@ class WebAPI:
 
         @app.route("/logs")
         async def logs():
-            return await self.make_response(utils.log_store, islist=True)
+            res = await self.make_response(utils.log_store.snapshot(), islist=True)
+            res.headers["Access-Control-Expose-Headers"] += ", X-Dropped-Count"
+            res.headers["X-Dropped-Count"] = f"{utils.log_store.num_dropped}"
+            return res
 
         @app.websocket("/logs_push")
         async def logs_push():
-            async def sending():
-                while True:
-                    l = await utils.log_queue.get()
-                    await websocket.send(json.dumps(l))
+            """Sends new log records. If the client falls so far behind that
+            records get overwritten, sends a warning record instead of them
+            """
+            async with self._log_updates.subscribe() as sub:
+                seq = utils.log_store.next_seq
 
-            producer = asyncio.create_task(sending())
-            consumer = asyncio.create_task(receiving())
-            await asyncio.gather(producer, consumer)
+                async def sending():
+                    nonlocal seq
+                    while True:
+                        records, missed, seq = utils.log_store.since(seq)
+                        if missed > 0:
+                            current_time = time.time()
+                            await websocket.send(
+                                json.dumps(
+                                    {
+                                        "id": current_time,
+                                        "time": int(current_time * 1000),
+                                        "level": "WARNING",
+                                        "module": type(self).__name__,
+                                        "msg": f"{missed} log records dropped",
+                                    }
+                                )
+                            )
+                        for r in records:
+                            await websocket.send(json.dumps(r))
+                        await sub.get()
+
+                producer = asyncio.create_task(sending())
+                consumer = asyncio.create_task(receiving())
+                await asyncio.gather(producer, consumer)
 
         async def receiving():
             while True:
@@ -98,12 +172,111 @@ class WebAPI:
                 self._coordinator.get_worker_info(worker_id)
             )
 
+        def worker_log_path(worker_id: str) -> Optional[str]:
+            if os.path.basename(worker_id) != worker_id:
+                return None
+            return os.path.join(env.temp_path, f"{worker_id}.log")
+
         @app.route("/worker_log/<worker_id>")
         async def worker_log(worker_id):
-            log_file = os.path.join(env.temp_path, f"{worker_id}.log")
-            with open(log_file) as f:
-                log = f.read()
-            return await self.make_response({"id": worker_id, "log": log})
+            """A window of the log. Query args:
+
+            - `offset`: in bytes. Negative counts from the end. Defaults to the
+                last window
+            - `length`: bytes to read or scan, at most `log_window_size`
+            - `grep`: return lines matching this regex instead (`icase=1` to
+                ignore case), at most `max_matches` (at most `log_max_matches`)
+
+            Continue from `next_offset` of the response for the next window.
+            """
+            log_file = worker_log_path(worker_id)
+            offset = request.args.get("offset", type=int)
+            length = max(
+                1,
+                min(
+                    request.args.get("length", LOG_WINDOW_SIZE, type=int),
+                    LOG_WINDOW_SIZE,
+                ),
+            )
+            pattern = request.args.get("grep")
+            max_matches = max(
+                min(
+                    request.args.get("max_matches", LOG_MAX_MATCHES, type=int),
+                    LOG_MAX_MATCHES,
+                ),
+                1,
+            )
+
+            try:
+                if log_file is None:
+                    raise FileNotFoundError(worker_id)
+
+                if pattern is not None:
+                    result = logtail.grep(
+                        log_file,
+                        logtail.compile_pattern(
+                            pattern, request.args.get("icase", 0, type=int) == 1
+                        ),
+                        offset,
+                        length,
+                        max_matches,
+                    )
+                    return await self.make_response(
+                        {
+                            "id": worker_id,
+                            "offset": result.offset,
+                            "next_offset": result.next_offset,
+                            "size": result.size,
+                            "matches": [m._asdict() for m in result.matches],
+                        }
+                    )
+
+                window = logtail.read_window(log_file, offset, length)
+            except FileNotFoundError:
+                return {"status": "err", "msg": f"No log of worker {worker_id}"}, 404
+            except re.error as e:
+                return {"status": "err", "msg": f"Invalid pattern: {e}"}, 400
+
+            return await self.make_response(
+                {
+                    "id": worker_id,
+                    "offset": window.offset,
+                    "next_offset": window.next_offset,
+                    "size": window.size,
+                    "log": window.data,
+                }
+            )
+
+        @app.websocket("/worker_log_push/<worker_id>")
+        async def worker_log_push(worker_id):
+            """Streams bytes appended to the log from `?offset=` (default: the
+            end) as `{"offset", "next_offset", "size", "log"}`
+            """
+            log_file = worker_log_path(worker_id)
+            offset = websocket.args.get("offset", type=int)
+
+            async def sending():
+                async for window in logtail.follow(
+                    log_file, offset, LOG_FOLLOW_INTERVAL
+                ):
+                    await websocket.send(
+                        json.dumps(
+                            {
+                                "offset": window.offset,
+                                "next_offset": window.next_offset,
+                                "size": window.size,
+                                "log": window.data,
+                            }
+                        )
+                    )
+
+            if log_file is None or not os.path.exists(log_file):
+                await websocket.close(1008)
+                return
+
+            producer = asyncio.create_task(sending())
+            consumer = asyncio.create_task(receiving())
+            await asyncio.gather(producer, consumer)
 
         @app.route("/start_exp/<exp_name>")
         async def start_exp(exp_name):
@@ -116,6 +289,20 @@ class WebAPI:
 
         self._app = app
 
+    async def make_snapshot_response(self, snapshot: Snapshot):
+        """Respond with the cached JSON of a snapshot. Supports If-None-Match"""
+        state = snapshot.get()
+        if request.if_none_match.contains_weak(state.etag.strip('"')):
+            res = await make_response("", 304)
+        else:
+            res = await make_response(state.json)
+            res.content_type = "application/json"
+
+        res.headers["ETag"] = state.etag
+        res.headers["Access-Control-Allow-Origin"] = "*"
+        res.headers["Access-Control-Expose-Headers"] = "ETag"
+        return res
+
     async def make_response(self, content: Any, islist=False):
         if islist:
             res = await make_response(json.dumps(list(reversed(content))))
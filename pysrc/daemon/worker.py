@@ -1,21 +1,166 @@
 import gc
+import hashlib
 import importlib.util
+import itertools
+import json
 import os
 import time
 import sys
-from typing import List
-
-from profiler import mem_profiler
+from collections import OrderedDict
+from types import ModuleType
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from pipeman.config import default_config as conf
+from package import ImportTracker, get_packages_of_modules
+from daemon.hygiene import Hygiene
+from profiler import ResourceMeter, mem_profiler
+
+
+IS_IMPORT_TRACKING_ENABLED = conf.getboolean("manifest", "track_imports")
+MODULE_CACHE_SIZE = conf.getint("worker", "module_cache_size")
+IS_HYGIENE_ENABLED = conf.getboolean("worker", "hygiene")
+
+_last_imported_modules: Set[str] = set()
+_last_resource_usage: Dict[str, Optional[float]] = {}
+
+
+def get_last_imported_packages() -> Dict[str, str]:
+    """Packages imported by the last component run through `execute_component`.
+    Empty if import tracking is disabled.
+    """
+    return get_packages_of_modules(_last_imported_modules)
+
+
+def get_last_resource_usage() -> str:
+    """Resources used by the last component run through `execute_component`,
+    as JSON. See `profiler.ResourceMeter`. `import_seconds` is the time spent
+    loading the module (0 if it was cached). With hygiene, also has
+    `rss_bytes` and `evicted_modules` after the cleanup, and `recycle`, true if
+    the worker should be replaced (see `daemon.hygiene`).
+    """
+    return json.dumps(_last_resource_usage)
+
+
+class _CachedModule(NamedTuple):
+    module: ModuleType
+    directory: str
+    helpers: Dict[str, ModuleType]
+    """Modules loaded from `directory` by the component (e.g., its utils)"""
+    load_modules: Set[str]
+    """Top-level modules imported when the module was executed"""
+
+
+class ModuleCache:
+    """Executed component modules of this worker, keyed by script path and
+    content hash.
+
+    A warm run of the same component version only calls `start()`: the source
+    is not compiled and its top-level imports are not executed again. Helper
+    modules of a component version stay in `sys.modules` while it runs, and
+    are swapped out when another version (i.e., another directory) runs, so
+    that same-named helpers of different versions never mix.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self._capacity = capacity
+        self._entries: "OrderedDict[Tuple[str, bytes], _CachedModule]" = OrderedDict()
+        self._active_directory: Optional[str] = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def key(script_path: str, source: bytes) -> Tuple[str, bytes]:
+        return script_path, hashlib.sha256(source).digest()
+
+    def get(self, key: Tuple[str, bytes]) -> Optional[_CachedModule]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(
+        self,
+        key: Tuple[str, bytes],
+        directory: str,
+        module: ModuleType,
+        load_modules: Set[str],
+    ) -> None:
+        """Cache a module after a run, with the helpers loaded so far"""
+        if self._capacity <= 0:
+            return
+        helpers = {
+            name: m
+            for name, m in list(sys.modules.items())
+            if _is_under(getattr(m, "__file__", None), directory)
+        }
+        self._entries[key] = _CachedModule(module, directory, helpers, load_modules)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._capacity:
+            self._entries.popitem(last=False)
+
+    def referenced_packages(self) -> Set[str]:
+        """Top-level packages that cached modules, or their helpers, may refer
+        to: those imported when they were executed, and those of the modules,
+        classes and functions in their globals
+        """
+        result: Set[str] = set()
+        for entry in self._entries.values():
+            result.update(n.partition(".")[0] for n in entry.load_modules)
+            for m in itertools.chain([entry.module], entry.helpers.values()):
+                for value in vars(m).values():
+                    name = (
+                        value.__name__
+                        if isinstance(value, ModuleType)
+                        else getattr(value, "__module__", None)
+                    )
+                    if isinstance(name, str):
+                        result.add(name.partition(".")[0])
+        return result
+
+    def activate(self, directory: str, entry: Optional[_CachedModule]) -> None:
+        """Make `sys.modules` hold the helpers of the component in `directory`,
+        and only them
+        """
+        last = self._active_directory
+        if last is not None and last != directory:
+            for name, m in list(sys.modules.items()):
+                if _is_under(getattr(m, "__file__", None), last):
+                    del sys.modules[name]
+            # Or its helpers would shadow the ones of the next component
+            while last in sys.path:
+                sys.path.remove(last)
+        if entry is not None:
+            sys.modules.update(entry.helpers)
+        self._active_directory = directory
+
+
+def _is_under(path: Optional[str], directory: str) -> bool:
+    return path is not None and path.startswith(directory + os.sep)
+
+
+_module_cache = ModuleCache(MODULE_CACHE_SIZE)
+
+_hygiene = Hygiene(
+    [p.strip() for p in conf.get("worker", "hygiene_keep_packages").split(",")],
+    conf.getint("worker", "recycle_rss_mb") * 1024 * 1024,
+)
 
 
 def execute_component(
     component_id: str, working_directory: str, cmds: List[str]
 ) -> str:
+    global _last_imported_modules, _last_resource_usage
+
+    if IS_HYGIENE_ENABLED:
+        _hygiene.before_run()
+
     print(f"[Worker] Changing working directory to: {working_directory}")
     os.chdir(working_directory)
 
     # add working directory to sys.path
-    sys.path.append(working_directory)
+    if working_directory not in sys.path:
+        sys.path.append(working_directory)
     os.environ["PYTHONUNBUFFERED"] = "1"
 
     print(f"[Worker] Execute command: {cmds}")
@@ -39,18 +184,67 @@ def execute_component(
     # with open(script_path, "r") as f:
     #     print(f.read())
 
-    spec = importlib.util.spec_from_file_location("module.name", script_path)
-    module = importlib.util.module_from_spec(spec)  # type: ignore
-    spec.loader.exec_module(module)  # type: ignore
-
-    # run code. the entry point is `def start(inputfolder, outputfolder) -> None`
-
-    print(f"[Worker] TIME OF COMPONENT START: {time.time()}")
-    module.start(inputfolder, outputfolder)
+    meter = ResourceMeter()
+    meter.start()
+
+    with open(script_path, "rb") as f:
+        source = f.read()
+    cache_key = _module_cache.key(script_path, source)
+    cached = _module_cache.get(cache_key)
+    _module_cache.activate(working_directory, cached)
+
+    tracker = ImportTracker()
+    if IS_IMPORT_TRACKING_ENABLED:
+        tracker.install()
+
+    try:
+        import_start = time.perf_counter()
+        if cached is not None:
+            print(f"[Worker] Reuse loaded module of {script_path}")
+            module = cached.module
+            load_modules = cached.load_modules
+        else:
+            spec = importlib.util.spec_from_file_location("module.name", script_path)
+            module = importlib.util.module_from_spec(spec)  # type: ignore
+            # Compile the bytes just hashed, rather than reading the file again
+            exec(compile(source, script_path, "exec"), module.__dict__)
+            load_modules = set(tracker.modules)
+        import_seconds = time.perf_counter() - import_start
+
+        # run code. the entry point is `def start(inputfolder, outputfolder) -> None`
+
+        print(f"[Worker] TIME OF COMPONENT START: {time.time()}")
+        module.start(inputfolder, outputfolder)
+
+        _module_cache.put(cache_key, working_directory, module, load_modules)
+    finally:
+        tracker.uninstall()
+
+    # Imports at the top level of a cached module are not executed again
+    _last_imported_modules = load_modules | tracker.modules
+    _last_resource_usage = {**meter.stop(), "import_seconds": import_seconds}
 
     del module
 
-    gc.collect()
+    if IS_HYGIENE_ENABLED:
+        # Helpers of the component stay if the module cache holds them, and so
+        # do the packages that cached modules refer to
+        report = _hygiene.after_run(
+            lambda m: MODULE_CACHE_SIZE > 0
+            and _is_under(getattr(m, "__file__", None), working_directory),
+            _module_cache.referenced_packages(),
+        )
+        print(
+            f"[Worker] Evicted {report.evicted_modules} modules. "
+            f"RSS: {report.rss_bytes}"
+        )
+        _last_resource_usage.update(
+            rss_bytes=report.rss_bytes,
+            evicted_modules=report.evicted_modules,
+            recycle=report.recycle,
+        )
+    else:
+        gc.collect()
 
     print(f"[WM] Component {component_id} done")
 
@@ -0,0 +1,321 @@
+"""Fork server for workers (zygote mode).
+
+A zygote is a worker process (`seccask --worker --zygote-port=<port>`) that
+imports a profile of packages once, and then forks a child per new worker
+requested by the scheduler. Children inherit the warm interpreter through
+copy-on-write pages, so a new worker skips interpreter startup and the imports
+of the profile. The profile is learned by the scheduler from the manifests of
+the components it has seen (see `PackageProfile`).
+
+Protocol: one JSON line per TCP connection, each way.
+
+- Request: `{"token": <token>, "id": <worker ID>, "log": <path of the worker
+    output>}`
+- Response: `{"pid": <child PID>, "packages": [...], "preload_seconds": <x>}`,
+    where `preload_seconds` is the import time the child saved
+
+The zygote only listens on the loopback. The scheduler reaches it through its
+SSH connection to the worker host. Other users of the host can reach the
+loopback too, so requests must carry the token that the scheduler wrote to the
+standard input of the zygote when starting it (not on its command line, which
+every local user can read). Worker IDs are restricted to letters, digits and
+`-`, and logs to `<log_dir>/<worker ID>.log`.
+
+Under SGX, forking is not copy-on-write: Gramine creates a new enclave for the
+child and copies a checkpoint of the memory of the zygote into it. Freezing
+the GC then saves nothing, and the cost of a fork grows with the preloaded
+packages. `_bench` only measures the path without SGX. Measure a zygote under
+SGX (e.g., with `seccask_worker_spawn_seconds{mode}`) before enabling it
+there.
+"""
+import collections
+import gc
+import hmac
+import importlib
+import json
+import os
+import re
+import signal
+import socket
+import sys
+import time
+from typing import Iterable, List, Optional, Tuple
+
+_WORKER_ID = re.compile(r"[A-Za-z0-9-]{1,64}")
+
+
+def preload(packages: Iterable[str]) -> Tuple[List[str], float]:
+    """Import the top-level modules of `packages`, skipping those that fail.
+
+    Profiles hold distribution names (e.g., `scikit-learn`), which are mapped to
+    the modules they provide (`sklearn`). Names of no installed distribution
+    (or one without `top_level.txt`) are imported as modules.
+
+    Returns:
+        The packages with at least one module imported, and the time spent
+    """
+    from package import cached_package_module_map
+
+    start = time.perf_counter()
+    modules_of = cached_package_module_map()
+    loaded = []
+    for name in packages:
+        imported = False
+        for module in modules_of.get(name, [name]):
+            try:
+                importlib.import_module(module)
+                imported = True
+            except Exception as e:
+                print(f"[Zygote] Cannot preload {module} of {name}: {e!r}")
+        if imported:
+            loaded.append(name)
+    return loaded, time.perf_counter() - start
+
+
+def _redirect_output(log_path: str) -> None:
+    sys.stdout.flush()
+    sys.stderr.flush()
+    # Not through a link planted by someone else
+    fd = os.open(
+        log_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o644
+    )
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+
+
+def _parse_request(line: str, token: str, log_dir: str) -> Tuple[str, str]:
+    """
+    Returns:
+        The worker ID and the log path
+
+    Raises:
+        ValueError: if the request is invalid or not authenticated
+    """
+    request = json.loads(line)
+    if not isinstance(request, dict):
+        raise ValueError("Request is not an object")
+    if not hmac.compare_digest(str(request.get("token", "")), token):
+        raise ValueError("Invalid token")
+
+    worker_id, log_path = request.get("id"), request.get("log")
+    if not isinstance(worker_id, str) or not _WORKER_ID.fullmatch(worker_id):
+        raise ValueError(f"Invalid worker ID {worker_id!r}")
+    expected_path = os.path.join(os.path.realpath(log_dir), f"{worker_id}.log")
+    if not isinstance(log_path, str) or os.path.realpath(log_path) != expected_path:
+        raise ValueError(f"Log path {log_path!r} is not {expected_path}")
+    return worker_id, log_path
+
+
+def serve(
+    port: int,
+    packages: Iterable[str],
+    token: Optional[str] = None,
+    log_dir: Optional[str] = None,
+) -> str:
+    """Preload `packages` and fork a worker per request on `127.0.0.1:port`.
+
+    Args:
+        token: required in requests. Read from the first line of the standard
+            input if not given
+        log_dir: directory of the logs of workers. `env.temp_path` by default
+
+    Only returns in forked children, with the ID the child should run as.
+    """
+    if token is None:
+        token = sys.stdin.readline().strip()
+    if not token:
+        raise ValueError("No token for the zygote")
+    if log_dir is None:
+        from pipeman.env import env
+
+        log_dir = env.temp_path
+
+    loaded, preload_seconds = preload(packages)
+    print(f"[Zygote] Preloaded {loaded} in {preload_seconds:.3f}s")
+
+    # Objects allocated so far are never collected, so that the collector does
+    # not touch (and copy) the pages shared with children
+    gc.freeze()
+
+    server = socket.create_server(("127.0.0.1", port))
+    # Children are not waited for
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    print(f"[Zygote] Listening on 127.0.0.1:{port}")
+
+    while True:
+        conn, _ = server.accept()
+        with conn:
+            try:
+                with conn.makefile("r") as f:
+                    worker_id, log_path = _parse_request(f.readline(), token, log_dir)
+            except (ValueError, TypeError, OSError) as e:
+                print(f"[Zygote] Invalid request: {e!r}")
+                continue
+
+            pid = os.fork()
+            if pid == 0:
+                server.close()
+                conn.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                os.setsid()
+                _redirect_output(log_path)
+                print(f"[Zygote] Forked as worker {worker_id}")
+                return worker_id
+
+            print(f"[Zygote] Forked worker {worker_id} as PID {pid}")
+            response = {
+                "pid": pid,
+                "packages": loaded,
+                "preload_seconds": preload_seconds,
+            }
+            try:
+                conn.sendall(json.dumps(response).encode() + b"\n")
+            except OSError as e:
+                # The child runs anyway
+                print(f"[Zygote] Cannot reply to the request of {worker_id}: {e!r}")
+
+
+def request_spawn(conn, token: str, worker_id: str, log_path: str) -> dict:
+    """Ask a zygote for a new worker.
+
+    Args:
+        conn: a connection to the zygote, i.e., a socket or a paramiko channel
+
+    Raises:
+        ValueError: if the zygote does not respond properly
+    """
+    request = {"token": token, "id": worker_id, "log": log_path}
+    conn.sendall(json.dumps(request).encode() + b"\n")
+    with conn.makefile("r") as f:
+        line = f.readline()
+    if not line:
+        raise ValueError("Zygote closed the connection")
+    return json.loads(line)
+
+
+class PackageProfile:
+    """Counts of packages among the manifests seen by the scheduler.
+
+    The most common ones make the profile of the zygote. Counts are saved to
+    `path` at most every `save_interval` seconds while observing, and by
+    `save` (e.g., at shutdown), so that the next zygote starts with them.
+    """
+
+    def __init__(self, path: str, size: int, save_interval: float = 60) -> None:
+        self._path = path
+        self._size = size
+        self._save_interval = save_interval
+        self._counts: "collections.Counter[str]" = collections.Counter()
+        self._profile: List[str] = []
+        self._is_dirty = False
+        self._saved_at = time.monotonic()
+        try:
+            with open(path) as f:
+                self._counts.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        self._profile = self._top()
+
+    @property
+    def packages(self) -> List[str]:
+        return self._profile
+
+    def _top(self) -> List[str]:
+        return [p for p, _ in self._counts.most_common(self._size)]
+
+    def observe(self, packages: Iterable[str]) -> None:
+        self._counts.update(set(packages))
+        self._is_dirty = True
+        if time.monotonic() - self._saved_at >= self._save_interval:
+            self.save()
+
+    def save(self) -> None:
+        """Write the counts, if changed, and update `packages`"""
+        if not self._is_dirty:
+            return
+        self._profile = self._top()
+        with open(self._path, "w") as f:
+            json.dump(self._counts, f)
+        self._is_dirty = False
+        self._saved_at = time.monotonic()
+
+
+def _is_ready(log_path: str) -> bool:
+    try:
+        with open(log_path) as f:
+            return "ready" in f.read()
+    except FileNotFoundError:
+        return False
+
+
+def _bench(packages: List[str], rounds: int) -> None:
+    """Start latency of cold workers (a new interpreter importing `packages`)
+    against forked ones. Runs without SGX (see the module documentation) or
+    the C++ worker.
+    """
+    import secrets
+    import subprocess
+    import tempfile
+
+    imports = "; ".join(f"import {p}" for p in packages) or "pass"
+    cold = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", f"{imports}; print('ready')"], check=True
+        )
+        cold.append(time.perf_counter() - start)
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    token = secrets.token_hex(16)
+    warm = []
+    with tempfile.TemporaryDirectory() as temp:
+        zygote = subprocess.Popen(
+            [sys.executable, "-m", "daemon.zygote", "--serve", str(port), temp]
+            + packages,
+            stdin=subprocess.PIPE,
+            text=True,
+        )
+        zygote.stdin.write(f"{token}\n")  # type: ignore
+        zygote.stdin.flush()  # type: ignore
+        try:
+            for i in range(rounds):
+                log_path = os.path.join(temp, f"{i}.log")
+                start = time.perf_counter()
+                while True:
+                    try:
+                        conn = socket.create_connection(("127.0.0.1", port))
+                        break
+                    except ConnectionRefusedError:
+                        time.sleep(0.01)
+                        start = time.perf_counter()
+                with conn:
+                    response = request_spawn(conn, token, str(i), log_path)
+                while not _is_ready(log_path):
+                    time.sleep(0.0005)
+                warm.append(time.perf_counter() - start)
+        finally:
+            zygote.terminate()
+
+    cold_ms, warm_ms = 1000 * min(cold), 1000 * min(warm)
+    print(f"Profile: {packages} (without SGX)")
+    print(f"Cold start:   {cold_ms:8.1f} ms (best of {rounds})")
+    print(f"Zygote start: {warm_ms:8.1f} ms (best of {rounds})")
+    print(f"Saved:        {cold_ms - warm_ms:8.1f} ms per worker")
+    print(f"Zygote preload: {1000 * response['preload_seconds']:.1f} ms")
+
+
+if __name__ == "__main__":
+    """
+    python -m daemon.zygote [numpy sklearn ...]
+    """
+    if len(sys.argv) > 3 and sys.argv[1] == "--serve":
+        # A stand-in for the C++ worker: report ready, then exit
+        worker_id = serve(int(sys.argv[2]), sys.argv[4:], log_dir=sys.argv[3])
+        print(f"ready {worker_id}", flush=True)
+        os._exit(0)
+
+    _bench(sys.argv[1:], rounds=5)
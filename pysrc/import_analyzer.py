@@ -0,0 +1,220 @@
+"""Static Import Analyzer.
+
+Derive the packages a component depends on by parsing its train script (and
+the local modules it imports) instead of executing it.
+"""
+import ast
+import importlib.util
+import itertools
+import os
+import sys
+import sysconfig
+from typing import Dict, List, Optional, Set, Tuple
+
+import package
+
+
+__all__ = ["UnresolvedImport", "analyze_script", "get_script_packages"]
+
+IMPORT_ERRORS = {"ImportError", "ModuleNotFoundError"}
+GUARD_EXCEPTIONS = IMPORT_ERRORS | {"Exception"}
+"""Handlers of these make the imports in their `try` optional"""
+DYNAMIC_IMPORT_FUNCS = {"import_module", "__import__"}
+
+
+class UnresolvedImport(Exception):
+    """Raised when an import cannot be resolved without running the script."""
+
+    pass
+
+
+class _ImportVisitor(ast.NodeVisitor):
+    """Collect imports of one module.
+
+    Each found import is a tuple (module, level, names, optional), where
+    `optional` marks imports guarded by `try ... except ImportError`.
+    """
+
+    def __init__(self) -> None:
+        self.imports: List[Tuple[str, int, List[str], bool]] = []
+        self.is_dynamic = False
+        self._optional_depth = 0
+
+    def visit_Import(self, node: ast.Import):
+        for alias in node.names:
+            self.imports.append((alias.name, 0, [], self._optional_depth > 0))
+
+    def visit_ImportFrom(self, node: ast.ImportFrom):
+        self.imports.append(
+            (
+                node.module or "",
+                node.level,
+                [alias.name for alias in node.names],
+                self._optional_depth > 0,
+            )
+        )
+
+    def visit_Try(self, node: ast.Try):
+        is_guarded = any(self._catches_import_error(h) for h in node.handlers)
+        if is_guarded:
+            self._optional_depth += 1
+        for stmt in node.body:
+            self.visit(stmt)
+        if is_guarded:
+            self._optional_depth -= 1
+        for stmt in itertools.chain(node.handlers, node.orelse, node.finalbody):
+            self.visit(stmt)
+
+    def visit_Call(self, node: ast.Call):
+        func = node.func
+        name = (
+            func.attr
+            if isinstance(func, ast.Attribute)
+            else func.id
+            if isinstance(func, ast.Name)
+            else None
+        )
+        if name in DYNAMIC_IMPORT_FUNCS:
+            if (
+                len(node.args) > 0
+                and isinstance(node.args[0], ast.Constant)
+                and isinstance(node.args[0].value, str)
+            ):
+                self.imports.append(
+                    (node.args[0].value, 0, [], self._optional_depth > 0)
+                )
+            else:
+                self.is_dynamic = True
+        self.generic_visit(node)
+
+    @staticmethod
+    def _catches_import_error(handler: ast.ExceptHandler) -> bool:
+        if handler.type is None:
+            return True
+        types = (
+            handler.type.elts
+            if isinstance(handler.type, ast.Tuple)
+            else [handler.type]
+        )
+        return any(isinstance(t, ast.Name) and t.id in GUARD_EXCEPTIONS for t in types)
+
+
+def _is_stdlib_module(name: str) -> bool:
+    if name in sys.builtin_module_names:
+        return True
+    try:
+        spec = importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+        return False
+    if spec is None or spec.origin is None:
+        return False
+    if spec.origin in ("built-in", "frozen"):
+        return True
+    stdlib_path = sysconfig.get_paths()["stdlib"]
+    return spec.origin.startswith(stdlib_path) and "site-packages" not in spec.origin
+
+
+def _find_local_module(base_dir: str, module: str) -> Optional[str]:
+    """Return the file path of a local module (relative to `base_dir`), if any.
+    For a package, its `__init__.py` is returned.
+    """
+    path = os.path.join(base_dir, *module.split("."))
+    if os.path.isfile(f"{path}.py"):
+        return f"{path}.py"
+    init_path = os.path.join(path, "__init__.py")
+    if os.path.isfile(init_path):
+        return init_path
+    return None
+
+
+def analyze_script(script_path: str, base_dir: Optional[str] = None) -> Set[str]:
+    """Collect top-level names of all non-local modules imported by a script,
+    following imports of local modules under `base_dir` (the script directory
+    by default).
+
+    Raises:
+        UnresolvedImport: if the script (or one of its local modules) imports
+            modules dynamically, or a required import can neither be found
+            locally nor in the current environment
+    """
+    base_dir = os.path.abspath(base_dir or os.path.dirname(script_path))
+    mpmap = package.cached_module_package_map()
+
+    result: Set[str] = set()
+    visited: Set[str] = set()
+    pending = [os.path.abspath(script_path)]
+
+    while pending:
+        file_path = pending.pop()
+        if file_path in visited:
+            continue
+        visited.add(file_path)
+
+        with open(file_path, "r") as f:
+            tree = ast.parse(f.read(), filename=file_path)
+
+        visitor = _ImportVisitor()
+        visitor.visit(tree)
+        if visitor.is_dynamic:
+            raise UnresolvedImport(f"Dynamic import in {file_path}")
+
+        file_dir = os.path.dirname(file_path)
+        for module, level, names, optional in visitor.imports:
+            if level > 0:
+                # Relative import: always local
+                pkg_dir = file_dir
+                for _ in range(level - 1):
+                    pkg_dir = os.path.dirname(pkg_dir)
+                candidates = [module] if module else []
+                candidates.extend(f"{module}.{n}" if module else n for n in names)
+                for c in candidates:
+                    local = _find_local_module(pkg_dir, c)
+                    if local is not None:
+                        pending.append(local)
+                continue
+
+            top_level = module.partition(".")[0]
+            local = _find_local_module(base_dir, top_level)
+            if local is not None:
+                pending.append(local)
+                for c in [module] + [f"{module}.{n}" for n in names]:
+                    sub = _find_local_module(base_dir, c)
+                    if sub is not None:
+                        pending.append(sub)
+                continue
+
+            if top_level in mpmap:
+                result.add(top_level)
+            elif _is_stdlib_module(top_level):
+                continue
+            elif importlib.util.find_spec(top_level) is not None:
+                # Installed, but not owned by any known distribution
+                raise UnresolvedImport(
+                    f"Cannot map module {top_level} to a distribution"
+                )
+            elif not optional:
+                raise UnresolvedImport(f"Module {top_level} not found")
+
+    return result
+
+
+def get_script_packages(
+    script_path: str, base_dir: Optional[str] = None
+) -> Dict[str, str]:
+    """Resolve imports of a script to installed distributions and versions,
+    with the distributions they require, as recorded at runtime.
+
+    Raises:
+        UnresolvedImport: see `analyze_script`
+    """
+    return package.get_packages_of_modules(analyze_script(script_path, base_dir))
+
+
+if __name__ == "__main__":
+    from pprint import pprint
+
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} SCRIPT_PATH [BASE_DIR]")
+        sys.exit(1)
+
+    pprint(get_script_packages(*sys.argv[1:3]))
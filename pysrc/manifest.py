@@ -1,10 +1,13 @@
 """Component Manifest Manager.
 """
 import json
+import sys
+import weakref
 from enum import Enum
+from types import MappingProxyType
 import yaml
 import hashlib
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Iterable, Mapping, Optional, Tuple
 
 from pipeman.version import SemanticVersion
 import package
@@ -15,7 +18,129 @@ class ComponentType(Enum):
     LIBRARY = "library"
 
 
+def fingerprint_packages(packages: Dict[str, str]) -> str:
+    """SHA256 over the package table only (unlike `Manifest.packages_hash`, the
+    manifest name is not included). Used to check delta bases.
+    """
+    sha256 = hashlib.sha256()
+    sha256.update(json.dumps(packages, sort_keys=True).encode("utf-8"))
+    return sha256.hexdigest()
+
+
+class PackageSet:
+    """Immutable package table ({name: version}).
+
+    Instances are interned: building a `PackageSet` from the same packages
+    returns the same object, so manifests of workers sharing an environment
+    share one table, and equality is an identity check in the common case.
+    Package names and versions are interned strings.
+    """
+
+    __slots__ = ("_items", "_dict", "_hasher", "_fingerprint", "__weakref__")
+
+    _interned: "weakref.WeakValueDictionary[Tuple, PackageSet]" = (
+        weakref.WeakValueDictionary()
+    )
+
+    def __init__(self, items: Tuple[Tuple[str, str], ...]) -> None:
+        """Use `PackageSet.of` instead"""
+        self._items = items
+        self._dict: Dict[str, str] = dict(items)
+        self._hasher = None
+        self._fingerprint: Optional[str] = None
+
+    @classmethod
+    def of(cls, packages: Mapping[str, str]) -> "PackageSet":
+        if isinstance(packages, PackageSet):
+            return packages
+        items = tuple(
+            sorted(
+                (sys.intern(str(k)), sys.intern(str(v))) for k, v in packages.items()
+            )
+        )
+        obj = cls._interned.get(items)
+        if obj is None:
+            obj = cls(items)
+            cls._interned[items] = obj
+        return obj
+
+    @property
+    def mapping(self) -> Mapping[str, str]:
+        """Read-only view of the package table"""
+        return MappingProxyType(self._dict)
+
+    def to_dict(self) -> Dict[str, str]:
+        return dict(self._dict)
+
+    @property
+    def hasher(self):
+        """SHA256 object fed with the package table. Copy it before updating."""
+        if self._hasher is None:
+            self._hasher = hashlib.sha256()
+            self._hasher.update(
+                json.dumps(self._dict, sort_keys=True).encode("utf-8")
+            )
+        return self._hasher
+
+    @property
+    def fingerprint(self) -> str:
+        """Same value as `fingerprint_packages`, computed once"""
+        if self._fingerprint is None:
+            self._fingerprint = self.hasher.hexdigest()
+        return self._fingerprint
+
+    def apply_delta(
+        self,
+        added: Mapping[str, str],
+        removed: Iterable[str],
+        changed: Mapping[str, str],
+    ) -> "PackageSet":
+        packages = dict(self._dict)
+        packages.update(added)
+        packages.update(changed)
+        for p in removed:
+            packages.pop(p, None)
+        return PackageSet.of(packages)
+
+    def __eq__(self, other) -> bool:
+        if self is other:
+            return True
+        if not isinstance(other, PackageSet):
+            return NotImplemented
+        return self._items == other._items
+
+    def __hash__(self) -> int:
+        return hash(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return repr(self._dict)
+
+
 class Manifest:
+    """Component or worker manifest.
+
+    The package table is an interned `PackageSet` and cannot be modified in
+    place (use `packages` setter or `apply_delta`). `name` and `version` stay
+    settable since the scheduler relabels worker manifests with the last
+    executed component. Derived values (`packages_hash`, `info_dict`, `json()`)
+    are cached until one of the fields changes.
+    """
+
+    __slots__ = (
+        "_name",
+        "_type",
+        "_version",
+        "_packages_semver",
+        "_package_set",
+        "_appendix",
+        "_packages_hash",
+        "_info_dict",
+        "_json",
+    )
+
     DEFAULT_VALUES = {
         "name": "DUMMY",
         "type": ComponentType.DATASET,
@@ -25,36 +150,33 @@ class Manifest:
     }
 
     def __init__(self, obj: Optional[dict] = None) -> None:
-        if obj is not None:
-            self._name = obj["name"] if "name" in obj else self.DEFAULT_VALUES["name"]
-            self._type = (
-                ComponentType(obj["type"])
-                if "type" in obj
-                else self.DEFAULT_VALUES["type"]
-            )
-            self._version = (
-                SemanticVersion.from_version_str(obj["version"])
-                if "version" in obj
-                else self.DEFAULT_VALUES["version"]
-            )
-            self._packages_semver = (
-                obj["packages_semver"]
-                if "packages_semver" in obj
-                else self.DEFAULT_VALUES["packages_semver"]
-            )
-            self._packages = (
-                obj["packages"]
-                if "packages" in obj
-                else self.DEFAULT_VALUES["packages"]
-            )
-        else:
-            self._name = self.DEFAULT_VALUES["name"]
-            self._type = self.DEFAULT_VALUES["type"]
-            self._version = self.DEFAULT_VALUES["version"]
-            self._packages_semver = self.DEFAULT_VALUES["packages_semver"]
-            self._packages = self.DEFAULT_VALUES["packages"]
+        if obj is None:
+            obj = {}
+
+        self._name = obj["name"] if "name" in obj else self.DEFAULT_VALUES["name"]
+        self._type = (
+            ComponentType(obj["type"]) if "type" in obj else self.DEFAULT_VALUES["type"]
+        )
+        self._version = (
+            SemanticVersion.from_version_str(obj["version"])
+            if "version" in obj
+            else self.DEFAULT_VALUES["version"]
+        )
+        self._packages_semver = (
+            obj["packages_semver"]
+            if "packages_semver" in obj
+            else self.DEFAULT_VALUES["packages_semver"]
+        )
+        self._package_set = PackageSet.of(
+            obj["packages"] if "packages" in obj else self.DEFAULT_VALUES["packages"]
+        )
+        self._appendix: Any = None
+        self._invalidate()
 
-        self.appendix: Any = None
+    def _invalidate(self) -> None:
+        self._packages_hash: Optional[str] = None
+        self._info_dict: Optional[dict] = None
+        self._json: Optional[str] = None
 
     @property
     def name(self) -> str:
@@ -63,6 +185,7 @@ class Manifest:
     @name.setter
     def name(self, name: str):
         self._name = name
+        self._invalidate()
 
     @property
     def type(self) -> ComponentType:
@@ -71,6 +194,7 @@ class Manifest:
     @type.setter
     def type(self, type: ComponentType):
         self._type = type
+        self._invalidate()
 
     @property
     def version(self) -> SemanticVersion:
@@ -79,6 +203,7 @@ class Manifest:
     @version.setter
     def version(self, version: SemanticVersion):
         self._version = version
+        self._invalidate()
 
     @property
     def packages_semver(self) -> bool:
@@ -87,21 +212,63 @@ class Manifest:
     @packages_semver.setter
     def packages_semver(self, packages_semver: bool):
         self._packages_semver = packages_semver
+        self._invalidate()
+
+    @property
+    def appendix(self) -> Any:
+        return self._appendix
+
+    @appendix.setter
+    def appendix(self, appendix: Any):
+        self._appendix = appendix
+        self._invalidate()
+
+    @property
+    def packages(self) -> Mapping[str, str]:
+        return self._package_set.mapping
+
+    @packages.setter
+    def packages(self, packages: Mapping[str, str]):
+        self._package_set = PackageSet.of(packages)
+        self._invalidate()
 
     @property
-    def packages(self) -> Dict[str, str]:
-        return self._packages
+    def package_set(self) -> PackageSet:
+        return self._package_set
 
     def update_packages(self):
-        self._packages = package.get_active_packages()
+        self.packages = package.get_active_packages()
+
+    def apply_delta(
+        self,
+        added: Dict[str, str],
+        removed: Iterable[str],
+        changed: Dict[str, str],
+    ) -> None:
+        """Replace the package table with the one after applying a delta"""
+        self.packages = self._package_set.apply_delta(added, removed, changed)
 
     @property
     def packages_hash(self) -> str:
-        sha256 = hashlib.sha256()
-        sha256.update(json.dumps(self.packages, sort_keys=True).encode("utf-8"))
-        # ! To better test hash matching, add some noise here
-        sha256.update(self._name.encode("utf-8"))
-        return sha256.hexdigest()
+        if self._packages_hash is None:
+            sha256 = self._package_set.hasher.copy()
+            # ! To better test hash matching, add some noise here
+            sha256.update(self._name.encode("utf-8"))
+            self._packages_hash = sha256.hexdigest()
+        return self._packages_hash
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Manifest):
+            return NotImplemented
+        return (
+            self._package_set is other._package_set
+            and self._name == other._name
+            and self._type == other._type
+            and self._packages_semver == other._packages_semver
+            and self._version.version_str == other._version.version_str
+        )
+
+    __hash__ = None  # type: ignore
 
     def __iter__(self):
         yield ("name", self.name)
@@ -111,16 +278,25 @@ class Manifest:
         if self.type == ComponentType.LIBRARY:
             yield ("packages_semver", self.packages_semver)
             yield ("hash", self.packages_hash)
-            yield ("packages", self.packages)
+            yield ("packages", self._package_set.to_dict())
 
         if self.appendix:
             for k, v in self.appendix.items():
                 yield (k, v)
 
+    @property
+    def info_dict(self) -> dict:
+        """Cached `dict(self)`. Do not modify the returned dict."""
+        if self._info_dict is None:
+            self._info_dict = dict(self)
+        return self._info_dict
+
     def json(self, refresh=True) -> str:
         if refresh:
             self.capture_current_env()
-        return json.dumps(dict(self), sort_keys=True)
+        if self._json is None:
+            self._json = json.dumps(self.info_dict, sort_keys=True)
+        return self._json
 
     def __repr__(self):
         if self.type == ComponentType.DATASET:
@@ -136,7 +312,7 @@ class Manifest:
                     self.version.version_str,
                     self.packages_semver,
                     self.packages_hash,
-                    self.packages,
+                    self._package_set,
                 )
             )
 
@@ -151,20 +327,105 @@ class Manifest:
             yaml.safe_dump(dict(self), f)
 
     @staticmethod
-    def capture_current_env(appendix: Any = None):
+    def capture_current_env(
+        appendix: Any = None, packages: Optional[Dict[str, str]] = None
+    ):
         """Call this function in a component enclave to fetch all manifest information.
         This does not set name and version.
+
+        If `packages` is given (e.g., packages recorded by `ImportTracker` during
+        a component run), it is used instead of all packages loaded in the
+        current interpreter.
         """
         manifest = Manifest()
         manifest.type = ComponentType.LIBRARY
         manifest.packages_semver = False
-        manifest.update_packages()
+        if packages is None:
+            manifest.update_packages()
+        else:
+            manifest.packages = packages
 
         manifest.appendix = appendix
 
         return manifest
 
 
+class ManifestDeltaPublisher:
+    """Worker-side state for the delta manifest protocol.
+
+    Each call to `capture` compares the current environment with the last
+    reported one and returns a JSON delta:
+    ```
+    {
+        "seq": 3,                 # increases by one per delta
+        "full": false,            # true: `added` holds the whole package table
+        "base": "<fingerprint>",  # fingerprint the delta applies to
+        "fingerprint": "<fingerprint after applying the delta>",
+        "added": {"pkg": "ver"},
+        "removed": ["pkg"],
+        "changed": {"pkg": "ver"},
+        ...                       # appendix
+    }
+    ```
+    """
+
+    def __init__(self) -> None:
+        self._seq = -1
+        self._packages: Optional[Dict[str, str]] = None
+        self._fingerprint: Optional[str] = None
+
+    def reset(self) -> None:
+        """Forget the last reported state. The next delta will be a full one."""
+        self._packages = None
+        self._fingerprint = None
+
+    def capture(self, appendix: Optional[dict] = None, full: bool = False) -> str:
+        if full:
+            self.reset()
+
+        packages = package.get_active_packages()
+        fingerprint = fingerprint_packages(packages)
+        self._seq += 1
+
+        if self._packages is None:
+            added, removed, changed = packages, [], {}
+        else:
+            added = {p: v for p, v in packages.items() if p not in self._packages}
+            removed = [p for p in self._packages if p not in packages]
+            changed = {
+                p: v
+                for p, v in packages.items()
+                if p in self._packages and self._packages[p] != v
+            }
+
+        delta = {
+            "seq": self._seq,
+            "full": self._packages is None,
+            "base": self._fingerprint,
+            "fingerprint": fingerprint,
+            "added": added,
+            "removed": removed,
+            "changed": changed,
+        }
+        if appendix:
+            delta.update(appendix)
+
+        self._packages = packages
+        self._fingerprint = fingerprint
+        return json.dumps(delta, sort_keys=True)
+
+
+_delta_publisher = ManifestDeltaPublisher()
+
+
+def capture_manifest_delta(worker_id: str, full: bool = False) -> str:
+    """Call this function in a worker enclave to get the manifest delta since
+    the last call. Set `full` to report the whole package table (e.g., when the
+    coordinator requests a resync).
+    """
+    return _delta_publisher.capture(appendix={"worker_id": worker_id}, full=full)
+
+
 if __name__ == "__main__":
     from pprint import pprint
 
@@ -1,7 +1,11 @@
+import builtins
+import functools
+import importlib.abc
 import pkg_resources
 import os
 import sys
 import pprint
+from typing import Dict, List, Set, Tuple
 
 
 def list_packages():
@@ -35,21 +39,159 @@ def get_module_package_map():
     return mpmap
 
 
+@functools.lru_cache(maxsize=None)
+def _requirements_of(package: str) -> Tuple[str, ...]:
+    """Keys (lowercase names) of the distributions `package` requires"""
+    try:
+        requirements = pkg_resources.get_distribution(package).requires()
+    except (pkg_resources.DistributionNotFound, pkg_resources.VersionConflict):
+        return ()
+    return tuple(r.key for r in requirements)
+
+
+def with_requirements(packages: Dict[str, str]) -> Dict[str, str]:
+    """Add the installed distributions that `packages` require, transitively.
+
+    Imports found by reading a script are only its direct ones, while imports
+    recorded at runtime also include the imports of the imported packages.
+    Closing both over requirements makes them agree.
+    """
+    installed, _ = _cached_maps()
+    by_key = {name.lower(): name for name in installed}
+    result = dict(packages)
+    pending = list(packages)
+    while pending:
+        for key in _requirements_of(pending.pop()):
+            name = by_key.get(key)
+            if name is not None and name not in result:
+                result[name] = installed[name]
+                pending.append(name)
+    return result
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_maps() -> Tuple[Dict[str, str], Dict[str, str]]:
+    """`list_packages()` and `get_module_package_map()`"""
+    return list_packages(), get_module_package_map()
+
+
+def cached_module_package_map() -> Dict[str, str]:
+    """`get_module_package_map()`, scanned once per process"""
+    return _cached_maps()[1]
+
+
+def cached_package_module_map() -> Dict[str, List[str]]:
+    """`get_package_module_map()`, scanned once per process"""
+    result: Dict[str, List[str]] = {}
+    for module, package in cached_module_package_map().items():
+        result.setdefault(package, []).append(module)
+    return result
+
+
 def get_active_modules():
     return sys.modules.keys()
 
 
 def get_active_packages():
-    active_packages = {}
-    packages = list_packages()
-    mpmap = get_module_package_map()
-    for am in get_active_modules():
-        if am in mpmap:
-            active_packages[mpmap[am]] = packages[mpmap[am]]
-    return active_packages
-
-
-__all__ = ["get_active_packages"]
+    return get_packages_of_modules(set(get_active_modules()))
+
+
+def get_packages_of_modules(modules: Set[str]) -> Dict[str, str]:
+    """Map top-level module names to the installed distributions providing them.
+    Modules that do not belong to any distribution (e.g., local scripts) are
+    skipped.
+
+    The distributions they require are included (see `with_requirements`).
+
+    Which distribution provides a module is scanned once per process, so
+    packages installed later are not seen.
+    """
+    result = {}
+    packages, mpmap = _cached_maps()
+    for m in modules:
+        if m in mpmap:
+            result[mpmap[m]] = packages[mpmap[m]]
+    return with_requirements(result)
+
+
+class ImportTracker(importlib.abc.MetaPathFinder):
+    """Record top-level modules imported while the tracker is installed.
+
+    The finder is placed in front of `sys.meta_path` and never resolves
+    anything itself, so it only observes modules that are loaded for the first
+    time. Modules already in `sys.modules` (e.g., imported earlier by the
+    coordinator or a previous component) do not reach the finders, so
+    `builtins.__import__` is wrapped as well to catch import statements that
+    are served from the module cache. The wrapper only adds the name to a set.
+
+    Mapping modules to distributions is costly, so it is only done when
+    `packages` is read.
+
+    Usage:
+    ```
+    with ImportTracker() as tracker:
+        ...
+    tracker.packages  # {"numpy": "1.22.4", ...}
+    ```
+    """
+
+    def __init__(self) -> None:
+        self._modules: Set[str] = set()
+        self._orig_import = None
+        self._is_tracking = False
+
+    def find_spec(self, fullname, path, target=None):
+        self._modules.add(fullname.partition(".")[0])
+        return None
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level == 0 and self._is_tracking:
+            self._modules.add(name.partition(".")[0])
+        return self._orig_import(name, globals, locals, fromlist, level)  # type: ignore
+
+    def install(self) -> None:
+        if self._is_tracking:
+            return
+        self._is_tracking = True
+        sys.meta_path.insert(0, self)
+        if self._orig_import is None:
+            self._orig_import = builtins.__import__
+            builtins.__import__ = self._import
+
+    def uninstall(self) -> None:
+        if not self._is_tracking:
+            return
+        self._is_tracking = False
+        if builtins.__import__ == self._import:
+            builtins.__import__ = self._orig_import
+            self._orig_import = None
+        # Else another wrapper was installed on top of ours since `install`.
+        # Ours stays in the chain, and only passes imports through
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *args):
+        self.uninstall()
+
+    @property
+    def modules(self) -> Set[str]:
+        return self._modules
+
+    @property
+    def packages(self) -> Dict[str, str]:
+        return get_packages_of_modules(self._modules)
+
+
+__all__ = [
+    "get_active_packages",
+    "get_packages_of_modules",
+    "with_requirements",
+    "ImportTracker",
+]
 
 if __name__ == "__main__":
     pprint.pprint(get_active_packages())
@@ -5,12 +5,24 @@ import threading
 import tempfile
 from typing import List, Optional
 
+from pipeman.config import default_config as conf
 from pipeman.meta import LibraryMeta
+from pipeman.utils import LogUtils
 from manifest import ComponentType, Manifest
-from daemon.worker import execute_component
+from daemon.worker import (
+    IS_IMPORT_TRACKING_ENABLED,
+    execute_component,
+    get_last_imported_packages,
+)
+import import_analyzer
 import workerconn as wc
 
 
+IS_STATIC_ANALYSIS_ENABLED = conf.getboolean("manifest", "static_analysis")
+
+_logger = LogUtils.get_default_named_logger("Component")
+
+
 class DAGNode:
     def __init__(self) -> None:
         self._parents: List["DAGNode"] = []
@@ -50,6 +62,8 @@ class Component(DAGNode):
         self._lock = None
         self._manifest = None
         self._command = None
+        self._request_id = 0
+        self._state_version = 0
         if load_manifest:
             self._manifest = Manifest.load(self.manifest_path)
 
@@ -61,6 +75,15 @@ class Component(DAGNode):
     def command(self, command: List[str]):
         self._command = command
 
+    @property
+    def request_id(self) -> int:
+        """ID of the `execute` request dispatching this component to a worker"""
+        return self._request_id
+
+    @request_id.setter
+    def request_id(self, request_id: int):
+        self._request_id = request_id
+
     @property
     def lock(self):
         return self._lock
@@ -85,6 +108,7 @@ class Component(DAGNode):
     def path(self, path: str):
         self._path = path
         self._manifest = Manifest.load(self.manifest_path)
+        self._state_version += 1
 
     @property
     def done(self):
@@ -93,6 +117,7 @@ class Component(DAGNode):
     @done.setter
     def done(self, done: bool):
         self._done = done
+        self._state_version += 1
 
     @property
     def start_time(self):
@@ -101,6 +126,7 @@ class Component(DAGNode):
     @start_time.setter
     def start_time(self, value: int):
         self._start_time = value
+        self._state_version += 1
 
     @property
     def end_time(self):
@@ -109,6 +135,7 @@ class Component(DAGNode):
     @end_time.setter
     def end_time(self, value: int):
         self._end_time = value
+        self._state_version += 1
 
     @property
     def worker(self):
@@ -117,6 +144,15 @@ class Component(DAGNode):
     @worker.setter
     def worker(self, worker: "wc.BaseWorkerConnection"):
         self._worker = worker
+        self._state_version += 1
+
+    @property
+    def state_version(self):
+        """Changes whenever `dict(self)` may change. Cheap to compute"""
+        return (
+            self._state_version,
+            self._worker.version if self._worker is not None else None,
+        )
 
     def __iter__(self):
         yield ("id", self.id)
@@ -126,8 +162,9 @@ class Component(DAGNode):
         yield ("end_time", self.end_time)
         if self.worker is not None:
             yield ("worker", self.worker.info_dict)
-        if self.path is not None:
-            yield ("manifest", dict(self.get_manifest()))
+        # Never load (or execute) the component just to describe it
+        if self._manifest is not None:
+            yield ("manifest", self._manifest.info_dict)
 
     @property
     def manifest_path(self) -> str:
@@ -140,12 +177,21 @@ class Component(DAGNode):
             raise AssertionError("Component path not specified")
 
         if self._manifest is None or refresh:
-            execute_component(
-                component_id="DUMMY",
-                working_directory=self.path,
-                cmds=self.get_component_commands(),
-            )
-            manifest = Manifest.capture_current_env()
+            manifest = None
+            if IS_STATIC_ANALYSIS_ENABLED:
+                manifest = self._analyze_manifest()
+
+            if manifest is None:
+                execute_component(
+                    component_id="DUMMY",
+                    working_directory=self.path,
+                    cmds=self.get_component_commands(),
+                )
+                manifest = Manifest.capture_current_env(
+                    packages=get_last_imported_packages()
+                    if IS_IMPORT_TRACKING_ENABLED
+                    else None
+                )
             manifest.name = self._meta.name
             manifest.type = ComponentType(self._meta.meta_type)
             manifest.version = self._meta.version
@@ -153,16 +199,38 @@ class Component(DAGNode):
             # self._cleanup()
 
             self._manifest = manifest
+            self._state_version += 1
 
         return self._manifest
 
-    def get_component_commands(self) -> List[str]:
+    def _analyze_manifest(self) -> Optional[Manifest]:
+        """Build the manifest from the imports of the train script without
+        executing it. Returns None if the imports cannot be resolved statically.
+        """
+        meta = self._load_meta()
+        script_path = os.path.join(self._path, meta.train_script)  # type: ignore
+        try:
+            packages = import_analyzer.get_script_packages(script_path, self._path)
+        except (import_analyzer.UnresolvedImport, OSError, SyntaxError) as e:
+            _logger.debug(
+                f"Static analysis of {script_path} failed ({e}). "
+                "Fall back to runtime capture"
+            )
+            return None
+
+        return Manifest.capture_current_env(packages=packages)
+
+    def _load_meta(self) -> LibraryMeta:
         if not self._path:
             raise AssertionError("Component path not specified")
 
         cp = ConfigParser()
         cp.read(os.path.join(self._path, ".manifest"))
         self._meta = LibraryMeta(cp)
+        return self._meta
+
+    def get_component_commands(self) -> List[str]:
+        self._load_meta()
         self._temp_output_folder = tempfile.mkdtemp(prefix=".")
         return [
             "python",
@@ -196,6 +264,9 @@ class Pipeline(DAGNode):
         self._done = False
         self._version = version
         self._components = components
+        self._hash = None
+        self._hash_key = None
+        self._state_version = 0
 
     @property
     def name(self):
@@ -212,20 +283,34 @@ class Pipeline(DAGNode):
     @done.setter
     def done(self, done: bool):
         self._done = done
+        self._state_version += 1
 
     @property
     def components(self):
         return self._components
 
+    @property
+    def state_version(self):
+        """Changes whenever `info_dict` may change. Cheap to compute"""
+        return (
+            self._state_version,
+            tuple(c.state_version for c in self._components),
+        )
+
     @property
     def hash(self):
         if len(self.components) == 0:
             return None
 
-        hash = hashlib.sha256()
-        hash.update(f"{self.components[0].start_time}".encode("utf-8"))
-        hash.update(" ".join([p.name for p in self.components]).encode("utf-8"))
-        return hash.hexdigest()
+        # The start time is only known once the first component starts
+        key = (self.components[0].start_time, len(self.components))
+        if key != self._hash_key:
+            hash = hashlib.sha256()
+            hash.update(f"{self.components[0].start_time}".encode("utf-8"))
+            hash.update(" ".join([p.name for p in self.components]).encode("utf-8"))
+            self._hash = hash.hexdigest()
+            self._hash_key = key
+        return self._hash
 
     def __iter__(self):
         yield ("name", self.name)
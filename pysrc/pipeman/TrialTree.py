@@ -30,6 +30,8 @@ class TreeNode:
         self.storage_time = 0.0
         self.execution_time = 0.0
         self.io_time = 0.0
+        # Reported by the worker. See `profiler.ResourceMeter`
+        self.resource_usage: Dict[str, Optional[float]] = {}
         self.perf = 0.0
 
     @property
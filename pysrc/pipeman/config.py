@@ -89,6 +89,14 @@ class Configuration:
         )
         return raw_value
 
+    def getfloat(self, section: str, key: str) -> float:
+        self._check_key_existence(section, key)
+
+        raw_value = self._parser.getfloat(
+            section, key, fallback=float(self._defaults[section][key])
+        )
+        return raw_value
+
     def __str__(self):
         result = {}
 
@@ -109,6 +117,11 @@ DEFUALTS_CONFIG_INI = {
         "host": "127.0.0.1",
         "worker_manager_port": "50200",
         "webapi_port": "5020",
+        "history_retention": "200",
+        "history_page_size": "50",
+        "log_window_size": "1048576",
+        "log_max_matches": "1000",
+        "log_follow_interval": "0.5",
     },
     "storage": {"storage_engine": "forkbase"},
     "storage_ledgebase": {
@@ -118,23 +131,58 @@ DEFUALTS_CONFIG_INI = {
         "chunk_size": "65536",
         "generic_file_name": "VALUE",
         "prefix": "$HOME/fsstore",
+        "layout": "sharded",
+        "index_file_name": "INDEX.sqlite3",
+        "read_mode": "direct",
+    },
+    "storage_cas": {
+        "enable": "false",
+        "path": "$HOME/fsstore/cas",
+        "min_chunk_size": "16384",
+        "avg_chunk_size": "65536",
+        "max_chunk_size": "262144",
+    },
+    "storage_cache": {
+        "enable": "false",
+        "path": "$HOME/fsstore/cache",
+        "max_size_mb": "10240",
     },
     "storage_rdbms": {
         "user": "$USER",
         "ssl_cert_path": "$HOME/cert.pem",
         "ssl_key_path": "$HOME/key.pem",
+        "pool_size": "4",
+        "pool_check_interval": "30",
+        "part_size": "1048576",
+        "schema_version": "1",
+    },
+    "storage_sqlite": {
+        "path": "$HOME/fsstore/seccask.sqlite3",
+        "block_size": "1048576",
     },
     "scheduler": {
         "default_num_slot": "4",
         "enable_compatibility_check_on_caching": "true",
         "enable_compatibility_check_on_new_worker": "false",
+        "pipeline_depth": "1",
         "__debug_disable_level3_check": "false",
         "__debug_worker_creation_dry_run": "false",
         "__debug_singleton_worker": "false",
     },
+    "manifest": {"track_imports": "true", "static_analysis": "true"},
     "worker": {
         "gramine_path": "/usr/local/bin/gramine-direct",
         "gramine_manifest_path": "$HOME/gramine-manifest/python",
+        "module_cache_size": "8",
+        "hygiene": "false",
+        "hygiene_keep_packages": "numpy,scipy,pandas,sklearn,torch,tensorflow",
+        "recycle_rss_mb": "0",
+    },
+    "zygote": {
+        "enable": "false",
+        "port": "50300",
+        "packages": "",
+        "profile_size": "8",
     },
     "worker_sgx": {
         "gramine_path": "/usr/local/bin/gramine-sgx",
@@ -147,6 +195,9 @@ DEFUALTS_CONFIG_INI = {
         "log_encfs": "false",
         "log_io": "false",
         "log_time": "false",
+        "level": "DEBUG",
+        "module_levels": "",
+        "ring_size": "1000",
     },
     "ratls": {"enable": "false", "mrenclave": "", "mrsigner": ""},
     "profiler": {"enable_memory_profiler": "false", "memory_profiler_mode": "status"},
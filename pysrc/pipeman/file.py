@@ -13,6 +13,7 @@ from typing import Union
 from thirdparty.stream_zip import stream_zip as sz
 from thirdparty.stream_unzip_orig import stream_unzip as su
 
+from pipeman import metrics
 from pipeman.utils import LogUtils
 
 
@@ -25,6 +26,20 @@ from pipeman.utils import LogUtils
 #             del sub
 
 
+def _timed_archive(op: str):
+    return metrics.timed(
+        "seccask_archive_seconds", "Duration of archiving and extraction", op=op
+    )
+
+
+def _count_archive_bytes(op: str, archive_path: str):
+    metrics.counter(
+        "seccask_archive_bytes_total",
+        "Compressed bytes written by archiving or read by extraction",
+        op=op,
+    ).inc(os.path.getsize(archive_path))
+
+
 class PseudoDirEntry:
     def __init__(self, path: str):
         self.path = path
@@ -116,7 +131,7 @@ class FileUtils:
             "Archiving file(s) {} to {}".format(source_files, dest_archive)
         )
 
-        with open(dest_archive, "wb") as f:
+        with _timed_archive("archive_file"), open(dest_archive, "wb") as f:
             if isinstance(source_files, list):
                 for zipped_chunk in sz.stream_zip(
                     [iter_metadata_for_file(p) for p in source_files]
@@ -129,6 +144,7 @@ class FileUtils:
                     f.write(zipped_chunk)
             else:
                 raise ValueError("invalid source files")
+        _count_archive_bytes("archive_file", dest_archive)
 
         # with zipfile.ZipFile(dest_archive, "w") as archive:
         #     if isinstance(source_files, list):
@@ -151,9 +167,10 @@ class FileUtils:
         )
         old_pwd = goto_dir(source_folder)
 
-        with open(dest_archive, "wb") as f:
+        with _timed_archive("archive_folder"), open(dest_archive, "wb") as f:
             for zipped_chunk in sz.stream_zip(iter_stream_zip(".")):
                 f.write(zipped_chunk)
+        _count_archive_bytes("archive_folder", dest_archive)
 
         ## GC to free memory during archive
         gc.collect()
@@ -165,15 +182,17 @@ class FileUtils:
         cls.logger.debug("Extracting {} to {}".format(source_path, dest_path))
         old_pwd = goto_dir(dest_path)
 
-        for file_name, file_size, unzipped_chunks in su.stream_unzip(
-            iterate_binary(source_path)
-        ):
-            file_name = os.path.abspath(file_name)
-            # cls.logger.debug("Extracting in dir {}: {}".format(dest_path, file_name))
-            check_or_create_dir(os.path.dirname(file_name).decode("utf-8"))
-            with open(file_name, "wb") as f:
-                for chunk in unzipped_chunks:
-                    f.write(chunk)
+        with _timed_archive("extract"):
+            for file_name, file_size, unzipped_chunks in su.stream_unzip(
+                iterate_binary(source_path)
+            ):
+                file_name = os.path.abspath(file_name)
+                # cls.logger.debug("Extracting in dir {}: {}".format(dest_path, file_name))
+                check_or_create_dir(os.path.dirname(file_name).decode("utf-8"))
+                with open(file_name, "wb") as f:
+                    for chunk in unzipped_chunks:
+                        f.write(chunk)
+        _count_archive_bytes("extract", source_path)
         ## GC to free memory during archive
         gc.collect()
 
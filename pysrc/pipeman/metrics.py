@@ -0,0 +1,223 @@
+"""In-process metrics of the coordinator.
+
+Counters and histograms are registered by name and labels in a `Registry`,
+and rendered in the Prometheus text format (served at `/metrics` of WebAPI).
+
+Histograms are HDR-style: each power of two is split into `SUB_BUCKETS`
+linear buckets, so that quantiles keep a bounded relative error (~1/16) over
+any range of values, with constant memory and O(1) recording.
+
+```
+from pipeman import metrics
+
+metrics.counter("seccask_worker_cache_total", "...", result="hit").inc()
+with metrics.timed("seccask_storage_get_seconds", "...", backend="rdbms"):
+    ...
+```
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+SUB_BUCKETS = 16
+QUANTILES = (0.5, 0.9, 0.99)
+
+LabelSet = Tuple[Tuple[str, str], ...]
+
+
+def _bucket_of(value: float) -> Tuple[int, int]:
+    # value = m * 2^e where 0.5 <= m < 1
+    m, e = math.frexp(value)
+    return e, int((m * 2 - 1) * SUB_BUCKETS)
+
+
+def _bucket_value(bucket: Tuple[int, int]) -> float:
+    """Midpoint of a bucket"""
+    e, sub = bucket
+    return math.ldexp((1 + (sub + 0.5) / SUB_BUCKETS) / 2, e)
+
+
+class Counter:
+    def __init__(self) -> None:
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self._value += amount
+
+
+class Histogram:
+    """Log-linear histogram of non-negative values"""
+
+    def __init__(self) -> None:
+        self._buckets: Dict[Tuple[int, int], int] = {}
+        self._zeros = 0
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def sum(self) -> float:
+        return self._sum
+
+    @property
+    def max(self) -> float:
+        return self._max
+
+    def observe(self, value: float) -> None:
+        value = max(value, 0.0)
+        with self._lock:
+            if value == 0.0:
+                self._zeros += 1
+            else:
+                b = _bucket_of(value)
+                self._buckets[b] = self._buckets.get(b, 0) + 1
+            self._count += 1
+            self._sum += value
+            if value > self._max:
+                self._max = value
+
+    def quantile(self, q: float) -> float:
+        with self._lock:
+            if self._count == 0:
+                return math.nan
+            rank = max(1, math.ceil(q * self._count))
+            if rank <= self._zeros:
+                return 0.0
+            seen = self._zeros
+            for b in sorted(self._buckets):
+                seen += self._buckets[b]
+                if seen >= rank:
+                    return min(_bucket_value(b), self._max)
+            return self._max
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # name -> (type, doc, {labels: metric})
+        self._families: Dict[str, Tuple[str, str, Dict[LabelSet, object]]] = {}
+
+    def _get(self, kind: str, cls: type, name: str, doc: str, labels: dict):
+        key: LabelSet = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = (kind, doc, {})
+            elif family[0] != kind:
+                raise ValueError(f"Metric {name} is already a {family[0]}")
+            metrics = family[2]
+            metric = metrics.get(key)
+            if metric is None:
+                metric = metrics[key] = cls()
+            return metric
+
+    def counter(self, name: str, doc: str = "", **labels) -> Counter:
+        return self._get("counter", Counter, name, doc, labels)
+
+    def histogram(self, name: str, doc: str = "", **labels) -> Histogram:
+        return self._get("summary", Histogram, name, doc, labels)
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)"""
+        with self._lock:
+            families = [
+                (name, kind, doc, list(metrics.items()))
+                for name, (kind, doc, metrics) in sorted(self._families.items())
+            ]
+
+        lines: List[str] = []
+        for name, kind, doc, metrics in families:
+            if doc:
+                lines.append(f"# HELP {name} {_escape_doc(doc)}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, m in metrics:
+                if isinstance(m, Counter):
+                    lines.append(f"{name}{_format_labels(labels)} {_num(m.value)}")
+                elif isinstance(m, Histogram):
+                    for q in QUANTILES:
+                        ql = labels + (("quantile", str(q)),)
+                        lines.append(
+                            f"{name}{_format_labels(ql)} {_num(m.quantile(q))}"
+                        )
+                    lines.append(f"{name}_sum{_format_labels(labels)} {_num(m.sum)}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {m.count}")
+            if kind == "summary":
+                lines.append(f"# TYPE {name}_max gauge")
+                for labels, m in metrics:
+                    lines.append(f"{name}_max{_format_labels(labels)} {_num(m.max)}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape_doc(doc: str) -> str:
+    return doc.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _format_labels(labels: LabelSet) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _num(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value))
+
+
+default_registry = Registry()
+
+
+def counter(name: str, doc: str = "", **labels) -> Counter:
+    return default_registry.counter(name, doc, **labels)
+
+
+def histogram(name: str, doc: str = "", **labels) -> Histogram:
+    return default_registry.histogram(name, doc, **labels)
+
+
+@contextmanager
+def timed(name: str, doc: str = "", **labels) -> Iterator[None]:
+    """Observe the duration of the block (in seconds), even if it raises"""
+    h = histogram(name, doc, **labels)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        h.observe(time.perf_counter() - start)
+
+
+def render(registry: Optional[Registry] = None) -> str:
+    return (registry or default_registry).render()
+
+
+if __name__ == "__main__":
+    import random
+
+    h = histogram("demo_seconds", "Demo latency")
+    values = [random.expovariate(100) for _ in range(100000)]
+    for v in values:
+        h.observe(v)
+    values.sort()
+    for q in QUANTILES:
+        exact = values[int(q * len(values)) - 1]
+        print(f"p{q}: exact {exact:.6f}, estimated {h.quantile(q):.6f}")
+
+    counter("demo_total", "Demo counter", result="hit").inc()
+    print(render())
@@ -3,10 +3,16 @@ import copy
 import pprint
 from abc import ABCMeta, abstractmethod
 from tempfile import NamedTemporaryFile
-from typing import List
+from typing import Dict, List
 
 from pipeman.meta import MetaKey
-from pipeman.store.base_storage import BaseStorage, TransferDType
+from pipeman.store.base_storage import (
+    BaseStorage,
+    GetItem,
+    PutItem,
+    TransferDType,
+    VersionOf,
+)
 from pipeman.version import SemanticVersion
 
 
@@ -120,6 +126,12 @@ class StringStorage(Storage):
     def get_parents_by_version(self, str_key: str, str_version: str) -> list:
         return self.phy_storage.meta(key=str_key, version=str_version).values
 
+    def get_lineage_by_branch_head(
+        self, str_key: str, str_branch: str
+    ) -> Dict[str, List[str]]:
+        """Parents of the branch head and of all its ancestors, in one call"""
+        return self.phy_storage.lineage(key=str_key, branch=str_branch).values
+
 
 # FileStorage based on Storage
 class FileStorage(Storage):
@@ -168,6 +180,27 @@ class FileStorage(Storage):
 
         return local_path
 
+    def get_versions(self, str_key: str, hashed_versions: List[str]) -> List[str]:
+        """
+        Returns:
+            List[str]: file paths of versions `hashed_versions` of key `str_key`,
+                fetched in one batch
+
+        Raises:
+            KeyError: if key does not exist
+        """
+        results = self.phy_storage.multi_get(
+            [
+                GetItem(str_key, hversion=v, dtype=TransferDType.FILE)
+                for v in hashed_versions
+            ]
+        )
+        local_paths = [local_path for _, local_path in results]
+        if any(local_path is None for local_path in local_paths):
+            raise KeyError(f"Key {str_key} does not exist")
+
+        return local_paths
+
     def put(self, str_key: str, str_branch: str, local_path):
         ret = self.phy_storage.put(
             key=str_key, branch=str_branch, dtype=TransferDType.FILE, value=local_path
@@ -225,6 +258,12 @@ class FileStorage(Storage):
     def get_parents_by_version(self, str_key: str, str_version: str) -> list:
         return self.phy_storage.meta(key=str_key, version=str_version).values
 
+    def get_lineage_by_branch_head(
+        self, str_key: str, str_branch: str
+    ) -> Dict[str, List[str]]:
+        """Parents of the branch head and of all its ancestors, in one call"""
+        return self.phy_storage.lineage(key=str_key, branch=str_branch).values
+
 
 """
 Higher Level
@@ -309,18 +348,20 @@ class SemanticFileStorage:
         return self.__parse_path(meta_path)
 
     def put(self, key: MetaKey, local_path):
-        # put the config
-        ret = self._entity_storage.put(
-            str_key=self._form_entity_key(key),
-            str_branch=key.component_version.branch,
-            local_path=local_path,
-        )
-        hashed_version = ret
-        # record the new hash version
-        self._version_storage.put(
-            str_key=self._form_version_key(key),
-            str_branch=key.component_version.branch,
-            raw_string=hashed_version,
+        branch = key.component_version.branch
+        # put the config, and record its hash version, in one batch
+        self._entity_storage.phy_storage.multi_put(
+            [
+                PutItem(
+                    self._form_entity_key(key), branch, TransferDType.FILE, local_path
+                ),
+                PutItem(
+                    self._form_version_key(key),
+                    branch,
+                    TransferDType.STRING,
+                    VersionOf(0),
+                ),
+            ]
         )
 
     def merge(
@@ -439,34 +480,17 @@ class SemanticFileStorage:
         )
 
     def traverse_branch(self, key: MetaKey) -> list:
-        root = False
-        node = self.get_parents_of_branch_head(key)
-        lineage = [node]
-        local_paths = []
-
-        while not root:
-            node = lineage[-1]
-            length = len(node)
-            if length == 1:
-                # normal case
-                parent_node = self._entity_storage.get_parents_by_version(
-                    str_key=self._form_entity_key(key), str_version=node[0]
-                )
-                if parent_node is None:
-                    break
-                else:
-                    lineage.append(parent_node)
-            else:
-                # may be merge node
-                raise NotImplementedError()
-
-        for version in lineage:
-            local_path = self._entity_storage.get_version(
-                str_key=self._form_entity_key(key), hashed_version=version[0]
-            )
-            local_paths.append(local_path)
-
-        return local_paths
+        """Files of the ancestors of the branch head, including merge parents,
+        nearest first
+        """
+        entity_key = self._form_entity_key(key)
+        lineage = self._entity_storage.get_lineage_by_branch_head(
+            str_key=entity_key, str_branch=key.component_version.branch
+        )
+        # The first one is the head itself
+        return self._entity_storage.get_versions(
+            str_key=entity_key, hashed_versions=list(lineage)[1:]
+        )
 
     def get_list_of_branches(self, key: MetaKey) -> list:
         primary_storage = self._entity_storage
@@ -37,7 +37,55 @@ def use_pep249():
     SSL_CERT_PATH = conf.get("storage_rdbms", "ssl_cert_path")
     SSL_KEY_PATH = conf.get("storage_rdbms", "ssl_key_path")
 
-    store = PEP249Storage(user=USER, ssl_cert=SSL_CERT_PATH, ssl_key=SSL_KEY_PATH)
+    store = PEP249Storage(
+        user=USER,
+        ssl_cert=SSL_CERT_PATH,
+        ssl_key=SSL_KEY_PATH,
+        pool_size=conf.getint("storage_rdbms", "pool_size"),
+        pool_check_interval=conf.getfloat("storage_rdbms", "pool_check_interval"),
+        part_size=conf.getint("storage_rdbms", "part_size"),
+        schema_version=conf.getint("storage_rdbms", "schema_version"),
+    )
+
+
+def use_sqlite():
+    global store
+
+    from pipeman.store.sqlite import SQLiteStorage
+
+    store = SQLiteStorage(
+        conf.get("storage_sqlite", "path"),
+        block_size=conf.getint("storage_sqlite", "block_size"),
+    )
+
+
+def use_cas():
+    """Deduplicate files put to the selected storage"""
+    global store
+
+    from pipeman.store.cas import Chunker, ChunkStore, ContentAddressedStorage
+
+    chunker = Chunker(
+        conf.getint("storage_cas", "min_chunk_size"),
+        conf.getint("storage_cas", "avg_chunk_size"),
+        conf.getint("storage_cas", "max_chunk_size"),
+    )
+    store = ContentAddressedStorage(
+        store, ChunkStore(conf.get("storage_cas", "path")), chunker
+    )
+
+
+def use_blob_cache():
+    """Cache blobs read from the selected storage on local disk"""
+    global store
+
+    from pipeman.store.blobcache import BlobCache, CachingStorage
+
+    cache = BlobCache(
+        conf.get("storage_cache", "path"),
+        conf.getint("storage_cache", "max_size_mb") * 1024 * 1024,
+    )
+    store = CachingStorage(store, cache)
 
 
 def init_physical_storage():
@@ -50,8 +98,21 @@ def init_physical_storage():
         use_filesystem()
     elif selected_storage == "rdbms":
         use_pep249()
+    elif selected_storage == "sqlite":
+        use_sqlite()
+
+    if conf.getboolean("storage_cas", "enable"):
+        use_cas()
+    if conf.getboolean("storage_cache", "enable"):
+        use_blob_cache()
 
     store.connect()
 
 
-init_physical_storage()
+def __getattr__(name: str):
+    # Initialized on first use, so that tools in submodules (e.g.,
+    # `python -m pipeman.store.pep249_schema bench`) run without a storage
+    if name == "store":
+        init_physical_storage()
+        return store
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
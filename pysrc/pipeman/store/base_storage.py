@@ -1,7 +1,13 @@
+import functools
+import inspect
+import os
+import time
 from abc import ABCMeta, abstractmethod
+from collections import deque
 from enum import Enum
-from typing import Optional, Tuple
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
 
+from pipeman import metrics
 from pipeman.utils import LogUtils
 
 
@@ -16,6 +22,143 @@ class StorageReturn:
         self.values = dict()
 
 
+def _size_of(dtype: "TransferDType", value) -> int:
+    if value is None:
+        return 0
+    if dtype == TransferDType.FILE:
+        return os.path.getsize(value) if os.path.exists(value) else 0
+    return len(value)
+
+
+class VersionOf(NamedTuple):
+    """Value of a `PutItem`: the version put by item `index` of the same batch"""
+
+    index: int
+
+
+class PutItem(NamedTuple):
+    key: str
+    branch: str
+    dtype: TransferDType
+    value: Union[str, VersionOf]
+
+
+class GetItem(NamedTuple):
+    key: str
+    branch: Optional[str] = None
+    hversion: Optional[str] = None
+    dtype: TransferDType = TransferDType.STRING
+
+
+def resolve_value(
+    value: Union[str, VersionOf], results: List[StorageReturn]
+) -> str:
+    """`value` of a `PutItem`, given the results of the items before it"""
+    if isinstance(value, VersionOf):
+        return results[value.index].values["Version"]
+    return value
+
+
+def instrumented(op: str):
+    """Record latency and bytes of `get` or `put` of a storage backend.
+
+    Metrics are labelled with the class name of the backend
+    """
+
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            backend = type(self).__name__
+            start = time.perf_counter()
+            result = fn(self, *args, **kwargs)
+            metrics.histogram(
+                f"seccask_storage_{op}_seconds",
+                f"Latency of storage {op}",
+                backend=backend,
+            ).observe(time.perf_counter() - start)
+
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            dtype = bound.arguments["dtype"]
+            if op == "get":
+                value = result[1] if isinstance(result, tuple) else None
+            else:
+                value = bound.arguments["value"]
+            metrics.counter(
+                f"seccask_storage_{op}_bytes_total",
+                f"Bytes transferred by storage {op}",
+                backend=backend,
+            ).inc(_size_of(dtype, value))
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def instrumented_batch(op: str):
+    """`instrumented` for `multi_get` or `multi_put`. A batch is observed as
+    one operation, of the bytes of all its items
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, items: list):
+            backend = type(self).__name__
+            start = time.perf_counter()
+            results = fn(self, items)
+            metrics.histogram(
+                f"seccask_storage_{op}_seconds",
+                f"Latency of storage {op}",
+                backend=backend,
+            ).observe(time.perf_counter() - start)
+
+            if op == "get":
+                sizes = (_size_of(i.dtype, r[1]) for i, r in zip(items, results))
+            else:
+                sizes = (
+                    _size_of(i.dtype, resolve_value(i.value, results)) for i in items
+                )
+            metrics.counter(
+                f"seccask_storage_{op}_bytes_total",
+                f"Bytes transferred by storage {op}",
+                backend=backend,
+            ).inc(sum(sizes))
+            return results
+
+        return wrapper
+
+    return decorator
+
+
+def order_lineage(
+    version: str, edges: Iterable[Tuple[str, Optional[str]]]
+) -> Dict[str, List[str]]:
+    """Parents by version, in breadth-first order from `version`.
+
+    Args:
+        edges: `(version, parent)` for the ancestors of `version`, with the
+            parents of each version in order. The parent is None for roots.
+    """
+    parents: Dict[str, List[str]] = {}
+    for v, parent in edges:
+        parents.setdefault(v, [])
+        if parent is not None:
+            parents[v].append(parent)
+
+    result: Dict[str, List[str]] = {}
+    queue = deque([version])
+    while queue:
+        v = queue.popleft()
+        if v in result:
+            continue
+        result[v] = parents.get(v, [])
+        queue.extend(result[v])
+    return result
+
+
 class BaseStorage(metaclass=ABCMeta):
     """Abstract class for all interfaces storage subsystems.
 
@@ -51,6 +194,33 @@ class BaseStorage(metaclass=ABCMeta):
     ) -> StorageReturn:
         pass
 
+    def multi_get(self, items: List[GetItem]) -> List[Tuple[str, Optional[str]]]:
+        """Results of `get` for each item.
+
+        Backends should answer in a fixed number of round trips. This default
+        calls `get` once per item.
+        """
+        return [
+            self.get(key=i.key, branch=i.branch, hversion=i.hversion, dtype=i.dtype)
+            for i in items
+        ]
+
+    def multi_put(self, items: List[PutItem]) -> List[StorageReturn]:
+        """Results of `put` for each item, put in order. A value `VersionOf(i)`
+        is replaced by the version put by item `i`, e.g., to record the
+        version of a file put in the same batch.
+
+        Backends with transactions should put all items or none, in one
+        transaction. This default calls `put` once per item.
+        """
+        results: List[StorageReturn] = []
+        for i in items:
+            value = resolve_value(i.value, results)
+            results.append(
+                self.put(key=i.key, branch=i.branch, dtype=i.dtype, value=value)
+            )
+        return results
+
     @abstractmethod
     def list_key(self) -> StorageReturn:
         pass
@@ -77,6 +247,42 @@ class BaseStorage(metaclass=ABCMeta):
     def meta(self, key: str, version: str = None, branch: str = None) -> StorageReturn:
         pass
 
+    def is_stored_file(self, path: str) -> bool:
+        """True if `path`, as returned by `get`, is a file of the storage
+        itself, to be left as is. Otherwise, it is a temporary file that the
+        caller owns
+        """
+        return False
+
+    def head_version(self, key: str, branch: str) -> Optional[str]:
+        """Hashed version at the head of a branch. None if there is none"""
+        head = self.head(key, branch).values
+        # UStore returns the version itself
+        return head.get("Version") if isinstance(head, dict) else head
+
+    def lineage(
+        self, key: str, version: str = None, branch: str = None
+    ) -> StorageReturn:
+        """Ancestry of a version (or of the head of a branch), with merge parents.
+
+        `values` maps the version and each of its ancestors to its parents, in
+        breadth-first order. Empty if the version does not exist.
+
+        Backends with a parent index should answer in one query. This default
+        calls `meta` once per ancestor.
+        """
+        ret = StorageReturn()
+        if version is None:
+            version = self.head_version(key, branch)
+        queue = deque([version] if version is not None else [])
+        while queue:
+            v = queue.popleft()
+            if v in ret.values:
+                continue
+            ret.values[v] = self.meta(key, version=v).values or []
+            queue.extend(ret.values[v])
+        return ret
+
     @abstractmethod
     def merge(
         self,
@@ -0,0 +1,294 @@
+"""Local read-through cache of blobs of a remote storage backend.
+
+Versions are immutable, so a blob fetched once by `(key, hversion)` is kept on
+local disk and served from there afterwards. Reads by branch only ask the
+backend for the head of the branch, and then read that version through the
+cache. The cache is bounded in size, and evicts least recently used blobs.
+Concurrent reads of a blob not cached yet make a single fetch.
+"""
+import hashlib
+import os
+import shutil
+import stat
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+from pipeman import metrics
+from pipeman.env import env
+from pipeman.store.base_storage import (
+    BaseStorage,
+    PutItem,
+    StorageReturn,
+    TransferDType,
+    instrumented,
+)
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        # E.g., on another file system
+        shutil.copyfile(src, dst)
+
+
+class BlobCache:
+    """Files in a directory, named by the hash of `(key, hversion)`"""
+
+    def __init__(self, path: str, max_bytes: int) -> None:
+        self._path = path
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        """Size of each cached file, least recently used first"""
+        self._size = 0
+        self._inflight: Dict[str, threading.Event] = {}
+        self._pins: Dict[str, int] = {}
+        """Number of checkouts in progress of each entry, not evicted meanwhile"""
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def load(self) -> None:
+        """Index the files cached by previous runs, by last use"""
+        os.makedirs(self._path, exist_ok=True)
+        found = []
+        for dirpath, _, filenames in os.walk(self._path):
+            for name in filenames:
+                if "." in name:
+                    # Left by an interrupted insert
+                    os.remove(os.path.join(dirpath, name))
+                    continue
+                st = os.stat(os.path.join(dirpath, name))
+                found.append((st.st_mtime, name, st.st_size))
+        with self._lock:
+            self._entries.clear()
+            for _, name, size in sorted(found):
+                self._entries[name] = size
+            self._size = sum(size for _, _, size in found)
+            self._evict()
+
+    @staticmethod
+    def name_of(key: str, hversion: str) -> str:
+        return hashlib.sha256(f"{key}\0{hversion}".encode()).hexdigest()
+
+    def _file_of(self, name: str) -> str:
+        return os.path.join(self._path, name[0:2], name)
+
+    def checkout(self, name: str, dest: str) -> bool:
+        """Give the cached file another name, `dest`, which stays valid after
+        eviction. False if not cached
+        """
+        with self._lock:
+            if name not in self._entries:
+                return False
+            self._entries.move_to_end(name)
+            self._pins[name] = self._pins.get(name, 0) + 1
+        # Copying may take long, so without the lock
+        try:
+            path = self._file_of(name)
+            _link_or_copy(path, dest)
+            # Last use survives restarts
+            os.utime(path)
+        finally:
+            with self._lock:
+                self._pins[name] -= 1
+                if self._pins[name] == 0:
+                    del self._pins[name]
+                    self._evict()
+        return True
+
+    def insert(self, name: str, local_path: str, move: bool) -> None:
+        """Add `local_path` to the cache, moved if `move`. Otherwise, it is
+        left as is, e.g., as the file of a backend (see `FileSystemStorage`)
+        """
+        path = self._file_of(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{threading.get_ident()}"
+        if move:
+            try:
+                os.replace(local_path, temp_path)
+            except OSError:
+                # E.g., on another file system
+                shutil.copyfile(local_path, temp_path)
+                os.remove(local_path)
+        else:
+            _link_or_copy(local_path, temp_path)
+        os.chmod(temp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.replace(temp_path, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            self._size += size - self._entries.pop(name, 0)
+            self._entries[name] = size
+            self._evict()
+
+    def _evict(self) -> None:
+        if self._size <= self._max_bytes:
+            return
+        # Keep the most recent entry even if it is larger than the budget, and
+        # the ones being checked out, until they are
+        for name in list(self._entries)[:-1]:
+            if self._size <= self._max_bytes:
+                break
+            if name in self._pins:
+                continue
+            self._size -= self._entries.pop(name)
+            try:
+                os.remove(self._file_of(name))
+            except FileNotFoundError:
+                pass
+
+    def begin_fetch(self, name: str) -> Tuple[bool, threading.Event]:
+        """Returns True if the caller should fetch the blob, and call
+        `end_fetch` after. Otherwise, the fetch of another thread is awaited
+        with the returned event
+        """
+        with self._lock:
+            event = self._inflight.get(name)
+            if event is not None:
+                return False, event
+            event = self._inflight[name] = threading.Event()
+            return True, event
+
+    def end_fetch(self, name: str) -> None:
+        with self._lock:
+            event = self._inflight.pop(name)
+        event.set()
+
+
+def _count(result: str) -> None:
+    metrics.counter(
+        "seccask_blob_cache_total", "Reads through the blob cache", result=result
+    ).inc()
+
+
+class CachingStorage(BaseStorage):
+    """Serves reads of `inner` from a `BlobCache` (see the module
+    documentation). Writes go to `inner` only.
+    """
+
+    def __init__(self, inner: BaseStorage, cache: BlobCache) -> None:
+        super().__init__()
+        self._inner = inner
+        self._cache = cache
+
+    @property
+    def inner(self) -> BaseStorage:
+        return self._inner
+
+    def connect(self):
+        self._cache.load()
+        self._inner.connect()
+
+    def disconnect(self):
+        self._inner.disconnect()
+
+    def _fetch(self, key: str, hversion: str, dest: str) -> bool:
+        """Check out the blob to `dest`, fetching it from `inner` if not cached.
+        False if the version does not exist
+        """
+        name = self._cache.name_of(key, hversion)
+        result = "hit"
+        while True:
+            if self._cache.checkout(name, dest):
+                _count(result)
+                return True
+
+            is_leader, event = self._cache.begin_fetch(name)
+            if not is_leader:
+                event.wait()
+                # If the fetch failed (or the blob is evicted already), retry
+                result = "coalesced"
+                continue
+
+            result = "miss"
+            try:
+                _, local_path = self._inner.get(
+                    key=key, hversion=hversion, dtype=TransferDType.FILE
+                )
+                if local_path is None:
+                    return False
+                is_temp = not self._inner.is_stored_file(local_path)
+                try:
+                    self._cache.insert(name, local_path, move=is_temp)
+                finally:
+                    if is_temp and os.path.exists(local_path):
+                        os.remove(local_path)
+            finally:
+                self._cache.end_fetch(name)
+
+    @instrumented("get")
+    def get(
+        self,
+        key: str,
+        branch: str = None,
+        hversion: str = None,
+        dtype: TransferDType = TransferDType.STRING,
+    ):
+        if hversion is None:
+            if branch is None:
+                raise ValueError("Not specifying one of branch and hversion")
+            # Heads move, so they are always asked for
+            hversion = self._inner.head_version(key, branch)
+            if hversion is None:
+                return None, None
+
+        local_file = os.path.join(env.temp_path, f"{key}-{branch}-{time.time()}")
+        if not self._fetch(key, hversion, local_file):
+            return None, None
+
+        if dtype == TransferDType.FILE:
+            return None, local_file
+        with open(local_file, "r") as f:
+            content = f.read()
+        os.remove(local_file)
+        return None, content
+
+    def put(self, key: str, branch: str, dtype: TransferDType, value: str):
+        return self._inner.put(key=key, branch=branch, dtype=dtype, value=value)
+
+    def multi_put(self, items: List[PutItem]) -> List[StorageReturn]:
+        return self._inner.multi_put(items)
+
+    def merge(
+        self,
+        key: str,
+        head_branch: str,
+        merge_branch: str,
+        dtype: TransferDType,
+        value: str,
+    ):
+        return self._inner.merge(
+            key=key,
+            head_branch=head_branch,
+            merge_branch=merge_branch,
+            dtype=dtype,
+            value=value,
+        )
+
+    def list_key(self):
+        return self._inner.list_key()
+
+    def head(self, key: str, branch: str):
+        return self._inner.head(key, branch)
+
+    def branch(
+        self,
+        key: str,
+        new_branch: str,
+        based_on_branch: str = None,
+        refer_version: str = None,
+    ):
+        return self._inner.branch(key, new_branch, based_on_branch, refer_version)
+
+    def list_branch(self, key: str):
+        return self._inner.list_branch(key)
+
+    def meta(self, key: str, version: str = None, branch: str = None):
+        return self._inner.meta(key, version, branch)
+
+    def lineage(self, key: str, version: str = None, branch: str = None):
+        return self._inner.lineage(key, version, branch)
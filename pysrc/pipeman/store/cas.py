@@ -0,0 +1,451 @@
+"""Content-addressed chunk store, deduplicating files across versions.
+
+`ContentAddressedStorage` wraps another storage backend. Files put through it
+are split into chunks at content-defined boundaries, and each chunk is stored
+once in a `ChunkStore`, under its SHA256. The wrapped backend only stores a
+small manifest of the chunks of each version, and keeps doing the versioning
+(branches, heads, parents). Putting content that is already stored (e.g., the
+same library archive committed on several branches) only writes a manifest,
+and similar versions (e.g., datasets with a few changed files) share most of
+their chunks.
+
+Chunk boundaries are where a gear rolling hash of the last 32 bytes has its
+top bits all zero, so that an insertion only changes the chunks around it.
+Strings are small metadata, and are passed through as is. So are files put
+while a component key is set (EncFS): chunks are named by the digest of their
+plaintext, which would both share them across keys and reveal their content to
+anyone able to guess it.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from pipeman import metrics
+from pipeman.env import env
+from pipeman.store.base_storage import (
+    BaseStorage,
+    GetItem,
+    PutItem,
+    StorageReturn,
+    TransferDType,
+    instrumented,
+    instrumented_batch,
+)
+
+# Below module is created from pybind11 and thus have no source
+import cpp_coordinator  # type: ignore
+
+MANIFEST_MAGIC = b"SECCASK-CAS-1\n"
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Deterministic, so that all processes cut at the same boundaries
+_GEAR = np.array(
+    [
+        int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], "little")
+        for i in range(256)
+    ],
+    dtype=np.uint32,
+)
+_WINDOW = 32
+"""Bytes that the (32-bit) hash of a position depends on"""
+
+
+def _gear_hashes(data: bytes) -> np.ndarray:
+    """Gear hash at each position, i.e., what `h = (h << 1) + GEAR[byte]`
+    gives when rolled from the beginning of `data`
+    """
+    h = _GEAR.take(np.frombuffer(data, dtype=np.uint8))
+    shifted = np.empty_like(h)
+    # h[i] = sum of GEAR[data[i - k]] << k for k < m, doubling m up to 32
+    m = 1
+    while m < min(_WINDOW, len(h)):
+        np.left_shift(h[:-m], np.uint32(m), out=shifted[:-m])
+        h[m:] += shifted[:-m]
+        m *= 2
+    return h
+
+
+class Chunker:
+    def __init__(self, min_size: int, avg_size: int, max_size: int) -> None:
+        if not 0 < min_size < avg_size < max_size:
+            raise ValueError("Chunk sizes must be 0 < min < avg < max")
+        self._min_size = min_size
+        self._max_size = max_size
+        bits = max(1, round(np.log2(avg_size - min_size)))
+        # Top bits, which depend on the whole window
+        self._mask = np.uint32(((1 << bits) - 1) << (32 - bits))
+
+    def chunks(self, f: BinaryIO) -> Iterator[bytes]:
+        """Split the content of `f` into chunks"""
+        context = b""
+        """The bytes before `pending`, for the hash of its first positions"""
+        pending = b""
+        while True:
+            block = f.read(READ_BLOCK_SIZE)
+            eof = not block
+            pending += block
+            if not pending:
+                return
+
+            h = _gear_hashes(context + pending)[len(context) :]
+            # Ends (exclusive) of chunks that may end here
+            candidates = np.flatnonzero((h & self._mask) == 0) + 1
+
+            start = 0
+            while True:
+                # The first candidate at or after the minimum size
+                i = np.searchsorted(candidates, start + self._min_size)
+                end = (
+                    int(candidates[i])
+                    if i < len(candidates)
+                    else len(pending) if eof else None
+                )
+                if end is None or end - start > self._max_size:
+                    if len(pending) - start < self._max_size and not eof:
+                        # Need more data to find the boundary
+                        break
+                    end = min(start + self._max_size, len(pending))
+                yield pending[start:end]
+                start = end
+                if start == len(pending):
+                    break
+
+            context = (context + pending[:start])[-_WINDOW:]
+            pending = pending[start:]
+            if eof:
+                if pending:
+                    yield pending
+                return
+
+
+class ChunkStore:
+    """Chunks in files named by their SHA256, with reference counts in SQLite.
+
+    Chunks with no reference left are only deleted by `collect_garbage`, which
+    must not run concurrently with puts.
+    """
+
+    INDEX_FILE_NAME = "INDEX.sqlite3"
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def connect(self) -> None:
+        os.makedirs(self._path, exist_ok=True)
+        self._conn = sqlite3.connect(
+            os.path.join(self._path, self.INDEX_FILE_NAME),
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS chunks (
+                digest TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                refcount INTEGER NOT NULL
+            )"""
+        )
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _chunk_path(self, digest: str) -> str:
+        return os.path.join(self._path, digest[0:2], digest[2:4], digest)
+
+    def has(self, digest: str) -> bool:
+        assert self._conn is not None, "Chunk store not connected"
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM chunks WHERE digest = ? AND refcount > 0", (digest,)
+            ).fetchone()
+        return row is not None
+
+    def write(self, digest: str, data: bytes) -> None:
+        """Write the file of a chunk. Not referenced until `add_refs`.
+
+        Chunks are plaintext: files put under EncFS do not go through the CAS
+        (see the module documentation).
+        """
+        path = self._chunk_path(digest)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Readers never see a partial chunk
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def read(self, digest: str) -> bytes:
+        with open(self._chunk_path(digest), "rb") as f:
+            return f.read()
+
+    def add_refs(self, chunks: List[Tuple[str, int]], delta: int = 1) -> None:
+        """Add `delta` references to each `(digest, size)`, in one transaction"""
+        assert self._conn is not None, "Chunk store not connected"
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    """INSERT INTO chunks VALUES (?, ?, ?)
+                    ON CONFLICT (digest) DO UPDATE SET refcount = refcount + ?""",
+                    ((d, s, delta, delta) for d, s in chunks),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def collect_garbage(self) -> int:
+        """Delete unreferenced chunks. Returns the number of bytes freed"""
+        assert self._conn is not None, "Chunk store not connected"
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT digest, size FROM chunks WHERE refcount <= 0"
+            ).fetchall()
+            for digest, _ in rows:
+                try:
+                    os.remove(self._chunk_path(digest))
+                except FileNotFoundError:
+                    pass
+            self._conn.executemany(
+                "DELETE FROM chunks WHERE digest = ?", ((d,) for d, _ in rows)
+            )
+        return sum(size for _, size in rows)
+
+    def stats(self) -> Dict[str, int]:
+        """Number and size of chunks, and size of the content referencing them"""
+        assert self._conn is not None, "Chunk store not connected"
+        with self._lock:
+            num, size, logical = self._conn.execute(
+                "SELECT COUNT(*), TOTAL(size), TOTAL(size * refcount) FROM chunks"
+            ).fetchone()
+        return {
+            "chunks": num,
+            "stored_bytes": int(size),
+            "logical_bytes": int(logical),
+        }
+
+
+class ContentAddressedStorage(BaseStorage):
+    """Deduplicates files put to `inner` (see the module documentation)"""
+
+    def __init__(
+        self, inner: BaseStorage, chunk_store: ChunkStore, chunker: Chunker
+    ) -> None:
+        super().__init__()
+        self._inner = inner
+        self._chunk_store = chunk_store
+        self._chunker = chunker
+
+    @property
+    def inner(self) -> BaseStorage:
+        return self._inner
+
+    def connect(self):
+        self._chunk_store.connect()
+        self._inner.connect()
+
+    def disconnect(self):
+        self._inner.disconnect()
+        self._chunk_store.close()
+
+    @staticmethod
+    def _is_encrypted() -> bool:
+        return cpp_coordinator.get_component_key() != ""
+
+    def _store_chunks(self, local_path: str) -> str:
+        """Store the chunks of a file. Returns the path of its manifest, a
+        temporary file
+        """
+        chunks: List[Tuple[str, int]] = []
+        new_bytes = dedup_bytes = 0
+        with open(local_path, "rb") as f:
+            for data in self._chunker.chunks(f):
+                digest = hashlib.sha256(data).hexdigest()
+                if self._chunk_store.has(digest):
+                    dedup_bytes += len(data)
+                else:
+                    self._chunk_store.write(digest, data)
+                    new_bytes += len(data)
+                chunks.append((digest, len(data)))
+        self._chunk_store.add_refs(chunks)
+
+        metrics.counter(
+            "seccask_cas_bytes_total", "Bytes put through the CAS", result="new"
+        ).inc(new_bytes)
+        metrics.counter(
+            "seccask_cas_bytes_total", "Bytes put through the CAS", result="dedup"
+        ).inc(dedup_bytes)
+        self.logger.debug(
+            "Stored %s in %d chunks: %d new bytes, %d deduplicated",
+            local_path,
+            len(chunks),
+            new_bytes,
+            dedup_bytes,
+        )
+
+        fd, manifest_path = tempfile.mkstemp(dir=env.temp_path, suffix=".cas")
+        with os.fdopen(fd, "wb") as f:
+            f.write(MANIFEST_MAGIC)
+            manifest = {"size": new_bytes + dedup_bytes, "chunks": chunks}
+            f.write(json.dumps(manifest).encode())
+        return manifest_path
+
+    def _put_files(self, local_paths: List[str], put):
+        """Store the chunks of files, then `put` their manifests"""
+        manifest_paths = []
+        try:
+            for local_path in local_paths:
+                manifest_paths.append(self._store_chunks(local_path))
+            return put(manifest_paths)
+        except BaseException:
+            # The versions were not stored, so their chunks are not referenced
+            for manifest_path in manifest_paths:
+                with open(manifest_path, "rb") as f:
+                    f.read(len(MANIFEST_MAGIC))
+                    chunks = json.load(f)["chunks"]
+                self._chunk_store.add_refs([tuple(c) for c in chunks], -1)
+            raise
+        finally:
+            for manifest_path in manifest_paths:
+                os.remove(manifest_path)
+
+    def _materialize(self, key: str, branch: Optional[str], path: str) -> str:
+        """Assemble the file of a manifest. Other files (stored before the CAS
+        was enabled) are returned as is
+        """
+        with open(path, "rb") as f:
+            if f.read(len(MANIFEST_MAGIC)) != MANIFEST_MAGIC:
+                return path
+            chunks = json.load(f)["chunks"]
+        # A copy made by the inner backend for this read
+        if not self._inner.is_stored_file(path):
+            os.remove(path)
+
+        local_file = os.path.join(env.temp_path, f"{key}-{branch}-{time.time()}")
+        with open(local_file, "wb") as f:
+            for digest, _ in chunks:
+                f.write(self._chunk_store.read(digest))
+        return local_file
+
+    def is_stored_file(self, path: str) -> bool:
+        # Files stored before the CAS was enabled are returned as is
+        return self._inner.is_stored_file(path)
+
+    @instrumented("get")
+    def get(
+        self,
+        key: str,
+        branch: str = None,
+        hversion: str = None,
+        dtype: TransferDType = TransferDType.STRING,
+    ):
+        ret, value = self._inner.get(
+            key=key, branch=branch, hversion=hversion, dtype=dtype
+        )
+        if dtype == TransferDType.FILE and value is not None:
+            value = self._materialize(key, branch, value)
+        return ret, value
+
+    @instrumented("put")
+    def put(self, key: str, branch: str, dtype: TransferDType, value: str):
+        if dtype != TransferDType.FILE or self._is_encrypted():
+            return self._inner.put(key=key, branch=branch, dtype=dtype, value=value)
+        return self._put_files(
+            [value],
+            lambda manifests: self._inner.put(
+                key=key, branch=branch, dtype=dtype, value=manifests[0]
+            ),
+        )
+
+    @instrumented_batch("get")
+    def multi_get(self, items: List[GetItem]) -> List[Tuple[str, Optional[str]]]:
+        results = self._inner.multi_get(items)
+        return [
+            (ret, self._materialize(i.key, i.branch, value))
+            if i.dtype == TransferDType.FILE and value is not None
+            else (ret, value)
+            for i, (ret, value) in zip(items, results)
+        ]
+
+    @instrumented_batch("put")
+    def multi_put(self, items: List[PutItem]) -> List[StorageReturn]:
+        """Chunks of all files first, then all items in one batch to `inner`"""
+        if self._is_encrypted():
+            return self._inner.multi_put(items)
+        files = [n for n, i in enumerate(items) if i.dtype == TransferDType.FILE]
+
+        def put(manifests: List[str]):
+            by_index = dict(zip(files, manifests))
+            return self._inner.multi_put(
+                [
+                    i._replace(value=by_index[n]) if n in by_index else i
+                    for n, i in enumerate(items)
+                ]
+            )
+
+        return self._put_files([items[n].value for n in files], put)
+
+    def merge(
+        self,
+        key: str,
+        head_branch: str,
+        merge_branch: str,
+        dtype: TransferDType,
+        value: str,
+    ):
+        def merge(value: str):
+            return self._inner.merge(
+                key=key,
+                head_branch=head_branch,
+                merge_branch=merge_branch,
+                dtype=dtype,
+                value=value,
+            )
+
+        if dtype != TransferDType.FILE or self._is_encrypted():
+            return merge(value)
+        return self._put_files([value], lambda manifests: merge(manifests[0]))
+
+    def list_key(self):
+        return self._inner.list_key()
+
+    def head(self, key: str, branch: str):
+        return self._inner.head(key, branch)
+
+    def branch(
+        self,
+        key: str,
+        new_branch: str,
+        based_on_branch: str = None,
+        refer_version: str = None,
+    ):
+        return self._inner.branch(key, new_branch, based_on_branch, refer_version)
+
+    def list_branch(self, key: str):
+        return self._inner.list_branch(key)
+
+    def meta(self, key: str, version: str = None, branch: str = None):
+        return self._inner.meta(key, version, branch)
+
+    def lineage(self, key: str, version: str = None, branch: str = None):
+        return self._inner.lineage(key, version, branch)
+
+    def collect_garbage(self) -> int:
+        return self._chunk_store.collect_garbage()
+
+    def stats(self) -> Dict[str, int]:
+        return self._chunk_store.stats()
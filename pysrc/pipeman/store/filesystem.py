@@ -1,19 +1,40 @@
+import fcntl
 import hashlib
 import os
+import stat
 import time
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 from pipeman.env import env
 from pipeman.config import default_config as conf
+from pipeman.store.fsindex import FileSystemIndex, IndexEntry
 from pipeman.store.base_storage import (
     BaseStorage,
     StorageReturn,
     TransferDType,
+    instrumented,
 )
 
 # Below module is created from pybind11 and thus have no source
 import cpp_coordinator  # type: ignore
 
+# From linux/fs.h
+_FICLONE = 0x40049409
+
+
+def _clone_file(src: str, dst: str) -> bool:
+    """Copy-on-write clone of `src` (a reflink). False if the file system
+    does not support it
+    """
+    try:
+        with open(src, "rb") as rf, open(dst, "wb") as wf:
+            fcntl.ioctl(wf.fileno(), _FICLONE, rf.fileno())
+        return True
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+
 
 class FileSystemStorage(BaseStorage):
     """FileSystem storage subsystem.
@@ -21,6 +42,12 @@ class FileSystemStorage(BaseStorage):
     This is a storage subsystem purely using file system as its physical
     storage. It manipulates files to store components and some metadata, plus
     uses directory hierarchy to include metainfo (component name, branch, etc.)
+
+    Versions are stored at `<key dir>/<branch>/<hversion>`. In the sharded
+    layout, the directory of a key is `<h[0:2]>/<h[2:4]>/<key>`, where `h` is
+    the SHA256 of the key, so that no directory gets too many entries. Where
+    each version is stored, and the head of each branch, are looked up in a
+    `FileSystemIndex`.
     """
 
     CONFIG_SECTION = "storage_filesystem"
@@ -28,6 +55,10 @@ class FileSystemStorage(BaseStorage):
     CHUNKSIZE = int(conf.get(CONFIG_SECTION, "chunk_size"))
     GENERIC_FILE_NAME = conf.get(CONFIG_SECTION, "generic_file_name")
     PREFIX = conf.get(CONFIG_SECTION, "prefix")
+    LAYOUT = conf.get(CONFIG_SECTION, "layout")
+    INDEX_FILE_NAME = conf.get(CONFIG_SECTION, "index_file_name")
+    READ_MODE = conf.get(CONFIG_SECTION, "read_mode")
+    HEAD_FILE_NAME = "@HEAD"
 
     def __init__(self, base_path: str = "SecCask") -> None:
         """Create a new file system storage
@@ -37,18 +68,75 @@ class FileSystemStorage(BaseStorage):
         """
         super().__init__()
         self.base_path = os.path.join(self.PREFIX, base_path)
+        self._index = FileSystemIndex(
+            os.path.join(self.base_path, self.INDEX_FILE_NAME)
+        )
 
     def connect(self):
         self._check_or_create_dir(self.base_path)
+        self._index.connect()
+        # A put interrupted between writing `@HEAD` and indexing leaves pending
+        if (
+            self._index.is_empty()
+            or self._index.is_outdated
+            or self._index.has_pending()
+        ):
+            self.rebuild_index()
+
+    def rebuild_index(self) -> None:
+        """Index all versions found on disk, in either layout. If a branch is
+        in both, its head is read from the configured layout, which is the one
+        written to since the layout changed
+        """
+        versions = []
+        heads: Dict[Tuple[str, str], str] = {}
+        for dirpath, dirnames, filenames in os.walk(self.base_path):
+            if self.HEAD_FILE_NAME not in filenames:
+                continue
+            # A branch directory: `<key dir>/<branch>`
+            branch = os.path.basename(dirpath)
+            key = os.path.basename(os.path.dirname(dirpath))
+            for hversion in dirnames:
+                version_dir = os.path.join(dirpath, hversion)
+                entry = IndexEntry(key, branch, version_dir)
+                versions.append((hversion, entry, self._read_parents(version_dir)))
+            is_current = os.path.abspath(dirpath) == self._get_path_from_branch(
+                key, branch
+            )
+            if is_current or (key, branch) not in heads:
+                with open(os.path.join(dirpath, self.HEAD_FILE_NAME), "r") as f:
+                    heads[(key, branch)] = f.read()
+            # Versions have no subdirectories to index
+            dirnames.clear()
+
+        self._index.clear()
+        self._index.add_versions(
+            versions, ((k, b, h) for (k, b), h in heads.items())
+        )
+        self._index.mark_current()
+        self.logger.info(
+            "Indexed %d versions of %d branches in %s",
+            len(versions),
+            len(heads),
+            self.base_path,
+        )
+
+    def _read_parents(self, version_dir: str) -> List[str]:
+        try:
+            with open(os.path.join(version_dir, self.PARENTS_FILE_NAME), "r") as f:
+                content = f.read()
+        except FileNotFoundError:
+            return []
+        return [] if content == "<null>" else content.split(",")
 
     def _check_or_create_dir(self, abspath: str):
         if not os.path.exists(abspath):
             os.makedirs(abspath, exist_ok=True)
 
     def disconnect(self):
-        """Do nothing"""
-        pass
+        self._index.close()
 
+    @instrumented("get")
     def get(
         self,
         key: str,
@@ -71,18 +159,21 @@ class FileSystemStorage(BaseStorage):
         file_path = os.path.join(file_path, self.GENERIC_FILE_NAME)
 
         if dtype == TransferDType.FILE:
+            if self.READ_MODE == "direct":
+                # Stored files are read-only, and callers only read them
+                return None, file_path
+
             # set a temporary file on remote server
             remote_file = "{}-{}-{}".format(key, branch, time.time())
             local_file = os.path.join(env.temp_path, remote_file)
 
-            with open(file_path, "rb") as rf:
-                with open(local_file, "wb") as wf:
-                    while True:
-                        chunk = rf.read(self.CHUNKSIZE)
-                        if not chunk:
-                            break
-
-                        wf.write(chunk)
+            # A clone would keep the ciphertext of EncFS, bound to the stored file
+            if not (
+                self.READ_MODE == "reflink"
+                and cpp_coordinator.get_component_key() == ""
+                and _clone_file(file_path, local_file)
+            ):
+                self._copy_file(file_path, local_file)
 
             if start_time is not None:
                 self.logger.debug(
@@ -100,6 +191,20 @@ class FileSystemStorage(BaseStorage):
                 )
             return None, content
 
+    def is_stored_file(self, path: str) -> bool:
+        base_path = os.path.abspath(self.base_path) + os.sep
+        return os.path.abspath(path).startswith(base_path)
+
+    def _copy_file(self, src: str, dst: str) -> None:
+        with open(src, "rb") as rf:
+            with open(dst, "wb") as wf:
+                while True:
+                    chunk = rf.read(self.CHUNKSIZE)
+                    if not chunk:
+                        break
+
+                    wf.write(chunk)
+
     def _get_file_path(
         self,
         key: str,
@@ -115,38 +220,51 @@ class FileSystemStorage(BaseStorage):
             raise ValueError("Not specifying one of branch and hversion")
         return result
 
+    def _get_key_dir(self, key: str) -> str:
+        if self.LAYOUT == "flat":
+            return os.path.abspath(os.path.join(self.base_path, key))
+        h = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.abspath(os.path.join(self.base_path, h[0:2], h[2:4], key))
+
     def _get_path_from_branch(self, key: str, branch: str) -> str:
-        return os.path.abspath(os.path.join(self.base_path, key, branch))
+        return os.path.join(self._get_key_dir(key), branch)
 
     def _get_head_path_from_branch(self, key: str, branch: str) -> Union[str, None]:
         head_version = self._get_head_version(key, branch)
         if head_version is None:
             return None
         else:
-            return os.path.join(self._get_path_from_branch(key, branch), head_version)
+            return self._get_path_from_hashed_version(key, head_version)
 
-    def _get_path_from_hashed_version(self, key: str, hversion: str) -> str:
-        for branch in self.list_branch(key):
-            if os.path.exists(os.path.join(self.base_path, key, branch, hversion)):
-                return os.path.join(self._get_path_from_branch(key, branch), hversion)
-
-        return ""
-
-    def _get_head_version(self, key: str, branch: str) -> Union[str, None]:
-        file_path = os.path.join(self._get_path_from_branch(key, branch), "@HEAD")
-        if not os.path.exists(file_path):
+    def _get_path_from_hashed_version(self, key: str, hversion: str) -> Optional[str]:
+        entry = self._index.lookup(hversion)
+        if entry is None or entry.key != key:
             return None
+        return entry.path
 
-        with open(file_path, "r") as f:
-            content = f.read()
-        return content
+    def _get_head_version(self, key: str, branch: str) -> Union[str, None]:
+        return self._index.head(key, branch)
 
-    def _set_head_version(self, key: str, branch: str, hversion: str) -> None:
+    def _set_head_version(
+        self,
+        key: str,
+        branch: str,
+        hversion: str,
+        version_dir: str,
+        parents: List[str],
+    ) -> None:
+        # The head file is only read to rebuild the index
+        self._index.begin_version(hversion)
         with open(
-            os.path.join(self._get_path_from_branch(key, branch), "@HEAD"), "w"
+            os.path.join(self._get_path_from_branch(key, branch), self.HEAD_FILE_NAME),
+            "w",
         ) as f:
             f.write(hversion)
+        self._index.add_version(
+            hversion, IndexEntry(key, branch, version_dir), parents
+        )
 
+    @instrumented("put")
     def put(self, key: str, branch: str, dtype: TransferDType, value: str):
         start_time: Union[float, None] = None
         if conf.getboolean("log", "log_filesystem_storage"):
@@ -189,7 +307,10 @@ class FileSystemStorage(BaseStorage):
         # Move file to correct directory (with hashed version)
         new_dir = os.path.join(os.path.dirname(remote_file_path), hversion)
         self._check_or_create_dir(new_dir)
-        os.rename(remote_file_path, os.path.join(new_dir, self.GENERIC_FILE_NAME))
+        new_file_path = os.path.join(new_dir, self.GENERIC_FILE_NAME)
+        os.rename(remote_file_path, new_file_path)
+        # Versions are immutable, and may be handed out as is by `get`
+        os.chmod(new_file_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
 
         # Move HASH file to destination (Enabled when EncFS is used)
         component_key = cpp_coordinator.get_component_key()
@@ -201,14 +322,12 @@ class FileSystemStorage(BaseStorage):
 
         # Write parents to PARENTS_FILE_NAME
         current_head = self._get_head_version(key, branch)
+        parents = [current_head] if current_head is not None else []
         with open(os.path.join(new_dir, self.PARENTS_FILE_NAME), "w") as f:
-            if current_head is not None:
-                f.write(current_head)
-            else:
-                f.write("<null>")
+            f.write(",".join(parents) if parents else "<null>")
 
         # Shift branch HEAD
-        self._set_head_version(key, branch, hversion)
+        self._set_head_version(key, branch, hversion, new_dir, parents)
 
         ret = StorageReturn()
         ret.values["Version"] = hversion
@@ -221,7 +340,9 @@ class FileSystemStorage(BaseStorage):
         return ret
 
     def list_key(self):
-        return [f.path for f in os.scandir(self.base_path) if f.is_dir()]
+        ret = StorageReturn()
+        ret.values = self._index.keys()
+        return ret
 
     def head(self, key: str, branch: str):
         ret = StorageReturn()
@@ -237,24 +358,38 @@ class FileSystemStorage(BaseStorage):
     ):
         raise NotImplementedError()
 
-    def list_branch(self, key: str) -> List[str]:
-        key_dir = os.path.abspath(os.path.join(self.base_path, key))
-        return [f.path for f in os.scandir(key_dir) if f.is_dir()]
+    def list_branch(self, key: str):
+        ret = StorageReturn()
+        ret.values = self._index.branches(key)
+        return ret
 
-    def meta(self, key: str, version: str = None, branch: str = None):
-        start_time: Union[float, None] = None
-        if conf.getboolean("log", "log_filesystem_storage"):
-            start_time = time.time()
+    def _resolve_version(
+        self, key: str, version: Optional[str], branch: Optional[str]
+    ) -> Optional[str]:
+        if version is not None:
+            entry = self._index.lookup(version)
+            return version if entry is not None and entry.key == key else None
+        elif branch is not None:
+            return self._get_head_version(key, branch)
+        else:
+            raise ValueError("Not specifying one of branch and hversion")
 
-        file_path = self._get_file_path(key, branch, version)
-        if file_path is None:
-            if start_time is not None:
-                self.logger.debug(
-                    f"[TIME: {time.time() - start_time}] Get [{key}]::[{branch}] failed"
-                )
-            return None, None
+    def meta(self, key: str, version: str = None, branch: str = None):
+        """`values` are the parents of the version, None if it has none (or
+        does not exist)
+        """
+        ret = StorageReturn()
+        hversion = self._resolve_version(key, version, branch)
+        parents = self._index.parents(hversion) if hversion is not None else []
+        ret.values = parents if parents else None
+        return ret
 
-        file_path = os.path.join(file_path, self.PARENTS_FILE_NAME)
+    def lineage(self, key: str, version: str = None, branch: str = None):
+        ret = StorageReturn()
+        hversion = self._resolve_version(key, version, branch)
+        if hversion is not None:
+            ret.values = self._index.lineage(hversion)
+        return ret
 
     def merge(
         self,
@@ -0,0 +1,197 @@
+"""Index of `FileSystemStorage`, kept in SQLite next to the stored data.
+
+Maps each hashed version to where it is stored and to its parents, and each
+branch to its head, so that lookups do not scan directories or read `@HEAD`
+and `PARENTS` files, whatever the number of keys and branches. The directories stay the source of truth: the
+index can be rebuilt from them (see `FileSystemStorage.rebuild_index`).
+"""
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from pipeman.store.base_storage import order_lineage
+
+
+class IndexEntry(NamedTuple):
+    key: str
+    branch: str
+    path: str
+    """Directory of the version"""
+
+
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS versions (
+        hversion TEXT PRIMARY KEY,
+        key TEXT NOT NULL,
+        branch TEXT NOT NULL,
+        path TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS heads (
+        key TEXT NOT NULL,
+        branch TEXT NOT NULL,
+        hversion TEXT NOT NULL,
+        PRIMARY KEY (key, branch)
+    )""",
+    """CREATE TABLE IF NOT EXISTS parents (
+        hversion TEXT NOT NULL,
+        parent TEXT NOT NULL,
+        ord INTEGER NOT NULL,
+        PRIMARY KEY (hversion, ord)
+    )""",
+    # Versions being put. Left behind by a crash, they mean that the
+    # directories are ahead of the index
+    """CREATE TABLE IF NOT EXISTS pending (
+        hversion TEXT PRIMARY KEY
+    )""",
+)
+SCHEMA_VERSION = 2
+"""Indexes of older versions miss data, and must be rebuilt"""
+
+
+class FileSystemIndex:
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        # Storage calls may come from several trial managers
+        self._lock = threading.Lock()
+
+    def connect(self) -> None:
+        self._conn = sqlite3.connect(
+            self._path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in _SCHEMA:
+            self._conn.execute(statement)
+
+    @property
+    def is_outdated(self) -> bool:
+        return self._query("PRAGMA user_version")[0][0] < SCHEMA_VERSION
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _query(self, sql: str, params: tuple = ()) -> list:
+        assert self._conn is not None, "Index not connected"
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def is_empty(self) -> bool:
+        return not self._query("SELECT 1 FROM heads LIMIT 1")
+
+    def has_pending(self) -> bool:
+        return bool(self._query("SELECT 1 FROM pending LIMIT 1"))
+
+    def begin_version(self, hversion: str) -> None:
+        """Record that `hversion` is about to be written to the directories.
+        Cleared when it is added
+        """
+        self._query("INSERT OR REPLACE INTO pending VALUES (?)", (hversion,))
+
+    def lookup(self, hversion: str) -> Optional[IndexEntry]:
+        rows = self._query(
+            "SELECT key, branch, path FROM versions WHERE hversion = ?", (hversion,)
+        )
+        return IndexEntry(*rows[0]) if rows else None
+
+    def head(self, key: str, branch: str) -> Optional[str]:
+        rows = self._query(
+            "SELECT hversion FROM heads WHERE key = ? AND branch = ?", (key, branch)
+        )
+        return rows[0][0] if rows else None
+
+    def keys(self) -> List[str]:
+        return [r[0] for r in self._query("SELECT DISTINCT key FROM heads")]
+
+    def branches(self, key: str) -> List[str]:
+        return [
+            r[0] for r in self._query("SELECT branch FROM heads WHERE key = ?", (key,))
+        ]
+
+    def parents(self, hversion: str) -> List[str]:
+        return [
+            r[0]
+            for r in self._query(
+                "SELECT parent FROM parents WHERE hversion = ? ORDER BY ord",
+                (hversion,),
+            )
+        ]
+
+    def lineage(self, hversion: str) -> Dict[str, List[str]]:
+        """Parents of `hversion` and of all its ancestors, in one query.
+
+        Returns:
+            Parents by version, in breadth-first order from `hversion`
+        """
+        rows = self._query(
+            """WITH RECURSIVE ancestors(hversion) AS (
+                SELECT ?
+                UNION
+                SELECT p.parent FROM parents p
+                JOIN ancestors a ON p.hversion = a.hversion
+            )
+            SELECT a.hversion, p.parent FROM ancestors a
+            LEFT JOIN parents p ON p.hversion = a.hversion
+            ORDER BY a.hversion, p.ord""",
+            (hversion,),
+        )
+        return order_lineage(hversion, rows)
+
+    def add_version(self, hversion: str, entry: IndexEntry, parents: List[str]) -> None:
+        """Record a new version and make it the head of its branch"""
+        self.add_versions(
+            [(hversion, entry, parents)], [(entry.key, entry.branch, hversion)]
+        )
+
+    def add_versions(
+        self,
+        versions: Iterable[Tuple[str, IndexEntry, List[str]]],
+        heads: Iterable[Tuple[str, str, str]],
+    ) -> None:
+        """Record `(hversion, IndexEntry, parents)` and `(key, branch, hversion)`
+        (heads) in one transaction
+        """
+        assert self._conn is not None, "Index not connected"
+        versions = list(versions)
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO versions VALUES (?, ?, ?, ?)",
+                    ((h, *e) for h, e, _ in versions),
+                )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO parents VALUES (?, ?, ?)",
+                    (
+                        (h, parent, i)
+                        for h, _, parents in versions
+                        for i, parent in enumerate(parents)
+                    ),
+                )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO heads VALUES (?, ?, ?)", heads
+                )
+                self._conn.executemany(
+                    "DELETE FROM pending WHERE hversion = ?",
+                    ((h,) for h, _, _ in versions),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def clear(self) -> None:
+        assert self._conn is not None, "Index not connected"
+        with self._lock:
+            self._conn.execute("DELETE FROM versions")
+            self._conn.execute("DELETE FROM heads")
+            self._conn.execute("DELETE FROM parents")
+            self._conn.execute("DELETE FROM pending")
+
+    def mark_current(self) -> None:
+        """Mark the index as complete for this schema version"""
+        assert self._conn is not None, "Index not connected"
+        with self._lock:
+            self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
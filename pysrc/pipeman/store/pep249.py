@@ -1,8 +1,21 @@
 import hashlib
 import os
+import shutil
 import threading
 import time
-from typing import List, Union
+from contextlib import contextmanager
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 
 # replace this with other DB client if necessary
@@ -12,59 +25,195 @@ from mysql.connector.errors import Error
 from pipeman.config import default_config as conf
 from pipeman.store.base_storage import (
     BaseStorage,
+    GetItem,
+    PutItem,
     StorageReturn,
     TransferDType,
+    instrumented_batch,
+    order_lineage,
+    resolve_value,
+)
+from pipeman.store.pep249_schema import (
+    check_branch,
+    create_shared,
+    key_hash,
+    key_prefix,
 )
 from pipeman.utils import LogUtils
 
 
-class ConnectionPool:
-    def __init__(self) -> None:
-        super().__init__()
-        self.logger = LogUtils.get_default_named_logger(type(self).__name__)
-        self._objs = {}
-        self._lock = threading.Lock()
-
-    def connect(self, obj):
-        conn_id = self._make_conn_id(obj.host, obj.port, obj.user)
+def _escape_like(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _match_pairs(column_a: str, column_b: str, n: int) -> str:
+    """Condition matching any of `n` pairs of parameters"""
+    return " OR ".join([f"({column_a} = %s AND {column_b} = %s)"] * n)
+
+
+class _Tables(NamedTuple):
+    """Names of the tables and columns of a schema version"""
+
+    blobs: str
+    b_key: str
+    b_hversion: str
+    b_branch: str
+    b_value: str
+    head: str
+    h_key: str
+    h_branch: str
+    h_hversion: str
+
+
+_TABLES = {
+    1: _Tables(
+        "blobstore",
+        "bs_key",
+        "bs_hversion",
+        "bs_branch",
+        "bs_blob_value",
+        "head",
+        "h_key",
+        "h_branch",
+        "h_hversion",
+    ),
+    # Keys are hashed. See `pep249_schema`
+    2: _Tables(
+        "blobs",
+        "b_key_hash",
+        "b_hversion",
+        "b_branch",
+        "b_blob_value",
+        "heads",
+        "h_key_hash",
+        "h_branch",
+        "h_hversion",
+    ),
+}
 
-        self._lock.acquire()
 
-        if conn_id in self._objs:
-            self.logger.debug(
-                "[ConnectionPool] {} exists. Directly returned".format(conn_id)
-            )
-        else:
-            self.logger.debug("[ConnectionPool] {} not exist. Creating".format(conn_id))
-            obj._do_connect()
-            self.logger.debug("[ConnectionPool] {} created".format(conn_id))
-
-            self._objs[conn_id] = obj
-
-        self._lock.release()
-
-        return self._objs[conn_id]
-
-    def disconnect(self, obj):
-        conn_id = self._make_conn_id(obj.host, obj.port, obj.user)
+class ConnectionPool:
+    """Up to `size` connections to one database, each used by one thread at a
+    time (cursors of a connection are not thread-safe).
 
-        self._lock.acquire()
+    A thread checks out a connection with `checkout`. Nested checkouts by the
+    same thread get the same connection, so that a transaction spans them.
+    Connections idle for longer than `check_interval` seconds are pinged
+    before reuse, and replaced if broken.
+    """
 
-        if conn_id in self._objs:
-            self.logger.debug("[ConnectionPool] {} closing".format(conn_id))
-            self._objs[conn_id]._do_disconnect()
-            self._objs[conn_id] = None
-        else:
-            # Do nothing. Or you can log this unusual behavior
+    def __init__(
+        self, name: str, factory: Callable[[], Any], size: int, check_interval: float
+    ) -> None:
+        self.logger = LogUtils.get_default_named_logger(type(self).__name__)
+        self._name = name
+        self._factory = factory
+        self._size = size
+        self._check_interval = check_interval
+        self._cond = threading.Condition()
+        self._idle: List[Tuple[Any, float]] = []
+        """Connections not checked out, with their last use"""
+        self._num_open = 0
+        self._local = threading.local()
+
+    @contextmanager
+    def checkout(self) -> Iterator[Any]:
+        held = getattr(self._local, "conn", None)
+        if held is not None:
+            yield held
+            return
+
+        conn = self._acquire()
+        self._local.conn = conn
+        broken = False
+        try:
+            yield conn
+        except Error:
+            broken = not self._is_healthy(conn)
+            raise
+        except BaseException:
+            # E.g., with unread results. The state of the connection is unknown
+            broken = True
+            raise
+        finally:
+            self._local.conn = None
+            self._release(conn, broken)
+
+    def _acquire(self) -> Any:
+        with self._cond:
+            while not self._idle and self._num_open >= self._size:
+                self._cond.wait()
+            if self._idle:
+                conn, last_used = self._idle.pop()
+            else:
+                conn, last_used = None, 0.0
+                self._num_open += 1
+
+        if conn is not None:
+            if time.monotonic() - last_used < self._check_interval:
+                return conn
+            if self._is_healthy(conn):
+                return conn
+            self.logger.warning(f"[ConnectionPool] {self._name}: replacing broken")
+            self._close(conn)
+
+        try:
+            conn = self._factory()
+        except BaseException:
+            with self._cond:
+                self._num_open -= 1
+                self._cond.notify()
+            raise
+        self.logger.debug(f"[ConnectionPool] {self._name}: connection opened")
+        return conn
+
+    def _release(self, conn: Any, broken: bool) -> None:
+        if broken:
+            self._close(conn)
+        with self._cond:
+            if broken:
+                self._num_open -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @staticmethod
+    def _is_healthy(conn: Any) -> bool:
+        try:
+            return conn.is_connected()
+        except Error:
+            return False
+
+    @staticmethod
+    def _close(conn: Any) -> None:
+        try:
+            conn.close()
+        except Error:
             pass
 
-        self._lock.release()
+    def close(self) -> None:
+        """Close idle connections. Checked out ones are closed on return"""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._num_open -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close(conn)
+
 
-    def _make_conn_id(self, host, port, user):
-        return f"{user}@{host}:{port}"
+_pools: Dict[str, ConnectionPool] = {}
+"""Shared by storages connecting as the same user@host:port"""
+_pools_lock = threading.Lock()
 
 
-pool = ConnectionPool()
+def get_pool(obj: "PEP249Storage") -> ConnectionPool:
+    conn_id = f"{obj.user}@{obj.host}:{obj.port}"
+    with _pools_lock:
+        if conn_id not in _pools:
+            _pools[conn_id] = ConnectionPool(
+                conn_id, obj._do_connect, obj.pool_size, obj.pool_check_interval
+            )
+        return _pools[conn_id]
 
 
 class PEP249Storage(BaseStorage):
@@ -75,7 +224,8 @@ class PEP249Storage(BaseStorage):
     as its physical storage. 
 
     NOTE: DBMS is required to create a database called `seccask`, and create 
-    tables using the following SQL query:
+    tables using the following SQL query (`blobparts` and `parents` are
+    created on connect if missing):
 
     CREATE TABLE blobstore (
         bs_key LONGTEXT,
@@ -84,11 +234,34 @@ class PEP249Storage(BaseStorage):
         bs_blob_value LONGBLOB
     );
 
+    CREATE TABLE blobparts (
+        bp_hversion CHAR(64),
+        bp_seq INT,
+        bp_data LONGBLOB,
+        PRIMARY KEY (bp_hversion, bp_seq)
+    );
+
     CREATE TABLE head (
         h_key LONGTEXT,
         h_branch LONGTEXT,
         h_hversion CHAR(64)
     );
+
+    CREATE TABLE parents (
+        p_hversion CHAR(64),
+        p_parent CHAR(64),
+        p_ord INT,
+        PRIMARY KEY (p_hversion, p_ord),
+        INDEX (p_parent)
+    );
+
+    Blobs are stored in parts of at most `part_size` Bytes (`blobparts`), so
+    that neither side holds a whole blob in memory. `bs_blob_value` is NULL
+    then; blobs stored before parts are still read from it.
+
+    These tables are schema v1. With `schema_version=2`, `blobstore` and
+    `head` are replaced by indexed tables, see `pep249_schema` (which also
+    migrates from v1).
     """
 
     # TODO: Moved to dedicated config file
@@ -105,7 +278,19 @@ class PEP249Storage(BaseStorage):
         password: Union[str, None] = None,
         ssl_cert: Union[str, None] = None,
         ssl_key: Union[str, None] = None,
+        pool_size: int = 4,
+        pool_check_interval: float = 30.0,
+        part_size: int = 1048576,
+        schema_version: int = 1,
     ) -> None:
+        """
+        Args:
+            pool_size: connections open at most, shared by threads
+            pool_check_interval: ping connections idle for longer (in seconds)
+            part_size: Bytes of each stored part of a blob. Must be below
+                `max_allowed_packet` of the DBMS
+            schema_version: 1 or 2, see `pep249_schema`
+        """
         super().__init__()
         self.user = user
         self.host = host
@@ -113,10 +298,19 @@ class PEP249Storage(BaseStorage):
         self.password = password
         self.ssl_cert = ssl_cert
         self.ssl_key = ssl_key
+        self.pool_size = pool_size
+        self.pool_check_interval = pool_check_interval
+        self.part_size = part_size
+        if schema_version not in _TABLES:
+            raise ValueError(f"Unknown schema version {schema_version}")
+        self.schema_version = schema_version
+        self._tables = _TABLES[schema_version]
         self.is_connected = False
 
     def connect(self) -> BaseStorage:
-        self.conn = pool.connect(self).conn
+        self._pool = get_pool(self)
+        with self._pool.checkout() as conn:
+            create_shared(conn)
         self.is_connected = True
         return self
 
@@ -126,7 +320,7 @@ class PEP249Storage(BaseStorage):
 
     def _do_connect(self):
         if self.password is not None:
-            self.conn = connector.connect(
+            return connector.connect(
                 host=self.host,
                 port=self.port,
                 database=self.DATABASE_NAME,
@@ -135,7 +329,7 @@ class PEP249Storage(BaseStorage):
                 autocommit=True,
             )
         elif self.ssl_cert is not None and self.ssl_key is not None:
-            self.conn = connector.connect(
+            return connector.connect(
                 host=self.host,
                 port=self.port,
                 database=self.DATABASE_NAME,
@@ -153,11 +347,32 @@ class PEP249Storage(BaseStorage):
         """Not proper to do any close-connection stuff before refactoring the 
         whole storage procedure
         """
-        # pool.disconnect(self)
+        # self._pool.close()
         pass
 
-    def _do_disconnect(self):
-        self.conn.close()
+    def _key_id(self, key: str) -> str:
+        """Key as stored in the key columns"""
+        return key if self.schema_version == 1 else key_hash(key)
+
+    def _query(self, sql: str, params: tuple = ()) -> list:
+        with self._pool.checkout() as conn:
+            cursor = conn.cursor(buffered=True)
+            try:
+                cursor.execute(sql, params)
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[Any]:
+        with self._pool.checkout() as conn:
+            conn.start_transaction()
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
 
     def get(
         self,
@@ -166,127 +381,301 @@ class PEP249Storage(BaseStorage):
         hversion: str = None,
         dtype: TransferDType = TransferDType.STRING,
     ):
-        self._check_and_connect()
-
-        if hversion is not None:
-            pass
-        elif branch is not None:
-            try_hversion = self._get_head_version(key, branch)
-            if try_hversion is None:
-                return None, None
-            hversion = try_hversion
-        else:
-            raise ValueError("Not specifying one of branch and hversion")
-
-        sql = (
-            "SELECT bs_blob_value FROM blobstore WHERE bs_key = %s AND bs_hversion = %s"
-        )
-        cursor = self.conn.cursor(buffered=True)
-        cursor.execute(sql, (key, hversion))
-
-        if cursor.rowcount == 0:
-            return None, None
-
-        row = cursor.fetchall()[0]
-        cursor.close()
+        return self.multi_get([GetItem(key, branch, hversion, dtype)])[0]
 
-        # set a temporary file on remote server
-        file_path = os.path.join(self.TEMP_PATH, f"{time.time()}-{key}-{branch}")
+    @instrumented_batch("get")
+    def multi_get(self, items: List[GetItem]) -> List[Tuple[str, Optional[str]]]:
+        """Heads, then blobs, of all items in three queries"""
+        self._check_and_connect()
 
-        with open(file_path, "wb") as f:
-            f.write(row[0])
+        for i in items:
+            if i.hversion is None and i.branch is None:
+                raise ValueError("Not specifying one of branch and hversion")
 
-        self.logger.debug(f"Get [{key}]::[{branch}] from dir: {file_path}")
+        with self._pool.checkout():
+            heads = self._get_head_versions(
+                [(i.key, i.branch) for i in items if i.hversion is None]
+            )
+            versions = [
+                (i.key, i.hversion or heads.get((i.key, i.branch))) for i in items
+            ]
+            found = self._find_blobs({v for v in versions if v[1] is not None})
+
+            # set temporary files on remote server
+            file_paths: Dict[Tuple[str, str], str] = {}
+            for i, version in zip(items, versions):
+                if version in found and version not in file_paths:
+                    file_paths[version] = os.path.join(
+                        self.TEMP_PATH, f"{time.time()}-{i.key}-{i.branch}"
+                    )
+            self._read_blobs(
+                {v: p for v, p in file_paths.items() if found[v]},
+                {v: p for v, p in file_paths.items() if not found[v]},
+            )
 
-        if dtype == TransferDType.FILE:
-            return None, file_path
+        results = []
+        returned = set()
+        for i, version in zip(items, versions):
+            if version not in file_paths:
+                results.append((None, None))
+                continue
+
+            file_path = file_paths[version]
+            if file_path in returned:
+                # Each caller owns its file
+                copy_path = f"{file_path}-{len(returned)}"
+                shutil.copyfile(file_path, copy_path)
+                file_path = copy_path
+            returned.add(file_path)
+            self.logger.debug(f"Get [{i.key}]::[{i.branch}] from dir: {file_path}")
+
+            if i.dtype == TransferDType.FILE:
+                results.append((None, file_path))
+            elif i.dtype == TransferDType.STRING:
+                with open(file_path, "r") as f:
+                    results.append((None, f.read()))
+        return results
+
+    def _find_blobs(
+        self, versions: Set[Tuple[str, str]]
+    ) -> Dict[Tuple[str, str], bool]:
+        """Stored ones of `(key, hversion)`, and whether they are in parts"""
+        if not versions:
+            return {}
+        t = self._tables
+        by_id = {(self._key_id(k), h): (k, h) for k, h in versions}
+        rows = self._query(
+            f"SELECT {t.b_key}, {t.b_hversion}, {t.b_value} IS NULL FROM {t.blobs} "
+            + "WHERE "
+            + _match_pairs(t.b_key, t.b_hversion, len(by_id)),
+            tuple(x for v in by_id for x in v),
+        )
+        return {by_id[(k, h)]: bool(in_parts) for k, h, in_parts in rows}
 
-        elif dtype == TransferDType.STRING:
-            with open(file_path, "r") as f:
-                content = f.read()
-            return None, content
+    def _read_blobs(
+        self,
+        in_parts: Dict[Tuple[str, str], str],
+        whole: Dict[Tuple[str, str], str],
+    ) -> None:
+        """Write blobs to the files by `(key, hversion)`"""
+        if in_parts:
+            files = {h: p for (_, h), p in in_parts.items()}
+            sql = (
+                "SELECT bp_hversion, bp_data FROM blobparts WHERE bp_hversion IN ("
+                + ", ".join(["%s"] * len(files))
+                + ") ORDER BY bp_hversion, bp_seq"
+            )
+            for path in files.values():
+                # Blobs of no parts are empty
+                open(path, "wb").close()
+            with self._pool.checkout() as conn:
+                # Unbuffered, so that parts are received one at a time
+                cursor = conn.cursor()
+                f, current = None, None
+                try:
+                    cursor.execute(sql, tuple(files))
+                    for hversion, data in cursor:
+                        if hversion != current:
+                            if f is not None:
+                                f.close()
+                            f, current = open(files[hversion], "wb"), hversion
+                        f.write(data)
+                finally:
+                    if f is not None:
+                        f.close()
+                    cursor.close()
+
+        if whole:
+            # Stored before parts
+            t = self._tables
+            by_id = {(self._key_id(k), h): path for (k, h), path in whole.items()}
+            rows = self._query(
+                f"SELECT {t.b_key}, {t.b_hversion}, {t.b_value} FROM {t.blobs} WHERE "
+                + _match_pairs(t.b_key, t.b_hversion, len(by_id)),
+                tuple(x for v in by_id for x in v),
+            )
+            for k, h, value in rows:
+                with open(by_id[(k, h)], "wb") as f:
+                    f.write(value)
+
+    def _get_head_versions(
+        self, branches: List[Tuple[str, str]], for_update: bool = False
+    ) -> Dict[Tuple[str, str], str]:
+        """Heads of `(key, branch)`, if any. `for_update` locks them until the
+        end of the transaction
+        """
+        if not branches:
+            return {}
+        t = self._tables
+        by_id = {(self._key_id(k), b): (k, b) for k, b in branches}
+        sql = (
+            f"SELECT {t.h_key}, {t.h_branch}, {t.h_hversion} FROM {t.head} WHERE "
+            + _match_pairs(t.h_key, t.h_branch, len(by_id))
+        )
+        if for_update:
+            sql += " FOR UPDATE"
+        rows = self._query(sql, tuple(x for b in by_id for x in b))
+        return {by_id[(k, b)]: h for k, b, h in rows}
 
     def _get_head_version(self, key: str, branch: str) -> Union[str, None]:
-        sql = "SELECT h_hversion FROM head WHERE h_key = %s AND h_branch = %s"
-        cursor = self.conn.cursor(buffered=True)
-        cursor.execute(sql, (key, branch))
-
-        if cursor.rowcount == 0:
-            return None
+        return self._get_head_versions([(key, branch)]).get((key, branch))
 
-        result = cursor.fetchall()[0][0]
-        cursor.close()
-        return result
-
-    def _set_head_version(self, key: str, branch: str, hversion: str) -> None:
-        try_hversion = self._get_head_version(key, branch)
-
-        if try_hversion is None:
-            sql = "INSERT INTO head (h_key, h_branch, h_hversion) VALUES (%s, %s, %s)"
-            params = (key, branch, hversion)
-        else:
-            sql = "UPDATE head SET h_hversion = %s WHERE h_key = %s AND h_branch = %s"
-            params = (hversion, key, branch)
-
-        cursor = self.conn.cursor(buffered=True)
-        cursor.execute(sql, params)
-        cursor.close()
-
-    def put(self, key: str, branch: str, dtype: TransferDType, value: str):
-        self._check_and_connect()
+    def _file_parts(self, path: str) -> Iterator[bytes]:
+        with open(path, "rb") as rf:
+            yield from iter(lambda: rf.read(self.part_size), b"")
 
+    def _hash_version(
+        self, key: str, branch: str, dtype: TransferDType, value: str
+    ) -> str:
         if dtype == TransferDType.FILE:
             hash_generator = hashlib.sha256()
             hash_generator.update(f"{time.time()}##{key}::{branch}::".encode())
 
-            local_file_path = value
-
-            with open(local_file_path, "rb") as rf:
-                content = rf.read()
+            # The version is the first column of the blob, so the file is
+            # read twice rather than held in memory
+            for part in self._file_parts(value):
+                hash_generator.update(part)
 
-            hash_generator.update(content)
-
-            hversion = hash_generator.hexdigest()
+            return hash_generator.hexdigest()
 
         elif dtype == TransferDType.STRING:
-            content = value
-
             # Compute non-collisional SHA256 as hashed version
-            hversion = hashlib.sha256(
-                f"{time.time()}##{key}::{branch}::{content}".encode()
+            return hashlib.sha256(
+                f"{time.time()}##{key}::{branch}::{value}".encode()
             ).hexdigest()
 
-        sql = (
-            "INSERT INTO blobstore (bs_key, bs_branch, bs_hversion, bs_blob_value) "
-            + "VALUES (%s, %s, %s, %s)"
-        )
-        cursor = self.conn.cursor(buffered=True)
-        cursor.execute(sql, (key, branch, hversion, content))
-        cursor.close()
+    def put(self, key: str, branch: str, dtype: TransferDType, value: str):
+        return self.multi_put([PutItem(key, branch, dtype, value)])[0]
 
-        self.logger.debug(f"Put [{key}]::[{branch}] to database")
+    @instrumented_batch("put")
+    def multi_put(self, items: List[PutItem]) -> List[StorageReturn]:
+        """All items in one transaction, with one statement per table (but one
+        per part of files, which are streamed)
+        """
+        self._check_and_connect()
+        if self.schema_version == 2:
+            for i in items:
+                check_branch(i.branch)
+
+        values, results = [], []
+        for i in items:
+            value = resolve_value(i.value, results)
+            values.append(value)
+            ret = StorageReturn()
+            ret.values["Version"] = self._hash_version(i.key, i.branch, i.dtype, value)
+            results.append(ret)
+        if not items:
+            return results
+
+        versions = [r.values["Version"] for r in results]
+        string_parts = [
+            (hversion, seq, content[j : j + self.part_size])
+            for i, value, hversion in zip(items, values, versions)
+            if i.dtype == TransferDType.STRING
+            for content in (value.encode(),)
+            for seq, j in enumerate(range(0, len(content), self.part_size))
+        ]
+
+        with self._transaction() as conn:
+            cursor = conn.cursor(buffered=True)
+            try:
+                t = self._tables
+                cursor.executemany(
+                    f"INSERT INTO {t.blobs} "
+                    + f"({t.b_key}, {t.b_branch}, {t.b_hversion}, {t.b_value}) "
+                    + "VALUES (%s, %s, %s, NULL)",
+                    [
+                        (self._key_id(i.key), i.branch, h)
+                        for i, h in zip(items, versions)
+                    ],
+                )
+                sql = (
+                    "INSERT INTO blobparts (bp_hversion, bp_seq, bp_data) "
+                    + "VALUES (%s, %s, %s)"
+                )
+                if string_parts:
+                    cursor.executemany(sql, string_parts)
+                for i, value, hversion in zip(items, values, versions):
+                    if i.dtype == TransferDType.FILE:
+                        for seq, part in enumerate(self._file_parts(value)):
+                            cursor.execute(sql, (hversion, seq, part))
+
+                # Locked, so that concurrent puts to a branch are serialized
+                old_heads = self._get_head_versions(
+                    [(i.key, i.branch) for i in items], for_update=True
+                )
+                # Record the parents, before they are replaced as HEAD
+                heads = dict(old_heads)
+                parents = []
+                for i, hversion in zip(items, versions):
+                    if (i.key, i.branch) in heads:
+                        parents.append((hversion, heads[(i.key, i.branch)], 0))
+                    heads[(i.key, i.branch)] = hversion
+                if parents:
+                    cursor.executemany(
+                        "INSERT INTO parents (p_hversion, p_parent, p_ord) "
+                        + "VALUES (%s, %s, %s)",
+                        parents,
+                    )
+
+                # Shift branch HEADs
+                self._upsert_heads(cursor, heads, old_heads)
+            finally:
+                cursor.close()
+
+        self.logger.debug(f"Put {[(i.key, i.branch) for i in items]} to database")
+        return results
+
+    def _upsert_heads(
+        self,
+        cursor: Any,
+        heads: Dict[Tuple[str, str], str],
+        old_heads: Dict[Tuple[str, str], str],
+    ) -> None:
+        if self.schema_version == 2:
+            cursor.executemany(
+                "INSERT IGNORE INTO blobkeys (k_key_hash, k_key_prefix, k_key) "
+                + "VALUES (%s, %s, %s)",
+                [(key_hash(k), key_prefix(k), k) for k in {k for k, _ in heads}],
+            )
+            cursor.executemany(
+                "INSERT INTO heads (h_key_hash, h_branch, h_hversion) "
+                + "VALUES (%s, %s, %s) "
+                + "ON DUPLICATE KEY UPDATE h_hversion = VALUES(h_hversion)",
+                [(key_hash(k), b, h) for (k, b), h in heads.items()],
+            )
+            return
+
+        # `head` has no unique key to upsert on. Rows of `old_heads` are locked
+        updates = [(h, k, b) for (k, b), h in heads.items() if (k, b) in old_heads]
+        inserts = [(k, b, h) for (k, b), h in heads.items() if (k, b) not in old_heads]
+        if updates:
+            cursor.executemany(
+                "UPDATE head SET h_hversion = %s WHERE h_key = %s AND h_branch = %s",
+                updates,
+            )
+        if inserts:
+            cursor.executemany(
+                "INSERT INTO head (h_key, h_branch, h_hversion) VALUES (%s, %s, %s)",
+                inserts,
+            )
 
-        # Shift branch HEAD
-        self._set_head_version(key, branch, hversion)
+    def list_key(self, prefix: str = ""):
+        """`values` are the keys, only those starting with `prefix` if given"""
+        self._check_and_connect()
 
+        if self.schema_version == 1:
+            sql = "SELECT DISTINCT h_key FROM head WHERE h_key LIKE %s"
+        else:
+            # Searches the index of prefixes
+            sql = "SELECT k_key FROM blobkeys WHERE k_key_prefix LIKE %s"
+        pattern = _escape_like(key_prefix(prefix)) + "%"
         ret = StorageReturn()
-        ret.values["Version"] = hversion
+        ret.values = [
+            row[0] for row in self._query(sql, (pattern,)) if row[0].startswith(prefix)
+        ]
         return ret
 
-    def list_key(self):
-        self._check_and_connect()
-
-        sql = "SELECT DISTINCT h_key FROM head"
-        cursor = self.conn.cursor(buffered=True)
-        cursor.execute(sql)
-
-        if cursor.rowcount == 0:
-            return []
-
-        result = cursor.fetchall().zip()[0]
-        cursor.close()
-        return result
-
     def head(self, key: str, branch: str):
         self._check_and_connect()
 
@@ -303,22 +692,64 @@ class PEP249Storage(BaseStorage):
     ):
         raise NotImplementedError()
 
-    def list_branch(self, key: str) -> List[str]:
+    def list_branch(self, key: str):
+        """`values` are the branches of `key`"""
         self._check_and_connect()
 
-        sql = "SELECT DISTINCT h_branch FROM head WHERE key = %s"
-        cursor = self.conn.cursor(buffered=True)
-        cursor.execute(sql, (key))
-
-        if cursor.rowcount == 0:
-            return []
+        t = self._tables
+        sql = f"SELECT DISTINCT {t.h_branch} FROM {t.head} WHERE {t.h_key} = %s"
+        ret = StorageReturn()
+        ret.values = [row[0] for row in self._query(sql, (self._key_id(key),))]
+        return ret
 
-        result = cursor.fetchall().zip()[0]
-        cursor.close()
-        return result
+    def _resolve_version(
+        self, key: str, version: Optional[str], branch: Optional[str]
+    ) -> Optional[str]:
+        if version is not None:
+            return version
+        elif branch is not None:
+            return self._get_head_version(key, branch)
+        else:
+            raise ValueError("Not specifying one of branch and hversion")
 
     def meta(self, key: str, version: str = None, branch: str = None):
-        raise NotImplementedError()
+        """`values` are the parents of the version, None if it has none"""
+        self._check_and_connect()
+
+        ret = StorageReturn()
+        ret.values = None
+        hversion = self._resolve_version(key, version, branch)
+        if hversion is None:
+            return ret
+
+        sql = "SELECT p_parent FROM parents WHERE p_hversion = %s ORDER BY p_ord"
+        parents = [row[0] for row in self._query(sql, (hversion,))]
+
+        ret.values = parents if parents else None
+        return ret
+
+    def lineage(self, key: str, version: str = None, branch: str = None):
+        self._check_and_connect()
+
+        ret = StorageReturn()
+        hversion = self._resolve_version(key, version, branch)
+        if hversion is None:
+            return ret
+
+        # All ancestors in one round trip
+        sql = """
+            WITH RECURSIVE ancestors (hversion) AS (
+                SELECT %s
+                UNION
+                SELECT p.p_parent FROM parents p
+                JOIN ancestors a ON p.p_hversion = a.hversion
+            )
+            SELECT a.hversion, p.p_parent FROM ancestors a
+            LEFT JOIN parents p ON p.p_hversion = a.hversion
+            ORDER BY a.hversion, p.p_ord
+        """
+        ret.values = order_lineage(hversion, self._query(sql, (hversion,)))
+        return ret
 
     def merge(
         self,
@@ -0,0 +1,416 @@
+"""Schema v2 of `PEP249Storage`, and its online migration from v1.
+
+Tables of v1 (see `PEP249Storage`) have LONGTEXT keys and no index, so that
+every lookup of a blob or of a head scans a table. v2 identifies keys by their
+SHA-256 (`key_hash`), in the primary keys of `blobs` and `heads`, and stores
+each key once in `blobkeys`, with an indexed prefix for prefix search.
+`blobparts` and `parents` are keyed by version already, and shared by both.
+They are created if missing when `PEP249Storage` connects (`create_shared`).
+
+Migration, while v1 is in use:
+
+    python -m pipeman.store.pep249_schema migrate
+
+creates the v2 tables, mirrors writes to v1 into them with triggers, and then
+copies existing rows. Copying reads a snapshot without locking, and never
+overwrites rows written by the triggers, so it can run (and be rerun) at any
+time. Then, set `schema_version = 2` in `[storage_rdbms]` and restart, and
+
+    python -m pipeman.store.pep249_schema finish
+
+drops the triggers. Tables of v1 are left to drop by hand.
+
+    python -m pipeman.store.pep249_schema bench [ROWS]
+
+compares lookups of both schemas on SQLite, as a stand-in of the DBMS.
+"""
+import hashlib
+import os
+import sys
+import time
+from typing import Any, Callable, List, Tuple
+
+KEY_PREFIX_LENGTH = 255
+"""Characters of keys in the indexed `k_key_prefix`"""
+BRANCH_MAX_LENGTH = 255
+"""Characters of branches in v2, where they are part of the primary key"""
+
+SCHEMA_V1 = (
+    """CREATE TABLE blobstore (
+        bs_key LONGTEXT,
+        bs_branch LONGTEXT,
+        bs_hversion CHAR(64),
+        bs_blob_value LONGBLOB
+    )""",
+    """CREATE TABLE head (
+        h_key LONGTEXT,
+        h_branch LONGTEXT,
+        h_hversion CHAR(64)
+    )""",
+)
+
+SHARED_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS blobparts (
+        bp_hversion CHAR(64),
+        bp_seq INT,
+        bp_data LONGBLOB,
+        PRIMARY KEY (bp_hversion, bp_seq)
+    )""",
+    """CREATE TABLE IF NOT EXISTS parents (
+        p_hversion CHAR(64),
+        p_parent CHAR(64),
+        p_ord INT,
+        PRIMARY KEY (p_hversion, p_ord),
+        INDEX (p_parent)
+    )""",
+)
+"""Tables of both versions (MySQL)"""
+
+SCHEMA_V2 = (
+    """CREATE TABLE blobkeys (
+        k_key_hash CHAR(64) NOT NULL,
+        k_key_prefix VARCHAR(255) NOT NULL,
+        k_key LONGTEXT NOT NULL,
+        PRIMARY KEY (k_key_hash)
+    )""",
+    "CREATE INDEX blobkeys_prefix ON blobkeys (k_key_prefix)",
+    """CREATE TABLE blobs (
+        b_key_hash CHAR(64) NOT NULL,
+        b_hversion CHAR(64) NOT NULL,
+        b_branch LONGTEXT,
+        b_blob_value LONGBLOB,
+        PRIMARY KEY (b_key_hash, b_hversion)
+    )""",
+    f"""CREATE TABLE heads (
+        h_key_hash CHAR(64) NOT NULL,
+        h_branch VARCHAR({BRANCH_MAX_LENGTH}) NOT NULL,
+        h_hversion CHAR(64) NOT NULL,
+        PRIMARY KEY (h_key_hash, h_branch)
+    )""",
+)
+
+# MySQL. Run in the transactions of the writes to v1
+_TRIGGERS = {
+    "blobstore_to_v2": """
+        CREATE TRIGGER blobstore_to_v2 AFTER INSERT ON blobstore FOR EACH ROW
+        INSERT IGNORE INTO blobs (b_key_hash, b_hversion, b_branch, b_blob_value)
+        VALUES (SHA2(NEW.bs_key, 256), NEW.bs_hversion, NEW.bs_branch,
+            NEW.bs_blob_value)
+    """,
+    "head_insert_to_v2": f"""
+        CREATE TRIGGER head_insert_to_v2 AFTER INSERT ON head FOR EACH ROW
+        BEGIN
+            INSERT IGNORE INTO blobkeys (k_key_hash, k_key_prefix, k_key)
+            VALUES (SHA2(NEW.h_key, 256), LEFT(NEW.h_key, {KEY_PREFIX_LENGTH}),
+                NEW.h_key);
+            INSERT INTO heads (h_key_hash, h_branch, h_hversion)
+            VALUES (SHA2(NEW.h_key, 256), NEW.h_branch, NEW.h_hversion)
+            ON DUPLICATE KEY UPDATE h_hversion = NEW.h_hversion;
+        END
+    """,
+    "head_update_to_v2": """
+        CREATE TRIGGER head_update_to_v2 AFTER UPDATE ON head FOR EACH ROW
+        INSERT INTO heads (h_key_hash, h_branch, h_hversion)
+        VALUES (SHA2(NEW.h_key, 256), NEW.h_branch, NEW.h_hversion)
+        ON DUPLICATE KEY UPDATE h_hversion = NEW.h_hversion
+    """,
+}
+
+
+def key_hash(key: str) -> str:
+    """Same as `SHA2(key, 256)` of MySQL, on UTF-8 columns"""
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def key_prefix(key: str) -> str:
+    return key[:KEY_PREFIX_LENGTH]
+
+
+def check_branch(branch: str) -> None:
+    """
+    Raises:
+        ValueError: if `branch` cannot be stored in v2
+    """
+    if len(branch) > BRANCH_MAX_LENGTH:
+        raise ValueError(
+            f"Branch longer than {BRANCH_MAX_LENGTH} characters: {branch[:32]}..."
+        )
+
+
+def _execute(conn: Any, sql: str, params: tuple = ()) -> None:
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, params)
+    finally:
+        cursor.close()
+
+
+def _has_table(conn: Any, name: str) -> bool:
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SELECT 1 FROM {name} LIMIT 1")
+        cursor.fetchall()
+        return True
+    # Errors are of the DB-API module of `conn`
+    except Exception:
+        return False
+    finally:
+        cursor.close()
+
+
+def create_shared(conn: Any) -> None:
+    for statement in SHARED_SCHEMA:
+        _execute(conn, statement)
+
+
+def create_v2(conn: Any) -> bool:
+    """Create the v2 tables. False if they exist already"""
+    if _has_table(conn, "blobs"):
+        return False
+    for statement in SCHEMA_V2:
+        _execute(conn, statement)
+    return True
+
+
+def install_triggers(conn: Any) -> None:
+    for name, statement in _TRIGGERS.items():
+        _execute(conn, f"DROP TRIGGER IF EXISTS {name}")
+        _execute(conn, statement)
+
+
+def drop_triggers(conn: Any) -> None:
+    for name in _TRIGGERS:
+        _execute(conn, f"DROP TRIGGER IF EXISTS {name}")
+
+
+def backfill(
+    read_conn: Any,
+    write_conn: Any,
+    batch_size: int = 1000,
+    insert_ignore: str = "INSERT IGNORE",
+    param: str = "%s",
+    progress: Callable[[str, int], None] = lambda table, n: None,
+) -> Tuple[int, int]:
+    """Copy rows of v1 to v2, except those in v2 already.
+
+    Rows are streamed from `read_conn`, and written by batches of `batch_size`
+    with `write_conn`.
+
+    Args:
+        insert_ignore, param: SQL of the DBMS (e.g., "INSERT OR IGNORE" and
+            "?" for SQLite)
+
+    Returns:
+        Numbers of blobs and heads read
+    """
+
+    def copy(select: str, inserts: List[Tuple[str, Callable[[tuple], tuple]]]):
+        n = 0
+        cursor = read_conn.cursor()
+        try:
+            cursor.execute(select)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                write_cursor = write_conn.cursor()
+                try:
+                    for table, to_row in inserts:
+                        values = [to_row(r) for r in rows]
+                        placeholders = ", ".join([param] * len(values[0]))
+                        write_cursor.executemany(
+                            f"{insert_ignore} INTO {table} VALUES ({placeholders})",
+                            values,
+                        )
+                finally:
+                    write_cursor.close()
+                write_conn.commit()
+                n += len(rows)
+                progress(inserts[0][0], n)
+        finally:
+            cursor.close()
+        return n
+
+    num_blobs = copy(
+        "SELECT bs_key, bs_hversion, bs_branch, bs_blob_value FROM blobstore",
+        [("blobs", lambda r: (key_hash(r[0]), r[1], r[2], r[3]))],
+    )
+    num_heads = copy(
+        "SELECT h_key, h_branch, h_hversion FROM head",
+        [
+            ("blobkeys", lambda r: (key_hash(r[0]), key_prefix(r[0]), r[0])),
+            ("heads", lambda r: (key_hash(r[0]), r[1], r[2])),
+        ],
+    )
+    return num_blobs, num_heads
+
+
+def _count(conn: Any, table: str) -> int:
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SELECT COUNT(*) FROM {table}")
+        return cursor.fetchall()[0][0]
+    finally:
+        cursor.close()
+
+
+def _count_long_branches(conn: Any) -> int:
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "SELECT COUNT(*) FROM head "
+            + f"WHERE CHAR_LENGTH(h_branch) > {BRANCH_MAX_LENGTH}"
+        )
+        return cursor.fetchall()[0][0]
+    finally:
+        cursor.close()
+
+
+def _storage_from_config():
+    from pipeman.config import default_config as conf
+    from pipeman.store.pep249 import PEP249Storage
+
+    storage = PEP249Storage(
+        user=conf.get("storage_rdbms", "user"),
+        ssl_cert=conf.get("storage_rdbms", "ssl_cert_path"),
+        ssl_key=conf.get("storage_rdbms", "ssl_key_path"),
+    )
+    return storage
+
+
+def migrate() -> None:
+    storage = _storage_from_config()
+    read_conn, write_conn = storage._do_connect(), storage._do_connect()
+    try:
+        num_long = _count_long_branches(read_conn)
+        if num_long > 0:
+            print(
+                f"{num_long} heads have branches longer than {BRANCH_MAX_LENGTH} "
+                + "characters, which v2 cannot store. Rename them first"
+            )
+            sys.exit(1)
+        create_shared(write_conn)
+        if create_v2(write_conn):
+            print("Created v2 tables")
+        install_triggers(write_conn)
+        print("Mirroring writes to v2")
+
+        num_blobs, num_heads = backfill(
+            read_conn,
+            write_conn,
+            progress=lambda table, n: print(f"{table}: {n} rows", end="\r"),
+        )
+        print(f"Copied {num_blobs} blobs and {num_heads} heads")
+        for v1, v2 in (("blobstore", "blobs"), ("head", "heads")):
+            print(f"{v1}: {_count(read_conn, v1)} rows, {v2}: {_count(read_conn, v2)}")
+        print("Set `schema_version = 2` in [storage_rdbms], restart, and `finish`")
+    finally:
+        read_conn.close()
+        write_conn.close()
+
+
+def finish() -> None:
+    conn = _storage_from_config()._do_connect()
+    try:
+        drop_triggers(conn)
+        print("Stopped mirroring writes to v2")
+    finally:
+        conn.close()
+
+
+def _time_per_op(conn: Any, sql: str, params: List[tuple]) -> float:
+    start = time.perf_counter()
+    for p in params:
+        conn.execute(sql, p).fetchall()
+    return (time.perf_counter() - start) / len(params)
+
+
+def _bench(rows: int, versions_per_key: int = 10) -> None:
+    """Lookups of v1 and v2, and migration, on SQLite with `rows` blobs"""
+    import random
+    import sqlite3
+    import tempfile
+
+    num_keys = max(rows // versions_per_key, 1)
+    keys = [f"bench::Entity::component::name-{i:08d}" for i in range(num_keys)]
+
+    with tempfile.TemporaryDirectory() as temp:
+        path = os.path.join(temp, "bench.sqlite3")
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Lets LIKE use the index of `k_key_prefix`, as MySQL does
+        conn.execute("PRAGMA case_sensitive_like = ON")
+        for statement in SCHEMA_V1:
+            conn.execute(statement)
+
+        start = time.perf_counter()
+        heads = []
+        for i, key in enumerate(keys):
+            batch = [
+                (key, "master", hashlib.sha256(f"{key}:{v}".encode()).hexdigest())
+                for v in range(versions_per_key)
+            ]
+            conn.executemany("INSERT INTO blobstore VALUES (?, ?, ?, NULL)", batch)
+            heads.append(batch[-1])
+        conn.executemany("INSERT INTO head VALUES (?, ?, ?)", heads)
+        conn.commit()
+        print(
+            f"Filled v1 with {num_keys * versions_per_key} blobs and {num_keys} "
+            + f"heads in {time.perf_counter() - start:.1f} s"
+        )
+
+        start = time.perf_counter()
+        create_v2(conn)
+        read_conn = sqlite3.connect(path)
+        backfill(read_conn, conn, insert_ignore="INSERT OR IGNORE", param="?")
+        read_conn.close()
+        elapsed = time.perf_counter() - start
+        num_blobs = num_keys * versions_per_key
+        print(f"Migrated in {elapsed:.1f} s ({num_blobs / elapsed:.0f} blobs/s)")
+
+        rng = random.Random(0)
+        samples = [rng.choice(heads) for _ in range(2000)]
+        prefixes = [(f"{key[:-3]}%",) for key, _, _ in samples]
+        cases = [
+            (
+                "head of a branch",
+                "SELECT h_hversion FROM head WHERE h_key = ? AND h_branch = ?",
+                "SELECT h_hversion FROM heads WHERE h_key_hash = ? AND h_branch = ?",
+                [(k, b) for k, b, _ in samples],
+                [(key_hash(k), b) for k, b, _ in samples],
+            ),
+            (
+                "blob of a version",
+                "SELECT bs_blob_value IS NULL FROM blobstore "
+                + "WHERE bs_key = ? AND bs_hversion = ?",
+                "SELECT b_blob_value IS NULL FROM blobs "
+                + "WHERE b_key_hash = ? AND b_hversion = ?",
+                [(k, h) for k, _, h in samples],
+                [(key_hash(k), h) for k, _, h in samples],
+            ),
+            (
+                "keys by prefix",
+                "SELECT DISTINCT h_key FROM head WHERE h_key LIKE ?",
+                "SELECT k_key FROM blobkeys WHERE k_key_prefix LIKE ?",
+                prefixes,
+                prefixes,
+            ),
+        ]
+        print(f"{'Lookup':<20}{'v1 (ms)':>12}{'v2 (ms)':>12}{'Speedup':>10}")
+        for name, sql_v1, sql_v2, params_v1, params_v2 in cases:
+            # v1 scans a table per lookup, so fewer are run
+            v1 = _time_per_op(conn, sql_v1, params_v1[:20])
+            v2 = _time_per_op(conn, sql_v2, params_v2)
+            print(f"{name:<20}{v1 * 1000:>12.3f}{v2 * 1000:>12.3f}{v1 / v2:>9.0f}x")
+        conn.close()
+
+
+if __name__ == "__main__":
+    commands = {"migrate": migrate, "finish": finish}
+    if len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        _bench(int(sys.argv[2]) if len(sys.argv) > 2 else 1000000)
+    elif len(sys.argv) == 2 and sys.argv[1] in commands:
+        commands[sys.argv[1]]()
+    else:
+        print(f"Usage: {sys.argv[0]} migrate | finish | bench [ROWS]")
+        sys.exit(1)
@@ -0,0 +1,392 @@
+"""Storage subsystem embedded in a single SQLite database file.
+
+Needs no outside service, and supports every operation of `BaseStorage`,
+including branch and merge, in transactions. Tables are indexed by version and
+by `(key, branch)`, and the database is in WAL mode, so that readers in other
+processes do not block writes.
+
+Values are stored as rows of `blocks`, in sequence, of at most `block_size`
+Bytes each, so that files are streamed in and out without being held in
+memory, and are not bounded by the maximum size of a blob.
+
+Writes are batched with `SQLiteStorage.batch`: writes in the block are one
+transaction, committed at its end. `multi_put` is always one batch.
+"""
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+from pipeman.env import env
+from pipeman.store.base_storage import (
+    BaseStorage,
+    GetItem,
+    PutItem,
+    StorageReturn,
+    TransferDType,
+    instrumented,
+    instrumented_batch,
+    order_lineage,
+    resolve_value,
+)
+
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS versions (
+        hversion TEXT PRIMARY KEY,
+        key TEXT NOT NULL,
+        branch TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS versions_key ON versions (key)",
+    # With a rowid, so that large rows do not bloat the primary key index
+    """CREATE TABLE IF NOT EXISTS blocks (
+        hversion TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        data BLOB NOT NULL,
+        PRIMARY KEY (hversion, seq)
+    )""",
+    """CREATE TABLE IF NOT EXISTS heads (
+        key TEXT NOT NULL,
+        branch TEXT NOT NULL,
+        hversion TEXT NOT NULL,
+        PRIMARY KEY (key, branch)
+    ) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS parents (
+        hversion TEXT NOT NULL,
+        parent TEXT NOT NULL,
+        ord INTEGER NOT NULL,
+        PRIMARY KEY (hversion, ord)
+    ) WITHOUT ROWID""",
+)
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, path: str, block_size: int = 1048576) -> None:
+        """
+        Args:
+            path: database file, created if missing
+            block_size: Bytes of each stored block of a value
+        """
+        super().__init__()
+        self._path = path
+        self._block_size = block_size
+        self._conn: Optional[sqlite3.Connection] = None
+        # Storage calls may come from several trial managers. Re-entrant, so
+        # that a batch can call other methods
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+
+    def connect(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+        self._conn = sqlite3.connect(
+            self._path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in _SCHEMA:
+            self._conn.execute(statement)
+        self.logger.info(f"Connected to {self._path}")
+        return self
+
+    def disconnect(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _query(self, sql: str, params: tuple = ()) -> list:
+        assert self._conn is not None, "Storage not connected"
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    @contextmanager
+    def batch(self, immediate: bool = True) -> Iterator[None]:
+        """Make writes in the block one transaction, rolled back on errors.
+
+        Other threads wait for the end of the block. Batches may be nested.
+
+        Args:
+            immediate: take the write lock at once. Batches that only read
+                should not, so that they do not wait for (or block) writers
+                of other processes
+        """
+        assert self._conn is not None, "Storage not connected"
+        with self._lock:
+            if self._batch_depth > 0:
+                self._batch_depth += 1
+                try:
+                    yield
+                finally:
+                    self._batch_depth -= 1
+                return
+
+            self._conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            self._batch_depth = 1
+            try:
+                yield
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            finally:
+                self._batch_depth = 0
+
+    def _head_version(self, key: str, branch: str) -> Optional[str]:
+        rows = self._query(
+            "SELECT hversion FROM heads WHERE key = ? AND branch = ?", (key, branch)
+        )
+        return rows[0][0] if rows else None
+
+    def _resolve_version(
+        self, key: str, version: Optional[str], branch: Optional[str]
+    ) -> Optional[str]:
+        if version is not None:
+            rows = self._query(
+                "SELECT 1 FROM versions WHERE hversion = ? AND key = ?", (version, key)
+            )
+            return version if rows else None
+        elif branch is not None:
+            return self._head_version(key, branch)
+        else:
+            raise ValueError("Not specifying one of branch and hversion")
+
+    def _read_value(self, key: str, hversion: str, local_file: str) -> bool:
+        """Write the value of a version to `local_file`. False if not stored"""
+        # Blocks are read from one snapshot
+        with self.batch(immediate=False):
+            if self._resolve_version(key, hversion, None) is None:
+                return False
+            with open(local_file, "wb") as f:
+                cursor = self._conn.execute(
+                    "SELECT data FROM blocks WHERE hversion = ? ORDER BY seq",
+                    (hversion,),
+                )
+                for (data,) in cursor:
+                    f.write(data)
+        return True
+
+    @instrumented("get")
+    def get(
+        self,
+        key: str,
+        branch: str = None,
+        hversion: str = None,
+        dtype: TransferDType = TransferDType.STRING,
+    ):
+        hversion = self._resolve_version(key, hversion, branch)
+        if hversion is None:
+            return None, None
+
+        local_file = os.path.join(env.temp_path, f"{key}-{branch}-{time.time()}")
+        if not self._read_value(key, hversion, local_file):
+            return None, None
+
+        if dtype == TransferDType.FILE:
+            return None, local_file
+        with open(local_file, "r") as f:
+            content = f.read()
+        os.remove(local_file)
+        return None, content
+
+    def multi_get(self, items: List[GetItem]) -> List[Tuple[str, Optional[str]]]:
+        """All items from one snapshot"""
+        with self.batch(immediate=False):
+            return super().multi_get(items)
+
+    def _hash_version(
+        self, key: str, branch: str, dtype: TransferDType, value: str
+    ) -> str:
+        hash_generator = hashlib.sha256()
+        hash_generator.update(f"{time.time()}##{key}::{branch}::".encode())
+        if dtype == TransferDType.FILE:
+            with open(value, "rb") as f:
+                for block in iter(lambda: f.read(self._block_size), b""):
+                    hash_generator.update(block)
+        else:
+            hash_generator.update(value.encode())
+        return hash_generator.hexdigest()
+
+    def _add_version(
+        self,
+        hversion: str,
+        key: str,
+        branch: str,
+        dtype: TransferDType,
+        value: str,
+        parents: List[str],
+    ) -> None:
+        """Store a version with `parents`, and make it the head of `branch`.
+        `hversion` is hashed by the caller, before taking the write lock
+        """
+        with self.batch():
+            self._conn.execute(
+                "INSERT INTO versions VALUES (?, ?, ?)", (hversion, key, branch)
+            )
+            if dtype == TransferDType.STRING:
+                self._insert_blocks(hversion, io.BytesIO(value.encode()))
+            else:
+                with open(value, "rb") as f:
+                    self._insert_blocks(hversion, f)
+
+            self._conn.executemany(
+                "INSERT INTO parents VALUES (?, ?, ?)",
+                [(hversion, p, i) for i, p in enumerate(parents)],
+            )
+            self._set_head(key, branch, hversion)
+
+    def _insert_blocks(self, hversion: str, f: BinaryIO) -> None:
+        self._conn.executemany(
+            "INSERT INTO blocks VALUES (?, ?, ?)",
+            (
+                (hversion, seq, block)
+                for seq, block in enumerate(
+                    iter(lambda: f.read(self._block_size), b"")
+                )
+            ),
+        )
+
+    def _set_head(self, key: str, branch: str, hversion: str) -> None:
+        self._conn.execute(
+            "INSERT INTO heads VALUES (?, ?, ?) "
+            + "ON CONFLICT (key, branch) DO UPDATE SET hversion = excluded.hversion",
+            (key, branch, hversion),
+        )
+
+    def put(self, key: str, branch: str, dtype: TransferDType, value: str):
+        return self.multi_put([PutItem(key, branch, dtype, value)])[0]
+
+    @instrumented_batch("put")
+    def multi_put(self, items: List[PutItem]) -> List[StorageReturn]:
+        """All items in one transaction"""
+        values, results = [], []
+        for i in items:
+            value = resolve_value(i.value, results)
+            values.append(value)
+            ret = StorageReturn()
+            ret.values["Version"] = self._hash_version(i.key, i.branch, i.dtype, value)
+            results.append(ret)
+
+        with self.batch():
+            for i, value, ret in zip(items, values, results):
+                head = self._head_version(i.key, i.branch)
+                self._add_version(
+                    ret.values["Version"],
+                    i.key,
+                    i.branch,
+                    i.dtype,
+                    value,
+                    [head] if head is not None else [],
+                )
+        return results
+
+    def merge(
+        self,
+        key: str,
+        head_branch: str,
+        merge_branch: str,
+        dtype: TransferDType,
+        value: str,
+    ):
+        """Store `value` as the new head of `head_branch`, with the heads of both
+        branches as parents
+        """
+        ret = StorageReturn()
+        hversion = self._hash_version(key, head_branch, dtype, value)
+        with self.batch():
+            parents = [
+                self._head_version(key, head_branch),
+                self._head_version(key, merge_branch),
+            ]
+            if None in parents:
+                raise KeyError(f"Branch {head_branch} or {merge_branch} of {key}")
+            self._add_version(hversion, key, head_branch, dtype, value, parents)
+        ret.values["Version"] = hversion
+        return ret
+
+    def branch(
+        self,
+        key: str,
+        new_branch: str,
+        based_on_branch: str = None,
+        refer_version: str = None,
+    ):
+        """Create `new_branch` with its head at `refer_version`, or at the head
+        of `based_on_branch`
+        """
+        ret = StorageReturn()
+        with self.batch():
+            if self._head_version(key, new_branch) is not None:
+                raise ValueError(f"Branch {new_branch} of {key} exists")
+            if refer_version is not None:
+                hversion = self._resolve_version(key, refer_version, None)
+            elif based_on_branch is not None:
+                hversion = self._head_version(key, based_on_branch)
+            else:
+                raise ValueError("Not specifying one of branch and hversion")
+            if hversion is None:
+                raise KeyError(f"Version to branch from of {key}")
+
+            self._set_head(key, new_branch, hversion)
+        ret.values["Version"] = hversion
+        return ret
+
+    def list_key(self, prefix: str = ""):
+        """`values` are the keys, only those starting with `prefix` if given"""
+        # A range of the primary key of heads
+        rows = self._query(
+            "SELECT DISTINCT key FROM heads WHERE key >= ? AND key < ?",
+            (prefix, prefix + "\U0010ffff"),
+        )
+        ret = StorageReturn()
+        ret.values = [row[0] for row in rows if row[0].startswith(prefix)]
+        return ret
+
+    def head(self, key: str, branch: str):
+        ret = StorageReturn()
+        ret.values["Version"] = self._head_version(key, branch)
+        return ret
+
+    def list_branch(self, key: str):
+        """`values` are the branches of `key`"""
+        rows = self._query("SELECT branch FROM heads WHERE key = ?", (key,))
+        ret = StorageReturn()
+        ret.values = [row[0] for row in rows]
+        return ret
+
+    def meta(self, key: str, version: str = None, branch: str = None):
+        """`values` are the parents of the version, None if it has none"""
+        ret = StorageReturn()
+        ret.values = None
+        hversion = self._resolve_version(key, version, branch)
+        if hversion is None:
+            return ret
+
+        rows = self._query(
+            "SELECT parent FROM parents WHERE hversion = ? ORDER BY ord", (hversion,)
+        )
+        ret.values = [row[0] for row in rows] or None
+        return ret
+
+    def lineage(self, key: str, version: str = None, branch: str = None):
+        ret = StorageReturn()
+        hversion = self._resolve_version(key, version, branch)
+        if hversion is None:
+            return ret
+
+        rows = self._query(
+            """WITH RECURSIVE ancestors(hversion) AS (
+                SELECT ?
+                UNION
+                SELECT p.parent FROM parents p
+                JOIN ancestors a ON p.hversion = a.hversion
+            )
+            SELECT a.hversion, p.parent FROM ancestors a
+            LEFT JOIN parents p ON p.hversion = a.hversion
+            ORDER BY a.hversion, p.ord""",
+            (hversion,),
+        )
+        ret.values = order_lineage(hversion, rows)
+        return ret
@@ -4,7 +4,7 @@ import time
 from abc import ABCMeta, abstractmethod
 from typing import List, Match, Optional, Type, TypeVar
 
-from pipeman.store.base_storage import BaseStorage, TransferDType
+from pipeman.store.base_storage import BaseStorage, TransferDType, instrumented
 
 # from pipeman.store.ssh import SSHConnection
 from pipeman.store.ustoreconf import UStoreCLIConstant, UStoreConf
@@ -211,6 +211,7 @@ class UStoreCLI(BaseStorage):
         # self.sshclient.close()
         self.is_connected = False
 
+    @instrumented("put")
     def put(self, key: str, branch: str, dtype: TransferDType, value: str):
 
         ## IF SSH
@@ -253,6 +254,7 @@ class UStoreCLI(BaseStorage):
         # cmd_ret = self._exec_command(cmd, PutReturn)
         # return cmd_ret
 
+    @instrumented("get")
     def get(
         self,
         key: str,
@@ -1,3 +1,4 @@
+import json
 import os
 import pickle
 import pprint
@@ -7,7 +8,7 @@ from typing import Dict, List, Tuple
 
 import colorama
 
-from pipeman import storage
+from pipeman import metrics, storage
 from pipeman.datasetmanager import DatasetManager
 from pipeman.env import env
 from pipeman.file import FileUtils
@@ -466,11 +467,11 @@ class TrialManager:
 
             component_key = cpp_coordinator.get_component_key()
             if component_key == "":
-                io_time = cpp_coordinator.on_new_component(
+                io_time, resource_usage = cpp_coordinator.on_new_component(
                     [candidate_ids[i], wd, "NULL", *cmds]
                 )
             else:
-                io_time = cpp_coordinator.on_new_component(
+                io_time, resource_usage = cpp_coordinator.on_new_component(
                     [candidate_ids[i], wd, component_key, *cmds]
                 )
 
@@ -479,6 +480,15 @@ class TrialManager:
             t1 = time.time()
             node.execution_time = t1 - t0
             node.io_time = io_time
+            node.resource_usage = json.loads(resource_usage)
+            metrics.histogram(
+                "seccask_component_execution_seconds",
+                "Time from dispatching a component to its completion",
+            ).observe(node.execution_time)
+            metrics.histogram(
+                "seccask_component_io_seconds",
+                "Time spent on I/O by a component, as reported by its worker",
+            ).observe(io_time)
 
             self.logger.debug("Node execution time recorded")
 
@@ -510,6 +520,7 @@ class TrialManager:
             self.logger.info("NODE TIME STORAGE TIME  : {}".format(node.storage_time))
             self.logger.info("NODE TIME EXECUTION TIME: {}".format(node.execution_time))
             self.logger.info("NODE TIME IO TIME: {}".format(node.io_time))
+            self.logger.info("NODE RESOURCE USAGE: {}".format(node.resource_usage))
             # self.logger.info("NODE STORAGE SIZE: {}".format(node.storage_size))
 
         return node_list
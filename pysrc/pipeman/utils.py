@@ -1,14 +1,14 @@
 import asyncio
 import collections
+import itertools
 import json
 import logging
 import re
 import sys
-import time
-from typing import Dict, Callable, Union
+import threading
+from typing import Dict, Callable, List, NamedTuple, Optional, Tuple, Union
 
-log_store = collections.deque(maxlen=100)
-log_queue = asyncio.Queue()
+from pipeman.config import default_config as conf
 
 
 def first(iterable, condition: Callable[..., bool] = lambda _: True, default=None):
@@ -79,62 +79,163 @@ class PrintUtils:
 
 class StringUtils:
     REGEX_REMOVE_COLOR_ANSI_ESCAPE = r"(\x9B|\x1B\[)[0-?]*[ -\/]*[@-~]"
+    RE_REMOVE_COLOR_ANSI_ESCAPE = re.compile(REGEX_REMOVE_COLOR_ANSI_ESCAPE)
 
     @staticmethod
     def remove_ansi_color_escape(text: str) -> str:
         """Remove all ANSI color escapes"""
-        re_remove_ansi_escape = re.compile(StringUtils.REGEX_REMOVE_COLOR_ANSI_ESCAPE)
-        return re_remove_ansi_escape.sub("", text)
+        return StringUtils.RE_REMOVE_COLOR_ANSI_ESCAPE.sub("", text)
+
+
+class _LogEntry(NamedTuple):
+    created: float
+    levelname: str
+    name: str
+    message: str
+    fields: Optional[dict]
+
+
+class LogRing:
+    """The latest log records, for /logs and /logs_push of WebAPI.
+
+    Appending only captures the message of a record (`getMessage`): a record
+    holds its `args` until formatted, which keeps them alive, and would render
+    their state at read time rather than at logging time. Readers build the
+    dicts (see `to_dict`), so that logging does no more work. When full,
+    the oldest record is overwritten and counted in `num_dropped`. Each record
+    gets a sequence number, so that readers can tell how many records they
+    missed.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self._records: collections.deque = collections.deque(maxlen=capacity)
+        self._next_seq = 0
+        self._num_dropped = 0
+        self._lock = threading.Lock()
+        self._listeners: List[Callable[[], None]] = []
+
+    @property
+    def next_seq(self) -> int:
+        return self._next_seq
+
+    @property
+    def num_dropped(self) -> int:
+        return self._num_dropped
+
+    def add_listener(self, listener: Callable[[], None]) -> None:
+        """`listener` is called (on the logging thread) after each append"""
+        self._listeners = self._listeners + [listener]
+
+    def append(self, record: logging.LogRecord) -> None:
+        entry = self._entry_of(record)
+        with self._lock:
+            if len(self._records) == self._records.maxlen:
+                self._num_dropped += 1
+            self._records.append(entry)
+            self._next_seq += 1
+        for listener in self._listeners:
+            listener()
+
+    def since(self, seq: int) -> Tuple[List[dict], int, int]:
+        """Records numbered `seq` and after.
+
+        Returns:
+            The records, the number of records already overwritten, and the
+            sequence number to read from next time
+        """
+        with self._lock:
+            first_seq = self._next_seq - len(self._records)
+            missed = max(first_seq - seq, 0)
+            records = list(
+                itertools.islice(self._records, max(seq - first_seq, 0), None)
+            )
+            next_seq = self._next_seq
+        return [self._format(e) for e in records], missed, next_seq
+
+    def snapshot(self) -> List[dict]:
+        with self._lock:
+            records = list(self._records)
+        return [self._format(e) for e in records]
+
+    @staticmethod
+    def _entry_of(record: logging.LogRecord) -> "_LogEntry":
+        return _LogEntry(
+            record.created,
+            record.levelname,
+            record.name,
+            record.getMessage(),
+            getattr(record, "fields", None),
+        )
+
+    @staticmethod
+    def _format(entry: "_LogEntry") -> dict:
+        created, level, module, msg, fields = entry
+        d = {
+            "id": created,
+            "time": int(created * 1000),
+            "level": level,
+            "module": module,
+            "msg": StringUtils.remove_ansi_color_escape(msg),
+        }
+        if fields is not None:
+            # Structured data, from `logger.info(..., extra={"fields": {}})`
+            d["fields"] = fields
+        return d
+
+    @classmethod
+    def to_dict(cls, record: logging.LogRecord) -> dict:
+        return cls._format(cls._entry_of(record))
+
+
+log_store = LogRing(conf.getint("log", "ring_size"))
 
 
 class LogStoreHandler(logging.Handler):
     def emit(self, record):
-        current_time = time.time()
-        log_store.append(
-            {
-                "id": current_time,
-                "time": int(current_time * 1000),
-                "level": record.levelname,
-                "module": record.name,
-                "msg": StringUtils.remove_ansi_color_escape(record.message),
-            }
-        )
-        log_queue.put_nowait(
-            {
-                "id": current_time,
-                "time": int(current_time * 1000),
-                "level": record.levelname,
-                "module": record.name,
-                "msg": StringUtils.remove_ansi_color_escape(record.message),
-            }
-        )
+        log_store.append(record)
+
+
+def _parse_module_levels(spec: str) -> Dict[str, int]:
+    """`"Scheduler=INFO, FileSystemStorage=WARNING"` -> {name: level}"""
+    levels = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, _, level = item.partition("=")
+        levels[name.strip()] = logging.getLevelName(level.strip().upper())
+    return levels
 
 
 class LogUtils:
     loggers_lut: Dict[str, logging.Logger] = dict()
 
+    default_log_level = logging.getLevelName(conf.get("log", "level").upper())
+    module_log_levels = _parse_module_levels(conf.get("log", "module_levels"))
+
+    # Shared by all loggers. Levels are checked by loggers, so that a disabled
+    # level never creates a record
+    default_log_Handler = logging.StreamHandler(stream=sys.stdout)
+    default_log_Handler.setFormatter(
+        logging.Formatter(
+            fmt=f"%(asctime)-15s %(levelname)-7s | %(name)s |> %(message)s"
+        )
+    )
+    log_store_handler = LogStoreHandler()
+
     @classmethod
     def get_default_named_logger(cls, name: str) -> logging.Logger:
         if name in cls.loggers_lut:
             return cls.loggers_lut[name]
         else:
-            default_log_level = logging.DEBUG
-            default_log_formatter = logging.Formatter(
-                fmt=f"%(asctime)-15s %(levelname)-7s | %(name)s |> %(message)s"
-            )
+            default_log_level = cls.module_log_levels.get(name, cls.default_log_level)
             # default_log_formatter = logging.Formatter(fmt='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-            default_log_Handler = logging.StreamHandler(stream=sys.stdout)
-            default_log_Handler.setFormatter(default_log_formatter)
-            default_log_Handler.setLevel(default_log_level)
             # default_file_Handler = logging.FileHandler(filename=os.path.join(Env().home, time.strftime("%Y-%m-%d-%H-%M-%S.log", time.localtime())))
             # default_file_Handler.setFormatter(default_log_formatter)
             # default_file_Handler.setLevel(default_log_level)
 
             logger = logging.getLogger(name)
-            logger.addHandler(default_log_Handler)
-
-            handler = LogStoreHandler(level=default_log_level)
-            logger.addHandler(handler)
+            logger.addHandler(cls.default_log_Handler)
+            logger.addHandler(cls.log_store_handler)
 
             # logger.addFilter(LogUtils.LastPartFilter())
 
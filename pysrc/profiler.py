@@ -1,9 +1,12 @@
+import resource
+import time
 from abc import ABCMeta, abstractmethod
+from typing import Dict, Optional
 
 from pipeman.config import default_config
 
 
-__all__ = ["mem_profiler"]
+__all__ = ["mem_profiler", "ResourceMeter"]
 
 IS_ENABLED = default_config.getboolean("profiler", "enable_memory_profiler")
 
@@ -60,3 +63,76 @@ class MemoryProfilerImpl(MemoryProfiler):
 mem_profiler: MemoryProfiler = (
     MemoryProfilerImpl() if IS_ENABLED else EmptyMemoryProfiler()
 )
+
+
+def _read_proc_io() -> Optional[Dict[str, int]]:
+    """`/proc/self/io`, if available (e.g., not in every LibOS)"""
+    try:
+        with open("/proc/self/io", "r") as f:
+            return {k: int(v) for k, _, v in (l.partition(": ") for l in f)}
+    except (OSError, ValueError):
+        return None
+
+
+def _reset_peak_rss() -> bool:
+    """Reset VmHWM of this process (Linux 4.0+)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _read_peak_rss_kb() -> Optional[int]:
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class ResourceMeter:
+    """Resources used by this process between `start` and `stop`.
+
+    CPU time and page faults come from `getrusage`, I/O from `/proc/self/io`.
+    The peak RSS is of the measured period if the kernel can reset it, or of
+    the whole process otherwise. Unavailable values are `None`.
+    """
+
+    def start(self) -> None:
+        self._wall = time.perf_counter()
+        self._rusage = resource.getrusage(resource.RUSAGE_SELF)
+        self._io = _read_proc_io()
+        self._peak_rss_reset = _reset_peak_rss()
+
+    def stop(self) -> Dict[str, Optional[float]]:
+        wall = time.perf_counter() - self._wall
+        ru = resource.getrusage(resource.RUSAGE_SELF)
+        io = _read_proc_io()
+
+        peak_rss_kb = _read_peak_rss_kb() if self._peak_rss_reset else None
+        if peak_rss_kb is None:
+            # Linux reports ru_maxrss in KiB
+            peak_rss_kb = ru.ru_maxrss
+
+        def io_delta(key: str) -> Optional[int]:
+            if io is None or self._io is None or key not in io:
+                return None
+            return io[key] - self._io[key]
+
+        return {
+            "wall_seconds": wall,
+            "cpu_user_seconds": ru.ru_utime - self._rusage.ru_utime,
+            "cpu_system_seconds": ru.ru_stime - self._rusage.ru_stime,
+            "peak_rss_bytes": peak_rss_kb * 1024,
+            "read_bytes": io_delta("rchar"),
+            "write_bytes": io_delta("wchar"),
+            "disk_read_bytes": io_delta("read_bytes"),
+            "disk_write_bytes": io_delta("write_bytes"),
+            "minor_page_faults": ru.ru_minflt - self._rusage.ru_minflt,
+            "major_page_faults": ru.ru_majflt - self._rusage.ru_majflt,
+        }
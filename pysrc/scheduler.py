@@ -1,18 +1,23 @@
 import asyncio
 import itertools
+import json
 import os
+import secrets
 import time
 import uuid
-from typing import Callable, MutableSet, Optional
+from typing import Callable, Dict, MutableSet, Optional, Set, Tuple
 
 import paramiko
-import yaml
 
+from pipeman import metrics
 from pipeman.env import env
 from pipeman.store.ustoreconf import UStoreConf
 from pipeman.config import default_config as conf
 from pipeman.utils import LogUtils
 from pipeman.version import SemanticVersion
+from daemon.broadcast import BroadcastHub
+import daemon.zygote as zygote
+from manifest import Manifest
 import pipeline as p
 import worker_cache as cache
 import workerconn as wc
@@ -37,15 +42,37 @@ class Scheduler:
         self._cached_workers = cache.PACache()
         self._new_workers = []
         self._num_slot = num_slot
+        self._pipeline_depth = conf.getint("scheduler", "pipeline_depth")
+        self._pool_version = 0
         # self._waiting_components: MutableSet[Tuple[p.Component, asyncio.Future]] = set()
         self._waiting_components: MutableSet[p.Component] = set()
+        # For metrics: when each component started to wait, and each worker
+        # was spawned
+        self._waiting_since: Dict[p.Component, float] = {}
+        self._spawned_at: Dict[str, Tuple[float, str]] = {}
+        # Workers that asked to be recycled (see `daemon.hygiene`). They get no
+        # new components, and exit once drained
+        self._recycling: Set[str] = set()
 
-        self._is_pool_updated = asyncio.Queue(1)
+        # Notifies /pool_push subscribers. Each keeps only the latest update
+        self._pool_updates = BroadcastHub()
 
         self._config = UStoreConf()
 
         self._connect_ssh()
 
+        # Packages most used by components, preloaded by the zygote. Only
+        # learned if the zygote is enabled
+        self._profile: Optional[zygote.PackageProfile] = None
+        self._zygote_port: Optional[int] = None
+        self._zygote_token = secrets.token_hex(32)
+        if conf.getboolean("zygote", "enable"):
+            self._profile = zygote.PackageProfile(
+                os.path.join(env.temp_path, "zygote_profile.json"),
+                conf.getint("zygote", "profile_size"),
+            )
+            self._start_zygote()
+
     @property
     def active_workers(self):
         return self._active_workers
@@ -88,6 +115,23 @@ class Scheduler:
         )
         self.sshclient = ssh_client
 
+    @property
+    def pool_updates(self) -> BroadcastHub:
+        return self._pool_updates
+
+    def _on_pool_updated(self):
+        self._pool_version += 1
+        self._pool_updates.publish()
+
+    @property
+    def pool_version(self):
+        """Changes whenever `pool_info_dict` may change. Cheap to compute"""
+        return (
+            self._pool_version,
+            tuple(w.version for w in self._active_workers),
+            tuple(w.version for w in self._cached_workers),
+        )
+
     @property
     def pool_info_dict(self):
         return {
@@ -97,8 +141,97 @@ class Scheduler:
 
     def _print_workers(self):
         self.logger.debug(
-            f"Active: {self._active_workers}; Cached: {self._cached_workers}"
+            "Active: %s; Cached: %s", self._active_workers, self._cached_workers
+        )
+
+    def _on_dispatched(self, queued_at: float, result: str):
+        metrics.counter(
+            "seccask_worker_cache_total",
+            "Components served by a cached worker (hit), queued on a busy "
+            "worker (queued), or waiting for a new worker (miss)",
+            result=result,
+        ).inc()
+        metrics.histogram(
+            "seccask_queue_wait_seconds",
+            "Time from requesting a worker to dispatching the component",
+            result=result,
+        ).observe(time.time() - queued_at)
+
+    def _on_compatibility_checked(self, level: str, compatible: bool):
+        metrics.counter(
+            "seccask_compatibility_checks_total",
+            "Worker-component compatibility checks by level and result",
+            level=level,
+            result="hit" if compatible else "miss",
+        ).inc()
+
+    def _format_worker_command(self, worker_args: str, output_file: str):
+        section_name = "worker_sgx" if conf.is_sgx_enabled else "worker"
+
+        # COMMAND_ESCAPED = r"{{ env PYTHONDONTWRITEBYTECODE=1 {}{}{}cset shield --exec {} -- {} --worker --mode={} {} -P{} ; }} > {} 2>&1"
+        COMMAND_ESCAPED = r"{{ env PYTHONDONTWRITEBYTECODE=1 {}{}{}env {} {} --worker --mode={} {} -P{} ; }} > {} 2>&1"
+        return COMMAND_ESCAPED.format(
+            "SECCASK_DEBUG_ENCFS=1 " if conf.getboolean("log", "log_encfs") else "",
+            "SECCASK_PROFILE_IO=1 " if conf.getboolean("log", "log_io") else "",
+            "/usr/bin/time -v " if conf.getboolean("log", "log_time") else "",
+            conf.get(section_name, "gramine_path"),
+            conf.get(section_name, "gramine_manifest_path"),
+            "ratls"
+            if conf.is_sgx_enabled and conf.getboolean("ratls", "enable")
+            else "tls",
+            worker_args,
+            conf.get("coordinator", "worker_manager_port"),
+            output_file,
+        ).split()
+
+    def _start_zygote(self):
+        assert self._profile is not None
+        packages = [
+            p.strip() for p in conf.get("zygote", "packages").split(",") if p.strip()
+        ] or self._profile.packages
+        port = conf.getint("zygote", "port")
+        args = f"--zygote-port={port}"
+        if packages:
+            args += f" --profile={','.join(packages)}"
+        cmds = self._format_worker_command(
+            args, os.path.join(env.temp_path, "zygote.log")
+        )
+        self.logger.info("Starting zygote with profile %s", packages)
+        if conf.is_sgx_enabled:
+            self.logger.warning(
+                "Under SGX, forking copies the enclave, and may be slower than a "
+                "cold start. See daemon.zygote"
+            )
+        self.logger.debug(f"CLI CMD: {' '.join(cmds)}")
+        stdin, _, _ = self.sshclient.exec_command(" ".join(cmds))
+        # Not on the command line, which other users of the host can read
+        stdin.write(f"{self._zygote_token}\n")
+        stdin.flush()
+        self._zygote_port = port
+
+    def _spawn_from_zygote(self, id: str, output_file: str) -> bool:
+        """Fork a new worker from the zygote. False if it is not reachable"""
+        try:
+            # The zygote listens on the loopback of the worker host
+            channel = self.sshclient.get_transport().open_channel(  # type: ignore
+                "direct-tcpip", ("127.0.0.1", self._zygote_port), ("127.0.0.1", 0)
+            )
+            with channel:
+                response = zygote.request_spawn(
+                    channel, self._zygote_token, id, output_file
+                )
+        except (paramiko.SSHException, OSError, ValueError) as e:
+            self.logger.warning("Zygote unavailable (%r). Start a cold worker", e)
+            return False
+
+        self.logger.debug(
+            "Worker %s forked from zygote as PID %s", id, response.get("pid")
         )
+        metrics.counter(
+            "seccask_zygote_saved_seconds_total",
+            "Package import time saved by workers forked from the zygote",
+        ).inc(response.get("preload_seconds", 0.0))
+        return True
 
     def _execute_new_worker_command(self):
         id = str(uuid.uuid4())
@@ -107,6 +240,12 @@ class Scheduler:
         # strace_file_name = os.path.join(env.temp_path, f"strace-{id}.txt")
         self.logger.debug(f"Creating new worker. CLI output to {temp_file_name}")
 
+        if self._zygote_port is not None:
+            self._spawned_at[id] = (time.time(), "zygote")
+            if self._spawn_from_zygote(id, temp_file_name):
+                return
+        self._spawned_at[id] = (time.time(), "cold")
+
         section_name = "worker_sgx" if conf.is_sgx_enabled else "worker"
 
         # cmds_template = (
@@ -145,21 +284,7 @@ class Scheduler:
         # )
 
         """Use SecCask 2 binary"""
-        # COMMAND_ESCAPED = r"{{ env PYTHONDONTWRITEBYTECODE=1 {}{}{}cset shield --exec {} -- {} --worker --mode={} --id={} -P{} ; }} > {} 2>&1"
-        COMMAND_ESCAPED = r"{{ env PYTHONDONTWRITEBYTECODE=1 {}{}{}env {} {} --worker --mode={} --id={} -P{} ; }} > {} 2>&1"
-        cmds = COMMAND_ESCAPED.format(
-            "SECCASK_DEBUG_ENCFS=1 " if conf.getboolean("log", "log_encfs") else "",
-            "SECCASK_PROFILE_IO=1 " if conf.getboolean("log", "log_io") else "",
-            "/usr/bin/time -v " if conf.getboolean("log", "log_time") else "",
-            conf.get(section_name, "gramine_path"),
-            conf.get(section_name, "gramine_manifest_path"),
-            "ratls"
-            if conf.is_sgx_enabled and conf.getboolean("ratls", "enable")
-            else "tls",
-            id,
-            conf.get("coordinator", "worker_manager_port"),
-            temp_file_name,
-        ).split()
+        cmds = self._format_worker_command(f"--id={id}", temp_file_name)
 
         # cmds = r"mkdir -p {}; cd {}; {{ {}cset shield --exec env -- PYTHONDONTWRITEBYTECODE=1 {}{}{} -- {} {} --worker --mode={} --id={} -P{} ; }} > {} 2>&1".format(
         # cmds = r"mkdir -p {}; cd {}; {{ {}cset shield --exec env -- PYTHONDONTWRITEBYTECODE=1 {}{}{} {} --worker --mode={} --id={} -P{} ; }} > {} 2>&1".format(
@@ -209,10 +334,43 @@ class Scheduler:
     def cache_worker(self, worker: "wc.BaseWorkerConnection"):
         self._active_workers.remove(worker)
         self._cached_workers.add(worker)
+        self._on_pool_updated()
 
     def activate_worker(self, worker: "wc.BaseWorkerConnection"):
         self._cached_workers.remove(worker)
         self._active_workers.add(worker)
+        worker.on_dispatch()
+        self._on_pool_updated()
+
+    def recycle_worker(self, worker: "wc.BaseWorkerConnection"):
+        self._active_workers.remove(worker)
+        self._recycling.discard(worker.id)
+        self._on_pool_updated()
+        metrics.counter(
+            "seccask_worker_recycled_total",
+            "Workers replaced because their memory grew too much",
+        ).inc()
+        cpp_coordinator.on_cache_full(worker.id)
+
+    def on_component_done(
+        self, worker: "wc.BaseWorkerConnection", resource_usage: str = "{}"
+    ):
+        """Cache the worker once its run queue is drained, unless it asked to be
+        recycled
+        """
+        worker.on_done()
+        try:
+            if json.loads(resource_usage).get("recycle"):
+                self.logger.info("Worker %s asked to be recycled", worker)
+                self._recycling.add(worker.id)
+        except ValueError:
+            self.logger.warning("Invalid resource usage from %s", worker)
+
+        if worker.num_in_flight == 0:
+            if worker.id in self._recycling:
+                self.recycle_worker(worker)
+            else:
+                self.cache_worker(worker)
 
     @property
     def is_worker_set_full(self):
@@ -223,42 +381,71 @@ class Scheduler:
         component: p.Component,
         callback: Callable[[str], None],
     ) -> None:
-        self.logger.debug(f"Component {component} getting compatible worker")
+        self.logger.debug("Component %s getting compatible worker", component)
+        queued_at = time.time()
+        if self._profile is not None:
+            self._profile.observe(component.get_manifest().packages)
         for w in self._cached_workers:
             if conf.getboolean("scheduler", "__debug_singleton_worker"):
                 """Always reuse worker"""
-                self.logger.debug(f"Found Worker {w} for Component {component}")
+                self.logger.debug("Found Worker %s for Component %s", w, component)
                 self.activate_worker(w)
                 self._record_last_executed_component(w, component)
 
                 self._print_workers()
                 callback(w.id)
+                self._on_dispatched(queued_at, "hit")
                 return
 
             if conf.getboolean("scheduler", "enable_compatibility_check_on_caching"):
                 if self.is_compatible(w, component):
-                    self.logger.debug(f"Found Worker {w} for Component {component}")
+                    self.logger.debug("Found Worker %s for Component %s", w, component)
                     self.activate_worker(w)
                     self._record_last_executed_component(w, component)
-                    # notify(self._is_pool_updated)
 
                     self._print_workers()
                     callback(w.id)
+                    self._on_dispatched(queued_at, "hit")
 
                     return
                 else:
                     self.logger.debug(
-                        f"Worker {w} not compatible with Component {component}"
+                        "Worker %s not compatible with Component %s", w, component
                     )
             else:
-                self.logger.debug(f"Worker-component compatible check disabled")
+                self.logger.debug("Worker-component compatible check disabled")
+
+        if self._pipeline_depth > 1 and conf.getboolean(
+            "scheduler", "enable_compatibility_check_on_caching"
+        ):
+            # Queue the component on a busy worker, so that it starts right
+            # after the running one without another round trip
+            for w in self._active_workers:
+                if (
+                    w.num_in_flight >= self._pipeline_depth
+                    or w.needs_resync
+                    or w.id in self._recycling
+                ):
+                    continue
+                if self.is_compatible(w, component):
+                    self.logger.debug(
+                        "Queue Component %s on busy Worker %s (%d in flight)",
+                        component,
+                        w,
+                        w.num_in_flight,
+                    )
+                    w.on_dispatch()
+                    self._record_last_executed_component(w, component)
+                    callback(w.id)
+                    self._on_dispatched(queued_at, "queued")
+                    return
 
         if len(self._active_workers) >= self._num_slot:
             raise WorkerPoolFull
 
         if self.is_worker_set_full:
             w = self._cached_workers.remove_end(component)
-            # notify(self._is_pool_updated)
+            self._on_pool_updated()
 
             self.logger.debug(
                 f"Worker set full. Remove cached worker {w} based on policy"
@@ -269,7 +456,8 @@ class Scheduler:
         self._execute_new_worker_command()
 
         self._waiting_components.add(component)
-        self.logger.debug(f"Component {component} waiting for new worker")
+        self._waiting_since[component] = queued_at
+        self.logger.debug("Component %s waiting for new worker", component)
         print(f"[Coordinator] TIME OF WAITING NEW WORKER: {time.time()}")
 
     def is_compatible(
@@ -279,65 +467,99 @@ class Scheduler:
             return False
 
         component_manifest = component.get_manifest()
-        self.logger.debug(f"Worker manifest:")
-        print(yaml.safe_dump(dict(worker.manifest)))
-        self.logger.debug(
-            f"Component manifest for [{component_manifest.name} {component_manifest.version}]:"
-        )
-        print(yaml.safe_dump(dict(component_manifest)))
 
         # Level 1: Library Version Compatibility
         if (
             worker.manifest.name == component_manifest.name
             and worker.manifest.version == component_manifest.version
         ):
-            self.logger.debug(f"Worker {worker} == L1 == Component {component}")
+            self.logger.debug("Worker %s == L1 == Component %s", worker, component)
+            self._on_compatibility_checked("L1", True)
             return True
 
-        self.logger.debug(f"Worker {worker} == L1 X == Component {component}")
+        self.logger.debug("Worker %s == L1 X == Component %s", worker, component)
+        self._on_compatibility_checked("L1", False)
+
+        # Level 2/3 results only depend on packages. Reuse them until a manifest
+        # delta touches one of the component's packages
+        cached = worker.compat_index.get(component_manifest)
+        if cached is not None:
+            self.logger.debug(
+                "Worker %s == L2/L3 %s(cached) == Component %s",
+                worker,
+                "" if cached else "X ",
+                component,
+            )
+            self._on_compatibility_checked("cached", cached)
+            return cached
+
+        result = self._is_package_compatible(worker, component, component_manifest)
+        worker.compat_index.put(component_manifest, result)
+        return result
 
+    def _is_package_compatible(
+        self,
+        worker: "wc.BaseWorkerConnection",
+        component: p.Component,
+        component_manifest: Manifest,
+    ) -> bool:
         # Level 2: Package Hash
-        if worker.manifest.packages_hash == component_manifest.packages_hash:
-            self.logger.debug(f"Worker {worker} == L2 == Component {component}")
+        if worker.manifest.packages_hash == component_manifest.packages_hash:  # type: ignore
+            self.logger.debug("Worker %s == L2 == Component %s", worker, component)
+            self._on_compatibility_checked("L2", True)
             return True
 
-        self.logger.debug(f"Worker {worker} == L2 X == Component {component}")
+        self.logger.debug("Worker %s == L2 X == Component %s", worker, component)
+        self._on_compatibility_checked("L2", False)
 
         if conf.getboolean("scheduler", "__debug_disable_level3_check"):
             return False
         # Level 3: Package Version Compatibility
-        active_packages = worker.manifest.packages
+        active_packages = worker.manifest.packages  # type: ignore
         for p, v in component_manifest.packages.items():
             if p not in active_packages or v != active_packages[p]:
-                self.logger.debug(f"Worker {worker} == L3 X == Component {component}")
+                self.logger.debug(
+                    "Worker %s == L3 X == Component %s", worker, component
+                )
+                self._on_compatibility_checked("L3", False)
                 return False
-        self.logger.debug(f"Worker {worker} == L3 == Component {component}")
+        self.logger.debug("Worker %s == L3 == Component %s", worker, component)
+        self._on_compatibility_checked("L3", True)
         return True
 
     def on_worker_ready(
         self, worker: "wc.BaseWorkerConnection", callback: Callable[[p.Component], None]
     ):
         self._cached_workers.add(worker)
-        # notify(self._is_pool_updated)
+        self._on_pool_updated()
+
+        spawned = self._spawned_at.pop(worker.id, None)
+        if spawned is not None:
+            spawned_at, mode = spawned
+            metrics.histogram(
+                "seccask_worker_spawn_seconds",
+                "Time from spawning a worker to receiving its manifest",
+                mode=mode,
+            ).observe(time.time() - spawned_at)
 
         for wc in self._waiting_components:
             if conf.getboolean("scheduler", "enable_compatibility_check_on_new_worker"):
                 if not self.is_compatible(worker, wc):
                     self.logger.debug(
-                        f"Worker {worker} not compatible with Component {wc}"
+                        "Worker %s not compatible with Component %s", worker, wc
                     )
                     continue
 
-            self.logger.debug(f"Found Worker {worker} for Component {wc}")
+            self.logger.debug("Found Worker %s for Component %s", worker, wc)
             self._waiting_components.remove(wc)
 
             if worker in self._new_workers:
                 self._new_workers.remove(worker)
             self.activate_worker(worker)
             self._record_last_executed_component(worker, wc)
-            # notify(self._is_pool_updated)
 
             callback(wc)
+            self._on_dispatched(self._waiting_since.pop(wc, time.time()), "miss")
             break
 
         self._print_workers()
@@ -351,13 +573,18 @@ class Scheduler:
             worker.manifest.version = SemanticVersion.from_version_str(
                 cm.version.version_str
             )
-            self.logger.debug(f"{worker}'s last executed component is now: {component}")
+            self._on_pool_updated()
+            self.logger.debug(
+                "%s's last executed component is now: %s", worker, component
+            )
             self.logger.debug(
-                f"{worker.manifest.name}:{worker.manifest.version.version_str}"
+                "%s:%s", worker.manifest.name, worker.manifest.version.version_str
             )
 
     async def close(self):
         """Close scheduler. This will trigger `ConnectionClose` to all workers."""
+        if self._profile is not None:
+            self._profile.save()
         for w in self._cached_workers:
             self.logger.debug(f"Sending exit to [{w}]")
             await w.exit()
@@ -1,6 +1,7 @@
 from abc import ABCMeta, abstractmethod
+import itertools
 import json
-from typing import List, Optional
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
 
 
 from pipeman.utils import LogUtils
@@ -9,6 +10,43 @@ from manifest import Manifest
 from daemon.message import Message
 
 
+class CompatibilityIndex:
+    """Package-level (L2/L3) compatibility results of one worker.
+
+    Entries are keyed by component manifest hash and remember which packages
+    the result depends on, so that a manifest delta only invalidates the
+    entries of components using one of the touched packages.
+    """
+
+    def __init__(self) -> None:
+        self._entries: Dict[str, Tuple[bool, FrozenSet[str]]] = {}
+
+    def get(self, component_manifest: Manifest) -> Optional[bool]:
+        entry = self._entries.get(component_manifest.packages_hash)
+        return entry[0] if entry is not None else None
+
+    def put(self, component_manifest: Manifest, result: bool) -> None:
+        self._entries[component_manifest.packages_hash] = (
+            result,
+            frozenset(component_manifest.packages.keys()),
+        )
+
+    def invalidate(self, package_names: Iterable[str]) -> int:
+        names = set(package_names)
+        stale = [
+            k for k, (_, deps) in self._entries.items() if not deps.isdisjoint(names)
+        ]
+        for k in stale:
+            del self._entries[k]
+        return len(stale)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
 class BaseWorkerConnection(metaclass=ABCMeta):
     # def __init__(self, id: str, coordinator: "coord.Coordinator") -> None:
     def __init__(self, id: str) -> None:
@@ -16,6 +54,12 @@ class BaseWorkerConnection(metaclass=ABCMeta):
         # self._coordinator = coordinator
         self._manifest: Optional[Manifest] = None
         self._id = id
+        self._manifest_seq = -1
+        self._manifest_fingerprint: Optional[str] = None
+        self._needs_resync = False
+        self._compat_index = CompatibilityIndex()
+        self._num_in_flight = 0
+        self._version = 0
 
     @property
     def id(self):
@@ -28,8 +72,107 @@ class BaseWorkerConnection(metaclass=ABCMeta):
     def manifest(self) -> Optional[Manifest]:
         return self._manifest
 
+    @property
+    def compat_index(self) -> CompatibilityIndex:
+        return self._compat_index
+
+    @property
+    def num_in_flight(self) -> int:
+        """Number of components dispatched to the worker and not yet done.
+        Components beyond the first wait in the run queue of the worker.
+        """
+        return self._num_in_flight
+
+    @property
+    def version(self) -> int:
+        """Changes whenever `info_dict` may change"""
+        return self._version
+
+    def on_dispatch(self) -> None:
+        self._num_in_flight += 1
+        self._version += 1
+
+    def on_done(self) -> None:
+        if self._num_in_flight == 0:
+            self.logger.error(f"-{self._id}- Got done without running component")
+            return
+        self._num_in_flight -= 1
+        self._version += 1
+
+    @property
+    def needs_resync(self) -> bool:
+        """True if a manifest delta could not be applied. The coordinator should
+        then send `request_manifest` so the worker reports a full manifest.
+        """
+        return self._needs_resync
+
+    def _apply_manifest_delta(self, delta: dict) -> bool:
+        """Apply a delta from `manifest.ManifestDeltaPublisher`.
+
+        Returns:
+            bool: whether this is the first manifest of the worker
+        """
+        new_worker = self._manifest is None
+
+        if delta["full"] or self._manifest is None:
+            if not delta["full"]:
+                self.logger.error(f"-{self._id}- Got delta before full manifest")
+                self._needs_resync = True
+                return False
+
+            manifest = Manifest(
+                {
+                    "type": "library",
+                    "packages_semver": False,
+                    "packages": delta["added"],
+                }
+            )
+            if self._manifest is not None:
+                manifest.name = self._manifest.name
+                manifest.version = self._manifest.version
+            manifest.appendix = {"worker_id": delta.get("worker_id", self._id)}
+            self._manifest = manifest
+            self._compat_index.clear()
+
+        else:
+            if (
+                delta["seq"] != self._manifest_seq + 1
+                or delta["base"] != self._manifest_fingerprint
+            ):
+                self.logger.error(
+                    f"-{self._id}- Manifest delta {delta['seq']} does not apply "
+                    f"on {self._manifest_seq}. Resync required"
+                )
+                self._needs_resync = True
+                return False
+
+            self._manifest.apply_delta(
+                delta["added"], delta["removed"], delta["changed"]
+            )
+            touched = itertools.chain(
+                delta["added"].keys(), delta["removed"], delta["changed"].keys()
+            )
+            n = self._compat_index.invalidate(touched)
+            if n > 0:
+                self.logger.debug(
+                    f"-{self._id}- {n} compatibility entries invalidated"
+                )
+
+        self._manifest_seq = delta["seq"]
+        self._manifest_fingerprint = delta["fingerprint"]
+        self._needs_resync = False
+        return new_worker
+
     def on_msg(self, msg: Message):
-        if msg.cmd == "response_manifest":
+        self._version += 1
+
+        if msg.cmd == "manifest_delta":
+            new_worker = self._apply_manifest_delta(json.loads(msg.args[0]))
+            if new_worker:
+                self.logger.debug(f"New worker ready: {self._id}")
+            return new_worker
+
+        elif msg.cmd == "response_manifest":
             manifest_json = msg.args[0]
 
             new_worker = False
@@ -43,6 +186,8 @@ class BaseWorkerConnection(metaclass=ABCMeta):
             json_content = json.loads(manifest_json)
 
             self._manifest = Manifest(json_content)
+            self._manifest_fingerprint = self._manifest.package_set.fingerprint
+            self._compat_index.clear()
 
             if last_name and last_version:
                 self._manifest.name = last_name
@@ -67,19 +212,15 @@ class BaseWorkerConnection(metaclass=ABCMeta):
     def __iter__(self):
         yield ("name", str(self))
         yield ("id", self.id)
-        yield (
-            "manifest",
-            json.loads(self.manifest.json(refresh=False)) if self.manifest else None,
-        )
+        yield ("manifest", self.manifest.info_dict if self.manifest else None)
 
     @property
     def info_dict(self):
         return {
             "name": str(self),
             "worker_id": self.id,
-            "manifest": json.loads(self.manifest.json(refresh=False))
-            if self.manifest
-            else None,
+            "num_in_flight": self.num_in_flight,
+            "manifest": self.manifest.info_dict if self.manifest else None,
         }
 
     @abstractmethod